@@ -18,7 +18,7 @@ keyboard_description = "US (Mac)"
 # German:
 # -------
 
-# language_id = '0C07'
+# language_id = '0407'
 # language_tag = 'de-DE'
 # language_name = 'German (DE)'
 # keyboard_description = "German (Mac)"
@@ -26,11 +26,23 @@ keyboard_description = "US (Mac)"
 # French:
 # -------
 
-# language_id = '080C'
+# language_id = '040C'
 # language_tag = 'fr-FR'
 # language_name = 'French (FR)'
 # keyboard_description = "French (Mac)"
 
+# Locale profiles, selectable by language tag (--locale), in addition to
+# the locale above. More profiles can be loaded from a JSON file
+# (--locale-file), see load_locale_profiles in mac2winKeyboard.py.
+# language tag: (language_id, language_name, keyboard_description)
+
+locale_profiles = {
+    'ne-NE': ('0000', 'Neutral (Neutral)', "Custom (Mac)"),
+    'en-US': ('0409', 'English (United States)', "US (Mac)"),
+    'de-DE': ('0407', 'German (DE)', "German (Mac)"),
+    'fr-FR': ('040C', 'French (FR)', "French (Mac)"),
+}
+
 # more:
 # http://msdn.microsoft.com/en-us/library/windows/desktop/dd318693(v=vs.85).aspx
 # https://docs.microsoft.com/en-us/openspecs/windows_protocols/ms-lcid/63d3d639-7fd2-4afb-abbe-0d5b5551eef8
@@ -0,0 +1,645 @@
+#!/bin/env python
+'''
+Benchmark the conversion pipeline of mac2winKeyboard.py on synthetic
+keyboard layouts of increasing size, and compare the results to a stored
+baseline. Fails (exit code 1) if a stage got much slower than the baseline
+(relative to a reference workload timed on the same machine), or if a stage
+scales worse than linearly with the size which drives it (the input file,
+the actions, the keys or the .klc lines).
+With --import-time, the start-up cost of mac2winKeyboard.py is measured
+instead.
+'''
+
+import os
+import sys
+import time
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import math
+import tempfile
+import tracemalloc
+
+import xml.etree.ElementTree as ET
+
+from mac2winKeyboard import (
+    ConversionProfile, KeylayoutParser, encode_klc, filter_xml,
+    iter_prefiltered_xml, make_klc_data, prefilter_xml, write_klc,
+)
+from data.klc_data import win_to_mac_keycodes
+
+
+default_baseline = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'tests', 'benchmark_baseline.json')
+
+default_scales = [1, 4, 16]
+
+# A stage's time (relative to the reference time, see reference_workload)
+# and the peak memory may be this many times larger than in the baseline.
+default_tolerance = 3.0
+
+# Maximum exponent of the growth of a stage's time with the size which
+# drives it (1.0 is linear scaling; cache effects alone take larger layouts
+# up to about 1.3, a quadratic stage to 2.0).
+default_max_exponent = 1.5
+
+# Timings shorter than this (in seconds) are too noisy for a scaling check
+# or a comparison with the baseline.
+min_scaling_time = 0.005
+
+default_repeat = 5
+
+# The size which drives the work of a stage, fitted against the stage's
+# time in the scaling check. Other stages are driven by the input size.
+# (The synthetic layouts grow by their actions and dead key states, while
+# the number of keys stays the same.)
+stage_sizes = {
+    'KeylayoutParser.find_deadkeys': 'action_list',
+    'KeylayoutParser.match_actions': 'action_list',
+    'KeylayoutParser.find_outputs': 'key_list',
+    'KeylayoutParser.make_deadkey_dict': 'action_list',
+    'KeylayoutParser.make_output_dict': 'key_list',
+    'make_klc_data': 'klc_lines',
+    'write_utf16': 'klc_lines',
+}
+
+# Modules which mac2winKeyboard.py only imports when they are needed; none of
+# them may be imported on start-up.
+lazy_modules = [
+    'argparse', 'concurrent.futures', 'cProfile', 'glob', 'hashlib', 'json',
+    'tarfile', 'tempfile', 'xml.etree.ElementTree', 'zipfile',
+    'data.klc_data',
+]
+
+# Modifier combinations assigned to the synthetic keymaps, in order.
+modifier_combinations = [
+    'command?',
+    'anyShift caps?',
+    'caps',
+    'anyOption',
+    'anyShift caps? anyOption command?',
+    'caps anyOption',
+    'caps? anyOption command',
+    'anyShift caps? option? command? control',
+    'rightShift control',
+    'anyControl anyOption',
+]
+
+parser_passes = [
+    'parse', 'find_deadkeys', 'match_actions', 'find_outputs',
+    'make_deadkey_dict', 'make_output_dict']
+
+
+def make_synthetic_keylayout(
+    keymaps=8, actions=200, deadkey_states=10, ligatures=20
+):
+    '''
+    Return the XML of a synthetic keyboard layout with the given number of
+    keymaps (and keyMapSelect modifiers), actions, dead key states and
+    ligature outputs. Outputs are mostly private use code points, as in a
+    Pi font layout.
+    '''
+
+    mac_keycodes = sorted(set(win_to_mac_keycodes.values()))
+    space_keycode = 49
+
+    lines = [
+        '<?xml version="1.1" encoding="UTF-8"?>',
+        '<!DOCTYPE keyboard SYSTEM '
+        '"file://localhost/System/Library/DTDs/KeyboardLayout.dtd">',
+        '<keyboard group="126" id="-9999" name="synthetic" maxout="2">',
+        '    <layouts>',
+        '        <layout first="0" last="17" mapSet="ANSI" '
+        'modifiers="Modifiers"/>',
+        '    </layouts>',
+        '    <modifierMap id="Modifiers" defaultIndex="0">',
+    ]
+    for index in range(keymaps):
+        keys = modifier_combinations[index % len(modifier_combinations)]
+        lines.extend([
+            f'        <keyMapSelect mapIndex="{index}">',
+            f'            <modifier keys="{keys}"/>',
+            '        </keyMapSelect>',
+        ])
+    lines.extend([
+        '    </modifierMap>',
+        '    <keyMapSet id="ANSI">',
+    ])
+
+    action_id = 0
+    ligature_id = 0
+    for index in range(keymaps):
+        lines.append(f'        <keyMap index="{index}">')
+        for position, keycode in enumerate(mac_keycodes):
+            if keycode == space_keycode:
+                lines.append(
+                    f'            <key code="{keycode}" action="space"/>')
+            elif index == 0 and position < deadkey_states:
+                lines.append(
+                    f'            <key code="{keycode}" '
+                    f'action="dead{position}"/>')
+            elif (position + index) % 3 == 0 and actions:
+                lines.append(
+                    f'            <key code="{keycode}" '
+                    f'action="a{action_id % actions}"/>')
+                action_id += 1
+            elif ligature_id < ligatures and (position + index) % 7 == 1:
+                lines.append(
+                    f'            <key code="{keycode}" '
+                    f'output="&#xE{ligature_id % 0x1000:03X};&#x0301;"/>')
+                ligature_id += 1
+            else:
+                codepoint = 0xE000 + (index * 0x100 + position) % 0x1900
+                lines.append(
+                    f'            <key code="{keycode}" '
+                    f'output="&#x{codepoint:04X};"/>')
+        lines.append('        </keyMap>')
+    lines.extend([
+        '    </keyMapSet>',
+        '    <actions>',
+    ])
+
+    # the space bar, yielding the dead key characters in dead key states
+    lines.extend([
+        '        <action id="space">',
+        '            <when state="none" output="&#x0020;"/>',
+    ])
+    for state in range(deadkey_states):
+        lines.append(
+            f'            <when state="s{state}" '
+            f'output="&#x{0xF000 + state:04X};"/>')
+    lines.append('        </action>')
+
+    for state in range(deadkey_states):
+        lines.extend([
+            f'        <action id="dead{state}">',
+            f'            <when state="none" next="s{state}"/>',
+            '        </action>',
+        ])
+
+    for action in range(actions):
+        lines.extend([
+            f'        <action id="a{action}">',
+            f'            <when state="none" '
+            f'output="&#x{0xE800 + action % 0x800:04X};"/>',
+        ])
+        for offset in range(min(deadkey_states, 4)):
+            state = (action + offset) % deadkey_states
+            lines.append(
+                f'            <when state="s{state}" '
+                f'output="&#x{0xF100 + (action + state) % 0xE00:04X};"/>')
+        lines.append('        </action>')
+
+    lines.extend([
+        '    </actions>',
+        '    <terminators>',
+    ])
+    for state in range(deadkey_states):
+        lines.append(
+            f'        <when state="s{state}" '
+            f'output="&#x{0xF000 + state:04X};"/>')
+    lines.extend([
+        '    </terminators>',
+        '</keyboard>',
+    ])
+    return '\n'.join(lines)
+
+
+def make_spec(scale):
+    '''
+    Return the parameters of a synthetic layout for a given scale.
+    '''
+
+    return {
+        'keymaps': 8,
+        'actions': 250 * scale,
+        'deadkey_states': 8 * scale,
+        'ligatures': 10 * scale,
+    }
+
+
+def reference_workload():
+    '''
+    A fixed amount of string formatting and dict work, akin to that of the
+    conversion. The timings are stored in the baseline relative to the time
+    of this workload, so that they do not depend on the machine.
+    '''
+
+    table = {}
+    for index in range(50000):
+        table[f'{index:04x}'] = index
+    return len(table)
+
+
+def time_call(function, *args, repeat=default_repeat):
+    '''
+    Return the best time of several calls to function, and its result.
+    '''
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark_layout(keylayout_path, repeat=default_repeat):
+    '''
+    Time every stage of the conversion of a .keylayout file.
+    Return a tuple of dicts ({stage: seconds}, {data: size}); the sizes are
+    those of the input, of the parser's data structures and of the output.
+    '''
+
+    timings = {}
+    with open(keylayout_path, 'rb') as f:
+        input_bytes = f.read()
+
+    timings['filter_xml'], filtered_xml = time_call(
+        filter_xml, keylayout_path, repeat=repeat)
+    timings['prefilter_xml'], _ = time_call(
+        prefilter_xml, input_bytes, repeat=repeat)
+    timings['ET.XML'], tree = time_call(ET.XML, filtered_xml, repeat=repeat)
+
+    pass_times = {}
+    for i in range(repeat):
+        profile = ConversionProfile()
+        keyboard_data = KeylayoutParser(tree, profile=profile)
+        for name, stage in profile.stages.items():
+            elapsed = stage['time']
+            pass_times[name] = min(pass_times.get(name, elapsed), elapsed)
+    for name in parser_passes:
+        timings[f'KeylayoutParser.{name}'] = pass_times[name]
+    sizes = {'input_size': len(input_bytes), **profile.sizes}
+
+    timings['stream_parse'], _ = time_call(
+        lambda: KeylayoutParser(
+            xml_chunks=iter_prefiltered_xml(input_bytes)),
+        repeat=repeat)
+
+    timings['make_klc_data'], klc_data = time_call(
+        make_klc_data, 'synthetic', keyboard_data, repeat=repeat)
+
+    klc_path = os.path.splitext(keylayout_path)[0] + '.klc'
+    timings['write_utf16'], _ = time_call(
+        lambda: write_klc(encode_klc(klc_data), klc_path), repeat=repeat)
+    sizes['klc_lines'] = len(klc_data)
+
+    return timings, sizes
+
+
+def measure_peak_memory(keylayout_path):
+    '''
+    Return the peak memory (in bytes) allocated while converting a
+    .keylayout file.
+    '''
+
+    tracemalloc.start()
+    try:
+        tree = ET.XML(filter_xml(keylayout_path))
+        keyboard_data = KeylayoutParser(tree)
+        make_klc_data('synthetic', keyboard_data)
+        tree_peak = tracemalloc.get_traced_memory()[1]
+        del tree, keyboard_data
+
+        tracemalloc.reset_peak()
+        with open(keylayout_path, 'rb') as f:
+            keyboard_data = KeylayoutParser(
+                xml_chunks=iter_prefiltered_xml(f.read()))
+        make_klc_data('synthetic', keyboard_data)
+        stream_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'tree': tree_peak, 'stream': stream_peak}
+
+
+def run_benchmark(scales=default_scales, repeat=default_repeat):
+    '''
+    Benchmark synthetic layouts of the given scales.
+    Return a list of result dicts, one per scale.
+    '''
+
+    results = []
+    reference_time, _ = time_call(reference_workload, repeat=repeat)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for scale in scales:
+            spec = make_spec(scale)
+            keylayout_path = os.path.join(
+                temp_dir, f'synthetic{scale}.keylayout')
+            with open(keylayout_path, 'w', encoding='utf-8') as f:
+                f.write(make_synthetic_keylayout(**spec))
+
+            # silence the ligature messages
+            with contextlib.redirect_stdout(io.StringIO()):
+                # as timeit does, keep the garbage collector from
+                # distorting the timings
+                gc.collect()
+                gc.disable()
+                try:
+                    timings, sizes = benchmark_layout(
+                        keylayout_path, repeat)
+                finally:
+                    gc.enable()
+                peak_memory = measure_peak_memory(keylayout_path)
+
+            results.append({
+                'scale': scale,
+                'spec': spec,
+                'input_size': os.path.getsize(keylayout_path),
+                'sizes': sizes,
+                'timings': timings,
+                'reference_time': reference_time,
+                'peak_memory': peak_memory,
+            })
+    return results
+
+
+def measure_import_time(module='mac2winKeyboard', repeat=5):
+    '''
+    Import a module in fresh interpreters (python -X importtime).
+    Return a tuple (best cumulative import time in seconds, list of all
+    modules imported along with it). The time is None if the module was
+    not imported (for instance, if it was already loaded on start-up).
+    '''
+
+    import subprocess
+
+    best = None
+    for i in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        imported = []
+        elapsed = None
+        for line in completed.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            imported.append(name)
+            if name == module:
+                elapsed = int(fields[1]) / 1e6
+        if elapsed is not None and (best is None or elapsed < best):
+            best = elapsed
+    return best, imported
+
+
+def check_lazy_imports(imported):
+    '''
+    Return a list of error messages, one for each lazy module (see
+    lazy_modules) found in the imported modules.
+    '''
+
+    return [
+        f'{module} is imported on start-up'
+        for module in lazy_modules if module in imported]
+
+
+def get_stage_size(result, stage):
+    '''
+    Return the size which drives a stage (see stage_sizes) in a result.
+    '''
+
+    sizes = result.get('sizes', {})
+    return sizes.get(stage_sizes.get(stage), result['input_size'])
+
+
+def fit_exponent(points):
+    '''
+    Return the exponent of the power law best fitting a list of (size,
+    time) points (a least squares fit of their logarithms), or None if the
+    sizes do not grow.
+    '''
+
+    logs = [(math.log(size), math.log(elapsed)) for size, elapsed in points]
+    mean_size = sum(log_size for log_size, _ in logs) / len(logs)
+    mean_time = sum(log_time for _, log_time in logs) / len(logs)
+    variance = sum((log_size - mean_size) ** 2 for log_size, _ in logs)
+    if variance <= 0:
+        return None
+    return sum(
+        (log_size - mean_size) * (log_time - mean_time)
+        for log_size, log_time in logs) / variance
+
+
+def check_scaling(results, max_exponent=default_max_exponent):
+    '''
+    Fit the growth of each stage's time against the size which drives it
+    (see stage_sizes), over the layouts on which the stage takes long
+    enough to be timed reliably. Stages driven by a size which does not
+    grow are fitted against the input size instead.
+    Return a list of error messages.
+    '''
+
+    errors = []
+    for stage in results[-1]['timings']:
+        timed = [
+            result for result in results
+            if result['timings'].get(stage, 0) >= min_scaling_time]
+        if len(timed) < 2:
+            continue
+        exponent = fit_exponent([
+            (get_stage_size(result, stage), result['timings'][stage])
+            for result in timed])
+        if exponent is None:
+            exponent = fit_exponent([
+                (result['input_size'], result['timings'][stage])
+                for result in timed])
+        if exponent is not None and exponent > max_exponent:
+            errors.append(
+                f'{stage} scales with exponent {exponent:.2f} '
+                f'(maximum {max_exponent:.2f})')
+    return errors
+
+
+def make_baseline(results):
+    '''
+    Return the results with their timings relative to the reference time
+    (see reference_workload) instead of absolute, to be stored as a
+    baseline.
+    '''
+
+    return [
+        {
+            'scale': result['scale'],
+            'spec': result['spec'],
+            'input_size': result['input_size'],
+            'sizes': dict(result['sizes']),
+            'relative_timings': {
+                stage: elapsed / result['reference_time']
+                for stage, elapsed in result['timings'].items()},
+            'peak_memory': dict(result['peak_memory']),
+        }
+        for result in results]
+
+
+def compare_baseline(results, baseline, tolerance=default_tolerance):
+    '''
+    Compare the results to a baseline, for all scales contained in both:
+    the time of each stage relative to the reference time, and the peak
+    memory.
+    Return a list of error messages.
+    '''
+
+    errors = []
+    baseline_results = {result['scale']: result for result in baseline}
+    for result in results:
+        baseline_result = baseline_results.get(result['scale'])
+        if baseline_result is None:
+            continue
+        for stage, elapsed in result['timings'].items():
+            baseline_time = baseline_result['relative_timings'].get(stage)
+            if baseline_time is None or elapsed < min_scaling_time:
+                continue
+            relative_time = elapsed / result['reference_time']
+            if relative_time > baseline_time * tolerance:
+                errors.append(
+                    f'{stage} (scale {result["scale"]}) took '
+                    f'{relative_time:.2f} reference times, baseline '
+                    f'{baseline_time:.2f}')
+        for mode, peak in result['peak_memory'].items():
+            baseline_peak = baseline_result['peak_memory'].get(mode)
+            if baseline_peak and peak > baseline_peak * tolerance:
+                errors.append(
+                    f'peak memory ({mode}, scale {result["scale"]}) is '
+                    f'{peak / 1024:.0f} KB, baseline '
+                    f'{baseline_peak / 1024:.0f} KB')
+    return errors
+
+
+def print_results(results):
+    stages = list(results[0]['timings'])
+    width = max(len(stage) for stage in stages)
+    header = ''.join(
+        f'{"scale " + str(result["scale"]):>14}' for result in results)
+    print(f'{"":{width}}{header}')
+    print(f'{"input size (KB)":{width}}' + ''.join(
+        f'{result["input_size"] / 1024:14.1f}' for result in results))
+    for stage in stages:
+        print(f'{stage:{width}}' + ''.join(
+            f'{result["timings"][stage] * 1000:11.2f} ms'
+            for result in results))
+    for mode in results[0]['peak_memory']:
+        print(f'{"peak memory, " + mode + " (KB)":{width}}' + ''.join(
+            f'{result["peak_memory"][mode] / 1024:14.0f}'
+            for result in results))
+
+
+def get_args(args=None):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__)
+
+    parser.add_argument(
+        '-s', '--scales',
+        nargs='+',
+        type=int,
+        default=default_scales,
+        help='sizes of the synthetic layouts (default: %(default)s)',
+        metavar='N',
+    )
+
+    parser.add_argument(
+        '-b', '--baseline',
+        default=default_baseline,
+        help='baseline file (default: tests/benchmark_baseline.json)',
+        metavar='FILE',
+    )
+
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='store the results as the new baseline',
+    )
+
+    parser.add_argument(
+        '-t', '--tolerance',
+        type=float,
+        default=default_tolerance,
+        help=(
+            'maximum slowdown factor (relative to the reference time) '
+            'and peak memory growth compared to the baseline '
+            '(default: %(default)s)'),
+        metavar='FACTOR',
+    )
+
+    parser.add_argument(
+        '--import-time',
+        action='store_true',
+        help=(
+            'measure the import time of mac2winKeyboard.py, and check '
+            'that no lazily imported module is loaded on start-up'),
+    )
+
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=default_repeat,
+        help=(
+            'number of timed runs per stage, of which the best is kept '
+            '(default: %(default)s)'),
+        metavar='N',
+    )
+
+    return parser.parse_args(args)
+
+
+def run_import_time(repeat):
+    elapsed, imported = measure_import_time(repeat=max(repeat, 5))
+    if elapsed is None:
+        print('mac2winKeyboard was not found in the import times')
+        return 1
+    print(
+        f'import mac2winKeyboard: {elapsed * 1000:.2f} ms, '
+        f'{len(imported)} modules')
+
+    errors = check_lazy_imports(imported)
+    if errors:
+        print('\nREGRESSIONS:')
+        for error in errors:
+            print(f'  {error}')
+        return 1
+    print('\nNo regressions.')
+    return 0
+
+
+def run(args):
+    if getattr(args, 'import_time', False):
+        return run_import_time(args.repeat)
+
+    results = run_benchmark(sorted(args.scales), args.repeat)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(make_baseline(results), f, indent=2)
+        print(f'\nBaseline written to {args.baseline}')
+        return 0
+
+    errors = check_scaling(results)
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        errors.extend(compare_baseline(results, baseline, args.tolerance))
+    else:
+        print(f'\nNo baseline found at {args.baseline}')
+
+    if errors:
+        print('\nREGRESSIONS:')
+        for error in errors:
+            print(f'  {error}')
+        return 1
+    print('\nNo regressions.')
+    return 0
+
+
+if __name__ == '__main__':
+    args = get_args()
+    sys.exit(run(args))
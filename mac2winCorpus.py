@@ -0,0 +1,462 @@
+#!/bin/env python
+'''
+Analyze a corpus of keyboard layouts with NumPy. The outputs of every
+layout (key codes of the .klc key table x Mac shift states) are stacked
+into one integer matrix, one row per layout, on which duplicate layouts,
+layouts differing in only a few keys, and the use of code points are
+found with vectorized operations.
+
+Sources are the same as for mac2winKeyboard.py --batch: directories,
+glob patterns, archives, manifest files, .keylayout and .ir.json files.
+Requires NumPy.
+'''
+
+import os
+import sys
+
+import argparse
+import json
+
+from mac2winKeyboard import (
+    Diagnostics, KeyOutputTable, collect_input_files, get_keycode_plan,
+    process_input_keylayout,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+error_msg_numpy = (
+    'NumPy is required for corpus analytics (pip install numpy).')
+
+# Values of the cells of the corpus matrix which are not a code point.
+# Dead keys (marked with @ in .klc files) are code points with the
+# deadkey_flag bit set.
+undefined_output = -1
+unknown_output = -2
+deadkey_flag = 1 << 24
+
+# Layouts which differ in at most this many cells are reported.
+default_max_distance = 4
+
+# Number of cells compared at once when computing distances between
+# layouts, which limits the size of temporary arrays.
+distance_block_cells = 1 << 24
+
+# Number of code points listed in the report.
+default_top_codepoints = 20
+
+# Number of key/shift state columns listed in the report.
+default_top_columns = 20
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError(error_msg_numpy)
+
+
+def output_value(output):
+    '''
+    Return the integer value of a key output ('00e9', '00b4@' or '-1').
+    '''
+
+    if output == '-1':
+        return undefined_output
+    try:
+        value = int(output.rstrip('@'), 16)
+    except ValueError:
+        return unknown_output
+    if output.endswith('@'):
+        value |= deadkey_flag
+    return value
+
+
+def format_value(value):
+    '''
+    Return the .klc notation of a cell value (see output_value).
+    '''
+
+    if value == undefined_output:
+        return '-1'
+    if value == unknown_output:
+        return '?'
+    if value & deadkey_flag:
+        return f'{value & ~deadkey_flag:04x}@'
+    return f'{value:04x}'
+
+
+def get_corpus_keycodes():
+    '''
+    Return the Mac key codes of the .klc key table, in its order.
+    '''
+
+    keycodes = []
+    for win_kc_hex, win_kc_name, mac_kc in get_keycode_plan()[0]:
+        if mac_kc not in keycodes:
+            keycodes.append(mac_kc)
+    return keycodes
+
+
+def layout_row(keyboard_data, keycodes, keymapset_id=None):
+    '''
+    Return the outputs of a parsed layout (see KeylayoutParser) as a row of
+    the corpus matrix: one int32 value (see output_value) for every key
+    code and shift state (KeyOutputTable.columns), read directly from the
+    output table of a keymap set (default: the first keymap set).
+    '''
+
+    require_numpy()
+
+    if keymapset_id is None:
+        output_table = keyboard_data.output_table
+    else:
+        output_table = keyboard_data.output_tables[keymapset_id]
+    number_of_columns = len(KeyOutputTable.columns)
+
+    # every distinct output of the table is converted once
+    pool = np.array(
+        [output_value(output) for output in output_table.outputs],
+        dtype=np.int32)
+    # the rows of a derived table are filled in from its base
+    table_keycodes, table_cells = output_table.dense()
+    cells = np.frombuffer(
+        table_cells, dtype=np.dtype(table_cells.typecode)
+    ).reshape(-1, number_of_columns)
+    defined = np.frombuffer(table_keycodes, dtype=np.uint8)
+
+    keycodes = np.asarray(keycodes)
+    present = keycodes < len(defined)
+    present[present] = defined[keycodes[present]] != 0
+
+    row = np.full(
+        (len(keycodes), number_of_columns), undefined_output, dtype=np.int32)
+    row[present] = pool[cells[keycodes[present]]]
+    return row.ravel()
+
+
+def read_layout_row(input_file, keycodes):
+    '''
+    Parse a layout, and return (row, error), see layout_row.
+    '''
+
+    try:
+        keyboard_data = process_input_keylayout(
+            input_file, diagnostics=Diagnostics())
+        return layout_row(keyboard_data, keycodes), None
+    except (Exception, SystemExit) as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+class LayoutCorpus(object):
+    '''
+    The outputs of many keyboard layouts, as an int32 matrix with one row
+    per layout, and one column per key code and shift state (see
+    layout_row).
+    '''
+
+    def __init__(self, names, matrix, keycodes):
+        require_numpy()
+
+        self.names = list(names)
+        self.matrix = np.asarray(matrix, dtype=np.int32).reshape(
+            len(self.names), len(keycodes) * len(KeyOutputTable.columns))
+        self.keycodes = list(keycodes)
+
+        # (key code, shift state) of every column
+        self.columns = [
+            (keycode, state)
+            for keycode in self.keycodes
+            for state in KeyOutputTable.columns]
+
+    @classmethod
+    def from_files(cls, input_files, jobs=1):
+        '''
+        Parse layouts (on several worker processes if jobs > 1), and stack
+        them into a corpus. Return a tuple (corpus, failures), failures
+        being a list of (input file, error) tuples.
+        '''
+
+        require_numpy()
+
+        keycodes = get_corpus_keycodes()
+        if jobs > 1 and len(input_files) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(
+                    read_layout_row, input_files,
+                    [keycodes] * len(input_files), chunksize=16))
+        else:
+            results = [
+                read_layout_row(input_file, keycodes)
+                for input_file in input_files]
+
+        names, rows, failures = [], [], []
+        for input_file, (row, error) in zip(input_files, results):
+            if error:
+                failures.append((str(input_file), error))
+            else:
+                names.append(str(input_file))
+                rows.append(row)
+
+        matrix = np.stack(rows) if rows else np.empty(
+            (0, len(keycodes) * len(KeyOutputTable.columns)), dtype=np.int32)
+        return cls(names, matrix, keycodes), failures
+
+    def duplicates(self):
+        '''
+        Return the groups of layouts with identical outputs, as lists of
+        layout names (groups of at least two layouts).
+        '''
+
+        if not self.names:
+            return []
+        unique_rows, inverse, counts = np.unique(
+            self.matrix, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        groups = []
+        for group in np.flatnonzero(counts > 1):
+            groups.append([
+                self.names[index]
+                for index in np.flatnonzero(inverse == group)])
+        return groups
+
+    def iter_distance_blocks(self):
+        '''
+        Yield (first row, distances) for consecutive blocks of rows, the
+        distances being the Hamming distances (number of differing cells)
+        between the rows of the block and all rows of the corpus.
+        '''
+
+        number_of_rows, number_of_cells = self.matrix.shape
+        block_rows = max(1, distance_block_cells // max(
+            1, number_of_rows * number_of_cells))
+        for first in range(0, number_of_rows, block_rows):
+            block = self.matrix[first:first + block_rows]
+            yield first, np.count_nonzero(
+                block[:, np.newaxis, :] != self.matrix[np.newaxis, :, :],
+                axis=2)
+
+    def hamming_distances(self):
+        '''
+        Return the square matrix of the Hamming distances between all
+        layouts.
+        '''
+
+        number_of_rows = len(self.names)
+        distances = np.zeros((number_of_rows, number_of_rows), dtype=np.int32)
+        for first, block in self.iter_distance_blocks():
+            distances[first:first + len(block)] = block
+        return distances
+
+    def near_duplicates(self, max_distance=default_max_distance):
+        '''
+        Return the pairs of layouts which differ in 1 to max_distance cells,
+        as a list of (distance, name, other name) tuples, closest first.
+        The full distance matrix is never held in memory.
+        '''
+
+        pairs = []
+        for first, block in self.iter_distance_blocks():
+            rows, others = np.nonzero(
+                (block > 0) & (block <= max_distance))
+            rows += first
+            for row, other, distance in zip(
+                rows, others, block[rows - first, others]
+            ):
+                if row < other:
+                    pairs.append((
+                        int(distance), self.names[row], self.names[other]))
+        return sorted(pairs)
+
+    def differing_columns(self, name, other_name):
+        '''
+        Return the cells in which two layouts differ, as a list of
+        (key code, shift state, output, other output) tuples.
+        '''
+
+        row = self.matrix[self.names.index(name)]
+        other_row = self.matrix[self.names.index(other_name)]
+        return [
+            self.columns[column] + (
+                format_value(row[column]), format_value(other_row[column]))
+            for column in np.flatnonzero(row != other_row)]
+
+    def column_histograms(self):
+        '''
+        Return the number of layouts using every output in every column, as
+        a list of (key code, shift state, output, count) tuples, sorted by
+        column. Undefined cells are not counted.
+        '''
+
+        number_of_cells = self.matrix.shape[1]
+        column_index = np.broadcast_to(
+            np.arange(number_of_cells, dtype=np.int64), self.matrix.shape)
+        defined = self.matrix != undefined_output
+        # one key per (column, value) pair, values shifted to be positive
+        keys = (
+            column_index[defined] << 32 |
+            (self.matrix[defined].astype(np.int64) - unknown_output))
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        columns = unique_keys >> 32
+        values = (unique_keys & 0xffffffff) + unknown_output
+        return [
+            self.columns[column] + (format_value(value), int(count))
+            for column, value, count in zip(columns, values, counts)]
+
+    def codepoint_usage(self):
+        '''
+        Return the number of layouts using every code point (in any key and
+        shift state, dead keys included), as a list of (code point, count)
+        tuples, most used first.
+        '''
+
+        number_of_rows = self.matrix.shape[0]
+        values = self.matrix & ~deadkey_flag
+        row_index = np.broadcast_to(
+            np.arange(number_of_rows, dtype=np.int64)[:, np.newaxis],
+            self.matrix.shape)
+        defined = self.matrix >= 0
+        # every code point counted once per layout
+        keys = np.unique(
+            row_index[defined] << 32 | values[defined].astype(np.int64))
+        codepoints, counts = np.unique(
+            keys & 0xffffffff, return_counts=True)
+        order = np.lexsort((codepoints, -counts))
+        return [
+            (format_value(codepoints[index]), int(counts[index]))
+            for index in order]
+
+    def as_dict(self, max_distance=default_max_distance):
+        return {
+            'layouts': self.names,
+            'duplicates': self.duplicates(),
+            'near_duplicates': self.near_duplicates(max_distance),
+            'codepoint_usage': self.codepoint_usage(),
+            'column_histograms': self.column_histograms(),
+        }
+
+
+def group_column_histograms(histograms):
+    '''
+    Group the column histograms (see LayoutCorpus.column_histograms) by
+    column. Return a list of (key code, shift state, [(output, count)])
+    tuples, the columns with the most different outputs first.
+    '''
+
+    import itertools
+
+    columns = [
+        (keycode, state, [(output, count) for _, _, output, count in group])
+        for (keycode, state), group in itertools.groupby(
+            histograms, lambda histogram: histogram[:2])]
+    columns.sort(key=lambda column: -len(column[2]))
+    return columns
+
+
+def print_report(
+    corpus, failures, max_distance=default_max_distance,
+    top_codepoints=default_top_codepoints, top_columns=default_top_columns
+):
+    print(f'{len(corpus.names)} layouts, {len(failures)} failed.')
+    for input_file, error in failures:
+        print(f'FAILED  {input_file}: {error}')
+
+    duplicates = corpus.duplicates()
+    print(f'\n{len(duplicates)} groups of identical layouts')
+    for group in duplicates:
+        print('  ' + ', '.join(group))
+
+    near_duplicates = corpus.near_duplicates(max_distance)
+    print(
+        f'\n{len(near_duplicates)} pairs of layouts differing in at most '
+        f'{max_distance} keys/states')
+    for distance, name, other_name in near_duplicates:
+        print(f'  {distance}  {name}  {other_name}')
+        for keycode, state, output, other_output in (
+            corpus.differing_columns(name, other_name)
+        ):
+            print(f'       key {keycode} {state}: {output} / {other_output}')
+
+    print(f'\nMost used code points (of {len(corpus.names)} layouts)')
+    for codepoint, count in corpus.codepoint_usage()[:top_codepoints]:
+        print(f'  {codepoint}  {count}')
+
+    columns = [
+        column
+        for column in group_column_histograms(corpus.column_histograms())
+        if len(column[2]) > 1]
+    print(f'\n{len(columns)} keys/states with different outputs')
+    for keycode, state, outputs in columns[:top_columns]:
+        print(f'  key {keycode} {state}: ' + ', '.join(
+            f'{output} ({count})' for output, count in outputs))
+
+
+def get_args(args=None):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        'sources',
+        nargs='+',
+        help='directories, glob patterns, archives or manifest files',
+        metavar='SOURCE',
+    )
+
+    parser.add_argument(
+        '-d', '--max-distance',
+        type=int,
+        default=default_max_distance,
+        help=(
+            'report pairs of layouts differing in at most N keys/states '
+            '(default: %(default)s)'),
+        metavar='N',
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help='number of worker processes (default: number of CPU cores)',
+        metavar='N',
+    )
+
+    parser.add_argument(
+        '--json',
+        help='write the results to a JSON file',
+        metavar='FILE',
+    )
+
+    return parser.parse_args(args)
+
+
+def run(args):
+    if np is None:
+        print(error_msg_numpy)
+        return 1
+
+    input_files = collect_input_files(args.sources)
+    if not input_files:
+        print('No .keylayout files found.')
+        return 1
+
+    jobs = getattr(args, 'jobs', None) or os.cpu_count() or 1
+    corpus, failures = LayoutCorpus.from_files(input_files, jobs)
+    print_report(corpus, failures, args.max_distance)
+
+    json_path = getattr(args, 'json', None)
+    if json_path:
+        results = corpus.as_dict(args.max_distance)
+        results['failures'] = failures
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nResults written to {json_path}')
+    return 0
+
+
+if __name__ == '__main__':
+    args = get_args()
+    sys.exit(run(args))
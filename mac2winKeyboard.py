@@ -9,19 +9,30 @@ import re
 import sys
 import time
 
-import argparse
-import codecs
+import array
+import collections
+import contextlib
+import functools
+import mmap
 import unicodedata
 
-import xml.etree.ElementTree as ET
+from itertools import dropwhile
+
+import xml.parsers.expat as expat
+
+# Modules only needed for some tasks (argparse, concurrent.futures, glob,
+# hashlib, json, tarfile, tempfile, xml.etree, zipfile, cProfile) are
+# imported where they are
+# used, and the .klc data tables are loaded on first use (see
+# load_klc_data), to keep the start of single conversions fast.
+
+__version__ = '2.01'
 
 # local modules
-from data.klc_data import (
-    win_to_mac_keycodes, win_keycodes,
-    klc_keynames, klc_prologue_dummy, klc_epilogue_dummy
-)
+from data import locale_data
 from data.locale_data import (
-    keyboard_description, language_id, language_name, language_tag
+    keyboard_description, language_id, language_name, language_tag,
+    locale_profiles
 )
 
 error_msg_conversion = (
@@ -38,23 +49,521 @@ error_msg_macwin_mismatch = (
 error_msg_winmac_mismatch = (
     "// Could not match Windows code {} ('{}') to Mac OS code {}. Skipping.")
 
+error_msg_keymap_unassigned = (
+    '// Keymap {} ({}) matches no Windows shift state. Skipping.')
+
+error_msg_deadkey_state = (
+    '// Dead key state {} has no output (no space bar action or terminator).'
+    ' Skipping.')
+
+error_msg_output_collision = (
+    'Output file {} is already written for {}. Please rename the source '
+    'file.')
+error_msg_variant_collision = (
+    'Output file {} would be written for two variants of the layout. '
+    'Please rename the source file.')
+
+error_msg_keymap_base = (
+    '// Keymap {} of keyMapSet {} inherits from keymap {} of keyMapSet {}, '
+    'which {}. Using its own keys only.')
+
+error_msg_output_variants = (
+    'Several .klc files (keyMapSets, locales) cannot be written to a '
+    'single output.')
+
+error_msg_locale_unknown = (
+    'Unknown locale {}. Available locales: {}')
+
+error_msg_locale_file = (
+    'Invalid locale file {}: {}')
+
+error_msg_ir_file = (
+    'Invalid intermediate representation file {}: {}')
+
+
+# Number of code points whose descriptions are memoized.
+codepoint_cache_size = 8192
+
+# Polling interval and debounce time of the watch mode, in seconds. A save
+# is converted at most watch_interval + watch_debounce after it happened
+# (plus the conversion itself), well within the 100 ms target.
+watch_interval = 0.02
+watch_debounce = 0.025
+
+# Output directory argument for writing to standard output.
+stdout_sink = '-'
 
-# Change the line separator.
-# This is important, as the output klc file must be UTF-16 LE with
-# Windows-style line breaks.
-os.linesep = '\r\n'
+# Suffix, format name and version of the intermediate representation
+# files (see KeylayoutParser.as_ir). Increase the version with every change
+# of the format, or of the parser results stored in it.
+ir_suffix = '.ir.json'
+ir_format = 'mac2winKeyboard-ir'
+ir_version = 2
+
+# Byte order mark of the UTF-16 (little-endian) .klc files.
+klc_bom = '\ufeff'.encode('utf-16-le')
+
+# Suffixes of the zip and tar archives read as input sources.
+archive_suffixes = (
+    '.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Number of archives kept open for reading members (per process).
+open_archive_cache_size = 8
+
+# Archive members are read and prefiltered in blocks of whole lines of
+# (at least) this many bytes.
+stream_block_size = 64 * 1024
+
+# Default size limit of the .klc cache, in bytes.
+default_cache_size = 256 * 1024 * 1024
+
+# The locale, as configured in data/locale_data.py.
+Locale = collections.namedtuple('Locale', [
+    'language_id', 'language_tag', 'language_name', 'keyboard_description'])
+default_locale = Locale(
+    language_id, language_tag, language_name, keyboard_description)
+
+# Built-in locale profiles {language tag: Locale}, see data/locale_data.py.
+builtin_locales = {
+    tag: Locale(profile_id, tag, profile_name, profile_description)
+    for tag, (profile_id, profile_name, profile_description)
+    in locale_profiles.items()}
+builtin_locales.setdefault(language_tag, default_locale)
+
+# company = 'Adobe Systems Incorporated'
+default_company = 'myCompany'
 
 # Placeholder character for replacing 'ligatures' (more than one character
 # mapped to one key), which are not supported by this conversion script.
 replacement_char = '007E'
 
+# Bits of the modifier tokens (in the keys attribute of a <modifier>) which
+# are relevant for the Windows shift states. All other tokens (e.g.
+# 'control', 'rightShift') share one more bit, which no shift state allows.
+modifier_bits = {
+    token: 1 << bit for bit, token in enumerate((
+        'anyShift', 'anyShift?', 'anyOption', 'anyOption?',
+        'command', 'command?', 'caps', 'caps?'))}
+other_modifier_bit = 1 << len(modifier_bits)
+
+
+# A diagnostic event of a conversion.
+# kind: one of the event kinds below, message: human-readable description,
+# file: the input file (if known), keycode: the Mac key code (if any),
+# codepoints: hex strings of the characters involved
+DiagnosticEvent = collections.namedtuple('DiagnosticEvent', [
+    'kind', 'message', 'file', 'keycode', 'codepoints'])
+
+event_skipped_key = 'skipped_key'
+event_sgcap = 'sgcap'
+event_ligature = 'ligature'
+event_unassigned_keymap = 'unassigned_keymap'
+event_deadkey_state = 'deadkey_state'
+event_keymap_base = 'keymap_base'
+event_keycode_gap = 'keycode_gap'
+
+# Events of these kinds are the same for every layout (e.g. the gaps of the
+# key code plan). They are recorded by every Diagnostics object, but only
+# printed once per process.
+once_per_process_events = {event_keycode_gap}
+
+# (kind, message) of the once-per-process events printed in this process.
+printed_events = set()
+
+# How a Diagnostics object passes on the events it records:
+# print: print every message, quiet: nothing, summary: print a count of
+# the events per kind when finished, jsonl: write every event as a line
+# of JSON.
+diagnostics_modes = ('print', 'quiet', 'summary', 'jsonl')
+
+
+def should_print_event(kind, message):
+    '''
+    Whether an event is printed (or written as JSON): events of the kinds
+    in once_per_process_events only the first time in a process.
+    '''
+
+    if kind not in once_per_process_events:
+        return True
+    if (kind, message) in printed_events:
+        return False
+    printed_events.add((kind, message))
+    return True
+
+
+class Diagnostics(object):
+    '''
+    Collect the diagnostic events (skipped keys, SGCaps conversions,
+    replaced ligatures, ...) of a conversion, instead of printing them
+    one by one (see diagnostics_modes).
+    Output is written to stream (default: sys.stdout at the time of
+    writing).
+    '''
+
+    def __init__(self, mode='quiet', file=None, stream=None):
+        if mode not in diagnostics_modes:
+            raise ValueError(f'Unknown diagnostics mode {mode}')
+        self.mode = mode
+        self.file = file
+        self.stream = stream
+        self.events = []
+
+    @property
+    def messages(self):
+        return [event.message for event in self.events]
+
+    def report(self, message, kind='message', keycode=None, codepoints=()):
+        event = DiagnosticEvent(
+            kind, message, self.file, keycode, tuple(codepoints))
+        self.events.append(event)
+        if self.mode not in ('print', 'jsonl'):
+            return
+        if not should_print_event(kind, message):
+            return
+        if self.mode == 'print':
+            print(message, file=self.stream)
+        elif self.mode == 'jsonl':
+            import json
+
+            print(
+                json.dumps(event._asdict(), ensure_ascii=False),
+                file=self.stream, flush=True)
+
+    def counts(self):
+        '''
+        Return a Counter of the recorded events per kind.
+        '''
+
+        return collections.Counter(event.kind for event in self.events)
+
+    def finish(self):
+        '''
+        Print the summary of all events (in summary mode).
+        '''
+
+        if self.mode == 'summary' and self.events:
+            counts = ', '.join(
+                f'{count} {kind}' for kind, count in self.counts().items())
+            print(f'{self.file or "diagnostics"}: {counts}', file=self.stream)
+
+
+def report(message, diagnostics=None, kind='message', **details):
+    '''
+    Pass a message (and the details of the event, see DiagnosticEvent) to
+    a Diagnostics object, or print it if there is none.
+    '''
+
+    if diagnostics is None:
+        if should_print_event(kind, message):
+            print(message)
+    else:
+        diagnostics.report(message, kind, **details)
+
+
+def print_status(message, diagnostics_mode=None):
+    '''
+    Print a status message (e.g. the .klc file written, or the batch
+    summary). In jsonl mode, standard output is reserved for the JSON lines
+    of the diagnostics, so status messages go to standard error.
+    '''
+
+    if diagnostics_mode == 'jsonl':
+        print(message, file=sys.stderr)
+    else:
+        print(message)
+
+
+class ConversionProfile(object):
+    '''
+    Record the wall time and number of calls of the stages of a conversion,
+    and the sizes of intermediate data structures.
+    A disabled profile records nothing.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+        # {stage: {'time': seconds, 'calls': number of calls}}
+        self.stages = {}
+
+        # {data structure: number of items}
+        self.sizes = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Context manager timing a stage.
+        '''
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stage = self.stages.setdefault(name, {'time': 0.0, 'calls': 0})
+            stage['time'] += elapsed
+            stage['calls'] += 1
+
+    def record_sizes(self, **sizes):
+        if self.enabled:
+            self.sizes.update(sizes)
+
+    def as_dict(self):
+        return {
+            'stages': self.stages,
+            'sizes': self.sizes,
+            'codepoint_cache': codepoint_cache_info()._asdict(),
+        }
+
+    def write_json(self, path):
+        import json
+
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+# Used wherever no profile is passed.
+disabled_profile = ConversionProfile(enabled=False)
+
+
+class KeyOutputTable(object):
+    '''
+    Dense table of key outputs, indexed by Mac keycode and Windows column.
+    Every distinct output string is stored once in a pool; the cells of the
+    table are indexes into this pool.
+    '''
+
+    # Mac shift states, in the order of the Windows columns
+    # default, shift, ctrl, ctrl-shift, altGr, altGr-shift, caps, shift-caps
+    columns = (
+        'default', 'shift', 'cmd', 'cmdcaps',
+        'alt', 'altshift', 'caps', 'shiftcaps')
+
+    def __init__(self, size=0):
+        self.outputs = ['-1']
+        self.output_index = {'-1': 0}
+        self.cells = array.array('I', bytes(
+            size * len(self.columns) * array.array('I').itemsize))
+        self.keycodes = bytearray(size)
+
+    def __contains__(self, keycode):
+        return 0 <= keycode < len(self.keycodes) and self.keycodes[keycode]
+
+    def add_output(self, output):
+        '''
+        Return the index of an output in the pool, adding it if necessary.
+        '''
+
+        if output not in self.output_index:
+            self.output_index[output] = len(self.outputs)
+            self.outputs.append(output)
+        return self.output_index[output]
+
+    def set_row(self, keycode, outputs):
+        '''
+        Store the outputs of a key, one per column.
+        '''
+
+        offset = keycode * len(self.columns)
+        for column, output in enumerate(outputs):
+            self.cells[offset + column] = self.add_output(output)
+        self.keycodes[keycode] = 1
+
+    def get_row(self, keycode):
+        '''
+        Return the outputs of a key for all columns.
+        '''
+
+        offset = keycode * len(self.columns)
+        return tuple(
+            self.outputs[index]
+            for index in self.cells[offset:offset + len(self.columns)])
+
+    def get(self, keycode, state):
+        '''
+        Return the output of a key in a given state.
+        If no output, return '-1' (a.k.a. not defined).
+        '''
+
+        offset = keycode * len(self.columns) + self.columns.index(state)
+        return self.outputs[self.cells[offset]]
+
+    def dense(self):
+        '''
+        Return the table as (keycodes, cells): a flag for every key code,
+        and the pool indexes of all rows (see __init__).
+        '''
+
+        return self.keycodes, self.cells
+
+
+class DerivedKeyOutputTable(KeyOutputTable):
+    '''
+    Output table of a keyMapSet which inherits from another one (see
+    KeylayoutParser.make_keymapset_outputs): the pool and the rows of the
+    base table are shared, only the rows which differ are stored.
+    '''
+
+    def __init__(self, base):
+        self.base = base
+        self.outputs = base.outputs
+        self.output_index = base.output_index
+        self.cells = array.array('I')
+
+        # {keycode: row number in self.cells}
+        self.rows = {}
+
+    def __contains__(self, keycode):
+        return keycode in self.rows or keycode in self.base
+
+    def set_row(self, keycode, outputs):
+        if keycode not in self.rows:
+            self.rows[keycode] = len(self.rows)
+            self.cells.extend([0] * len(self.columns))
+        offset = self.rows[keycode] * len(self.columns)
+        for column, output in enumerate(outputs):
+            self.cells[offset + column] = self.add_output(output)
+
+    def get_row(self, keycode):
+        if keycode not in self.rows:
+            return self.base.get_row(keycode)
+        offset = self.rows[keycode] * len(self.columns)
+        return tuple(
+            self.outputs[index]
+            for index in self.cells[offset:offset + len(self.columns)])
+
+    def get(self, keycode, state):
+        if keycode not in self.rows:
+            return self.base.get(keycode, state)
+        offset = (
+            self.rows[keycode] * len(self.columns) +
+            self.columns.index(state))
+        return self.outputs[self.cells[offset]]
+
+    def dense(self):
+        '''
+        Return the table as (keycodes, cells), with the rows of the base
+        table filled in (a copy, see KeyOutputTable.dense).
+        '''
+
+        base_keycodes, base_cells = self.base.dense()
+        size = max(len(base_keycodes), max(self.rows, default=-1) + 1)
+        keycodes = base_keycodes + bytearray(size - len(base_keycodes))
+        cells = array.array('I', base_cells)
+        cells.extend([0] * (size * len(self.columns) - len(cells)))
+        width = len(self.columns)
+        for keycode, row in self.rows.items():
+            cells[keycode * width:(keycode + 1) * width] = (
+                self.cells[row * width:(row + 1) * width])
+            keycodes[keycode] = 1
+        return keycodes, cells
+
+
+@functools.lru_cache(maxsize=None)
+def load_klc_data():
+    '''
+    Import the .klc data tables (data/klc_data.py) on first use.
+    '''
+
+    from data import klc_data
+    return klc_data
+
+
+@functools.lru_cache(maxsize=None)
+def get_keycode_plan():
+    '''
+    Join the Windows key codes (win_keycodes) with their Mac equivalents
+    (win_to_mac_keycodes), once per process.
+    Return a tuple (plan, gaps): plan is a list of (scan code, virtual key
+    name, Mac key code) tuples in the order of the .klc key table, gaps is
+    a list of the messages for Windows key codes without a Mac equivalent.
+    '''
+
+    klc_data = load_klc_data()
+    plan = []
+    gaps = []
+    for win_kc_hex, win_kc_name in sorted(klc_data.win_keycodes.items()):
+        win_kc_int = int(win_kc_hex, 16)
+        if win_kc_int not in klc_data.win_to_mac_keycodes:
+            gaps.append(error_msg_macwin_mismatch.format(
+                win_kc_int, win_kc_name))
+            continue
+        plan.append((
+            win_kc_hex, win_kc_name,
+            klc_data.win_to_mac_keycodes[win_kc_int]))
+    return plan, gaps
+
+
+@functools.lru_cache(maxsize=None)
+def compile_modifier_keys(keys):
+    '''
+    Return the bitmask of a modifier expression (e.g. 'anyShift caps?'),
+    see modifier_bits.
+    '''
+
+    mask = 0
+    for token in keys.split():
+        mask |= modifier_bits.get(token, other_modifier_bit)
+    return mask
+
 
 class KeylayoutParser(object):
 
-    def __init__(self, tree):
+    # {shift state: (maximum, minimum) modifier configuration}
+    shift_state_rules = {
+        'default': ({'command?', 'caps?'}, set()),
+        'shift': ({'anyShift', 'caps?', 'command?'}, {'anyShift'}),
+        'alt': ({'anyOption', 'caps?', 'command?'}, {'anyOption'}),
+        'altshift': (
+            {'anyShift', 'anyOption', 'caps?', 'command?'},
+            {'anyShift', 'anyOption'}),
+        'cmd': ({'command', 'caps?', 'anyShift?', 'anyOption?'}, {'command'}),
+        'caps': ({'caps', 'anyShift?', 'command?'}, {'caps'}),
+        'cmdcaps': ({'command', 'caps', 'anyShift?'}, {'command', 'caps'}),
+        'shiftcaps': (
+            {'anyShift', 'caps', 'anyOption?'}, {'anyShift', 'caps'}),
+    }
+
+    # {shift state: (maximum, minimum) modifier bitmask}
+    shift_state_masks = {
+        state: (
+            compile_modifier_keys(' '.join(maxset)),
+            compile_modifier_keys(' '.join(minset)))
+        for state, (maxset, minset) in shift_state_rules.items()}
+
+    def __init__(
+        self, tree=None, xml_chunks=None, profile=None, diagnostics=None,
+        ir=None
+    ):
+        '''
+        Either pass an ElementTree (tree), an iterable of XML text chunks
+        (xml_chunks) to be parsed as a stream, or the intermediate
+        representation of a parsed layout (ir, see as_ir), which skips
+        parsing altogether.
+        If a ConversionProfile is passed, every pass is timed, and the sizes
+        of the resulting data structures are recorded.
+        Messages are printed, unless a Diagnostics object is passed.
+        '''
+
+        self.diagnostics = diagnostics
+
         # raw keys as they are in the layout XML
+        # (only kept while parsing, like output_list and keymaps)
         self.key_list = []
 
+        # {(keymap set ID, keymap index): {key code: output}}
+        # A keymap which inherits from another (baseMapSet, baseIndex) is a
+        # ChainMap of its own keys over the keys of its base keymap, which
+        # are shared rather than copied.
+        self.keymaps = {}
+
+        # {(keymap set ID, keymap index): (base keymap set ID, base index)}
+        self.keymap_bases = {}
+
         # raw list of actions collected from layout XML
         self.action_list = []
 
@@ -67,6 +576,15 @@ class KeylayoutParser(object):
         # {states: deadkeys}
         self.deadkeys = {}
 
+        # {state: output} of the <terminators>, output when a dead key state
+        # is terminated by a key without an action for that state.
+        self.terminators = {}
+
+        # {state: [next states]}, the transitions between the dead key
+        # states, and the states reachable from state none
+        self.state_graph = {}
+        self.reachable_states = []
+
         # {deadkey: (basekey, output)}
         self.deadkey_dict = {}
 
@@ -74,129 +592,394 @@ class KeylayoutParser(object):
         # in each individual state.
         self.output_dict = {}
 
+        # The outputs of every key, resolved to the Windows columns.
+        self.output_table = KeyOutputTable()
+
+        # IDs of all keymap sets, in order of appearance
+        self.keymapset_ids = []
+
+        # {keymap set ID: output dict}, {keymap set ID: output table}
+        # output_dict and output_table are those of the first keymap set.
+        # Keymap sets are stored in the order in which they were resolved
+        # (a base keymap set before the keymap sets derived from it).
+        self.output_dicts = {}
+        self.output_tables = {}
+
+        # {keymap set ID: base keymap set ID}, for keymap sets whose output
+        # dict is a ChainMap of the rows which differ over the output dict
+        # of their base (and whose output table is a DerivedKeyOutputTable).
+        self.keymapset_bases = {}
+
         # Actions that do not yield immediate output, but shift to a new state.
-        self.empty_actions = []
+        self.empty_actions = set()
+
+        # Indexes into self.action_list: {action ID: [action data]}
+        # and {state: [action data]}
+        self.actions_by_id = {}
+        self.actions_by_state = {}
 
         # {keymap ID: modifier key}
         self.keymap_assignments = {}
 
-        self.number_of_keymaps = 0
-
-        self.parse(tree)
-        self.find_deadkeys()
-        self.match_actions()
-        self.find_outputs()
-        self.make_deadkey_dict()
-        self.make_output_dict()
-
-    def check_states(self, states, keymap, maxset, minset, mod_name):
-        '''
-        Assign index numbers to the different shift states, by comparing
-        them to the minimum and maximum possible modifier configurations.
-        This is necessary as the arrangement in the Mac keyboard layout
-        is arbitrary.
-        '''
+        # {keymap index: [modifier expressions]}
+        self.keymap_modifiers = {}
 
-        if maxset.issuperset(states) and minset.issubset(states):
-            self.keymap_assignments[mod_name] = int(keymap)
+        # Keymap indexes not assigned to any Windows shift state
+        self.unassigned_keymaps = []
 
-    def parse(self, tree):
+        self.number_of_keymaps = 0
 
-        keymap_idx_list = []  # Find the number of keymap indexes.
+        # Events reported while parsing (if a Diagnostics object is passed),
+        # stored in the intermediate representation
+        self.parse_events = []
 
-        default_max = {'command?', 'caps?'}
-        default_min = set()
+        if profile is None:
+            profile = disabled_profile
 
-        alt_max = {'anyOption', 'caps?', 'command?'}
-        alt_min = {'anyOption'}
+        if ir is not None:
+            with profile.stage('load_ir'):
+                self.load_ir(ir)
+            return
 
-        shift_max = {'anyShift', 'caps?', 'command?'}
-        shift_min = {'anyShift'}
+        first_event = len(diagnostics.events) if diagnostics else 0
+        if xml_chunks is not None:
+            with profile.stage('parse_stream'):
+                self.parse_stream(xml_chunks)
+                self.find_unassigned_keymaps()
+        else:
+            with profile.stage('parse'):
+                self.parse(tree)
+                self.find_unassigned_keymaps()
+
+        for parser_pass in (
+            self.find_deadkeys,
+            self.match_actions,
+            self.find_outputs,
+            self.make_deadkey_dict,
+            self.make_output_dict,
+        ):
+            with profile.stage(parser_pass.__name__):
+                parser_pass()
+
+        profile.record_sizes(
+            key_list=len(self.key_list),
+            action_list=len(self.action_list),
+            deadkeys=len(self.deadkeys),
+            deadkey_dict=sum(map(len, self.deadkey_dict.values())),
+            output_dict=len(self.output_dict),
+            output_rows=sum(
+                len(getattr(output_dict, 'maps', [output_dict])[0])
+                for output_dict in self.output_dicts.values()),
+            keymaps=self.number_of_keymaps + 1,
+        )
+        if diagnostics:
+            self.parse_events = diagnostics.events[first_event:]
+
+        # the outputs are kept in the output dicts and tables only
+        self.key_list = []
+        self.output_list = []
+        self.keymaps = {}
 
-        altshift_max = {'anyShift', 'anyOption', 'caps?', 'command?'}
-        altshift_min = {'anyShift', 'anyOption'}
+    def as_ir(self):
+        '''
+        Return the intermediate representation of the parsed layout: the
+        results of the parser needed to render it (outputs of all keymap
+        sets, dead keys, keymap assignments), as a dict which can be
+        serialized as JSON (see write_ir).
+        '''
 
-        cmd_max = {'command', 'caps?', 'anyShift?', 'anyOption?'}
-        cmd_min = {'command'}
+        return {
+            'format': ir_format,
+            'version': ir_version,
+            'converter': __version__,
+            'number_of_keymaps': self.number_of_keymaps,
+            'keymapset_ids': self.keymapset_ids,
+            # {keymap set ID: [[key code, [output of every keymap]]]},
+            # bases first; derived keymap sets only hold the keys which
+            # differ from their base (see keymapset_bases)
+            'keymapsets': {
+                keymapset_id: [
+                    [key_id, list(key_outputs.values())]
+                    for key_id, key_outputs in getattr(
+                        output_dict, 'maps', [output_dict])[0].items()]
+                for keymapset_id, output_dict in self.output_dicts.items()},
+            'keymapset_bases': self.keymapset_bases,
+            'keymap_assignments': self.keymap_assignments,
+            'keymap_modifiers': [
+                [keymap_index, keys]
+                for keymap_index, keys in self.keymap_modifiers.items()],
+            'unassigned_keymaps': self.unassigned_keymaps,
+            'deadkeys': self.deadkeys,
+            'deadkey_dict': self.deadkey_dict,
+            'terminators': self.terminators,
+            'reachable_states': self.reachable_states,
+            'events': [
+                [event.kind, event.message, event.keycode, event.codepoints]
+                for event in self.parse_events],
+        }
+
+    def load_ir(self, ir):
+        '''
+        Restore the results of the parser from an intermediate
+        representation (see as_ir), and report the events of the parse
+        again. Raise ValueError for other formats or versions.
+        '''
 
-        caps_max = {'caps', 'anyShift?', 'command?'}
-        caps_min = {'caps'}
+        if not isinstance(ir, dict) or ir.get('format') != ir_format:
+            raise ValueError('not an intermediate representation')
+        if ir.get('version') != ir_version:
+            raise ValueError(
+                f'version {ir.get("version")} is not supported '
+                f'(expected {ir_version})')
+
+        self.number_of_keymaps = ir['number_of_keymaps']
+        self.keymapset_bases = ir['keymapset_bases']
+        for keymapset_id, key_rows in ir['keymapsets'].items():
+            output_dict = {
+                key_id: dict(enumerate(key_outputs))
+                for key_id, key_outputs in key_rows}
+            base_id = self.keymapset_bases.get(keymapset_id)
+            if base_id is not None:
+                base_dict = self.output_dicts[base_id]
+                output_dict = collections.ChainMap(
+                    output_dict, *getattr(base_dict, 'maps', [base_dict]))
+            self.output_dicts[keymapset_id] = output_dict
+        self.keymap_assignments = ir['keymap_assignments']
+        self.keymap_modifiers = {
+            keymap_index: keys
+            for keymap_index, keys in ir['keymap_modifiers']}
+        self.unassigned_keymaps = ir['unassigned_keymaps']
+        self.deadkeys = ir['deadkeys']
+        self.deadkey_dict = {
+            deadkey: [tuple(base_result) for base_result in base_results]
+            for deadkey, base_results in ir['deadkey_dict'].items()}
+        self.terminators = ir['terminators']
+        self.reachable_states = ir['reachable_states']
+
+        self.keymapset_ids = ir['keymapset_ids']
+        if self.keymapset_ids:
+            self.output_dict = self.output_dicts[self.keymapset_ids[0]]
+        self.make_output_table()
+
+        for kind, message, keycode, codepoints in ir['events']:
+            report(
+                message, self.diagnostics, kind, keycode=keycode,
+                codepoints=codepoints)
+        if self.diagnostics:
+            self.parse_events = self.diagnostics.events[
+                len(self.diagnostics.events) - len(ir['events']):]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def classify_modifier(keys):
+        '''
+        Return the shift states matching a modifier expression, by comparing
+        it to the minimum and maximum possible modifier configurations.
+        This is necessary as the arrangement in the Mac keyboard layout
+        is arbitrary.
+        '''
 
-        cmdcaps_max = {'command', 'caps', 'anyShift?'}
-        cmdcaps_min = {'command', 'caps'}
+        mask = compile_modifier_keys(keys)
+        return tuple(
+            state
+            for state, (max_mask, min_mask)
+            in KeylayoutParser.shift_state_masks.items()
+            if not mask & ~max_mask and mask & min_mask == min_mask)
 
-        shiftcaps_max = {'anyShift', 'caps', 'anyOption?'}
-        shiftcaps_min = {'anyShift', 'caps'}
+    def parse(self, tree):
+        '''
+        Collect modifiers, keys and actions from an ElementTree.
+        '''
 
         for parent in tree.iter():
 
             if parent.tag == 'keyMapSelect':
                 for modifier in parent:
-                    keymap_index = int(parent.get('mapIndex'))
-                    keymap_idx_list.append(keymap_index)
-
-                    keymap = parent.get('mapIndex')
-                    states = set(modifier.get('keys').split())
-
-                    self.check_states(
-                        states, keymap, default_max, default_min, 'default')
-                    self.check_states(
-                        states, keymap, shift_max, shift_min, 'shift')
-                    self.check_states(
-                        states, keymap, alt_max, alt_min, 'alt')
-                    self.check_states(
-                        states, keymap, altshift_max, altshift_min, 'altshift')
-                    self.check_states(
-                        states, keymap, cmd_max, cmd_min, 'cmd')
-                    self.check_states(
-                        states, keymap, caps_max, caps_min, 'caps')
-                    self.check_states(
-                        states, keymap, cmdcaps_max, cmdcaps_min, 'cmdcaps')
-                    self.check_states(
-                        states, keymap,
-                        shiftcaps_max, shiftcaps_min, 'shiftcaps')
+                    self.add_modifier(
+                        parent.get('mapIndex'), modifier.get('keys'))
 
             if parent.tag == 'keyMapSet':
                 keymapset_id = parent.attrib['id']
                 for keymap in parent:
-                    keymap_index = int(keymap.attrib['index'])
+                    keymap_index = self.add_keymap(
+                        keymapset_id, keymap.attrib)
                     for key in keymap:
-                        key_code = int(key.attrib['code'])
-                        if key.get('action') is None:
-                            key_type = 'output'
-                        else:
-                            key_type = 'action'
-                        output = key.get(key_type)
-
-                        self.key_list.append([
-                            keymapset_id, keymap_index,
-                            key_code, key_type, output])
+                        self.add_key(keymapset_id, keymap_index, key.attrib)
 
             if parent.tag == 'actions':
                 for action in parent:
                     action_id = action.get('id')
                     for action_trigger in action:
-                        if action_trigger.get('next') is None:
-                            action_type = 'output'
-                        else:
-                            action_type = 'next'
-                        state = action_trigger.get('state')
-
-                        # result can be a code point or another state
-                        result = action_trigger.get(action_type)
-                        self.action_list.append([
-                            action_id, state, action_type, result])
-
-                        # Make a dictionary for key id to output.
-                        # On the Mac keyboard, the 'a' for example is often
-                        # matched to an action, as it can produce
-                        # agrave, aacute, etc.
-                        if [state, action_type] == ['none', 'output']:
-                            self.action_basekeys[action_id] = result
-
-        # Yield the highest index assigned to a shift state - thus, the
+                        self.add_action(action_id, action_trigger.attrib)
+
+            if parent.tag == 'terminators':
+                for terminator in parent:
+                    self.add_terminator(terminator.attrib)
+
+    def parse_stream(self, xml_chunks):
+        '''
+        Collect modifiers, keys and actions from an iterable of XML text
+        (or bytes) chunks, using the event-driven expat parser.
+        No element tree is built; the conversion tables are filled directly
+        from the start-element events.
+        '''
+
+        # stack of (tag, attributes) of the currently open elements,
+        # starting with two placeholders for the root's (grand)parent
+        open_elements = [(None, {}), (None, {})]
+
+        def start_element(tag, attrs):
+            parent_tag, parent_attrs = open_elements[-1]
+            grandparent_tag, grandparent_attrs = open_elements[-2]
+
+            if parent_tag == 'keyMapSelect':
+                self.add_modifier(
+                    parent_attrs.get('mapIndex'), attrs.get('keys'))
+
+            elif parent_tag == 'keyMapSet':
+                self.add_keymap(parent_attrs['id'], attrs)
+
+            elif grandparent_tag == 'keyMapSet':
+                self.add_key(
+                    grandparent_attrs['id'], int(parent_attrs['index']),
+                    attrs)
+
+            elif grandparent_tag == 'actions':
+                self.add_action(parent_attrs.get('id'), attrs)
+
+            elif parent_tag == 'terminators':
+                self.add_terminator(attrs)
+
+            open_elements.append((tag, attrs))
+
+        def end_element(tag):
+            open_elements.pop()
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        for chunk in xml_chunks:
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+
+    def add_modifier(self, keymap, keys):
+        '''
+        Assign the keymap index of a modifier combination (a <modifier>
+        within a <keyMapSelect>) to the matching shift states.
+        '''
+
+        keymap_index = int(keymap)
+        # Keep the highest index assigned to a shift state - thus, the
         # number of shift states in the layout.
-        self.number_of_keymaps = max(keymap_idx_list)
+        self.number_of_keymaps = max(self.number_of_keymaps, keymap_index)
+
+        self.keymap_modifiers.setdefault(keymap_index, []).append(keys)
+        for state in self.classify_modifier(keys):
+            self.keymap_assignments[state] = keymap_index
+
+    def find_unassigned_keymaps(self):
+        '''
+        Report the keymaps which are not assigned to any Windows shift
+        state, and are therefore missing in the .klc file.
+        '''
+
+        assigned = set(self.keymap_assignments.values())
+        self.unassigned_keymaps = [
+            keymap_index for keymap_index in self.keymap_modifiers
+            if keymap_index not in assigned]
+        for keymap_index in self.unassigned_keymaps:
+            report(
+                error_msg_keymap_unassigned.format(
+                    keymap_index,
+                    ', '.join(
+                        repr(keys)
+                        for keys in self.keymap_modifiers[keymap_index])),
+                self.diagnostics, event_unassigned_keymap)
+
+    def add_keymap(self, keymapset_id, attrs):
+        '''
+        Record a <keyMap> element of a <keyMapSet>, and the keymap it
+        inherits from, if any. Return the keymap index.
+        '''
+
+        keymap_index = int(attrs['index'])
+        self.keymaps.setdefault((keymapset_id, keymap_index), {})
+        if attrs.get('baseMapSet') is not None:
+            self.keymap_bases[(keymapset_id, keymap_index)] = (
+                attrs['baseMapSet'],
+                int(attrs.get('baseIndex', keymap_index)))
+        return keymap_index
+
+    def add_key(self, keymapset_id, keymap_index, attrs):
+        '''
+        Record a <key> element of a <keyMap>.
+        '''
+
+        key_code = int(attrs['code'])
+        if attrs.get('action') is None:
+            key_type = 'output'
+        else:
+            key_type = 'action'
+        output = attrs.get(key_type)
+
+        self.key_list.append([
+            keymapset_id, keymap_index,
+            key_code, key_type, output])
+
+    def add_action(self, action_id, attrs):
+        '''
+        Record a <when> element of an <action>.
+        '''
+
+        if attrs.get('next') is None:
+            action_type = 'output'
+        else:
+            action_type = 'next'
+        state = attrs.get('state')
+
+        # result can be a code point or another state
+        result = attrs.get(action_type)
+        action_data = [action_id, state, action_type, result]
+        self.action_list.append(action_data)
+        self.actions_by_id.setdefault(action_id, []).append(action_data)
+        self.actions_by_state.setdefault(state, []).append(action_data)
+
+        if action_type == 'next':
+            self.state_graph.setdefault(state, []).append(result)
+
+        if state == 'none':
+            if action_type == 'output':
+                # Make a dictionary for key id to output.
+                # On the Mac keyboard, the 'a' for example is often
+                # matched to an action, as it can produce
+                # agrave, aacute, etc.
+                self.action_basekeys[action_id] = result
+            else:
+                self.empty_actions.add(action_id)
+
+    def add_terminator(self, attrs):
+        '''
+        Record a <when> element of the <terminators>.
+        '''
+
+        self.terminators[attrs.get('state')] = attrs.get('output')
+
+    def find_reachable_states(self):
+        '''
+        Return the dead key states reachable from state none, through
+        chains of 'next' actions, in the order of discovery. Every state
+        of the graph is visited once.
+        '''
+
+        reachable = {'none': None}
+        queue = collections.deque(['none'])
+        while queue:
+            for next_state in self.state_graph.get(queue.popleft(), []):
+                if next_state not in reachable:
+                    reachable[next_state] = None
+                    queue.append(next_state)
+        del reachable['none']
+        return list(reachable)
 
     def find_deadkeys(self):
         '''
@@ -204,33 +987,46 @@ class KeylayoutParser(object):
         and the code point of an actual dead key.
         (for instance, '3': '02c6' state 3: circumflex)
 
-        Populate list of IDs for 'empty' actions, for finding IDs of all key
-        inputs that have no immediate output.
-        This list is used later when an '@' is appended to the code points,
-        a Windows convention to mark dead keys.
+        The IDs of 'empty' actions (collected while parsing) are the IDs of
+        all key inputs that have no immediate output. They are used later
+        when an '@' is appended to the code points, a Windows convention to
+        mark dead keys.
         '''
 
-        deadkey_id = 0
-        key_list = []
-        for [key_id, state, key_type, result] in self.action_list:
-            if [state, key_type, result] == ['none', 'output', '0020']:
-                deadkey_id = key_id
-            if key_id == deadkey_id and result != '0020':
-                self.deadkeys[state] = result
-
-            if [state, key_type] == ['none', 'next']:
-                key_list.append([key_id, result])
-                self.empty_actions.append(key_id)
-
-        key_list_2 = []
-        for state, result_state in key_list:
-            if result_state in self.deadkeys.keys():
-                cp_result = self.deadkeys[result_state]
-                key_list_2.append((state, cp_result))
+        none_actions = self.actions_by_state.get('none', [])
+
+        # The action which outputs a space in state none (the space bar)
+        # outputs the actual dead keys in all other states.
+        for key_id, state, key_type, result in none_actions:
+            if (key_type, result) == ('output', '0020'):
+                space_actions = dropwhile(
+                    lambda action_data: action_data[1] != 'none',
+                    self.actions_by_id[key_id])
+                for action_data in space_actions:
+                    if action_data[2] == 'output' and (
+                        action_data[3] != '0020'
+                    ):
+                        self.deadkeys[action_data[1]] = action_data[3]
+
+        # Dead key states (including those only reached by chained dead
+        # keys) without a dead key on the space bar fall back to the output
+        # of their terminator.
+        self.reachable_states = self.find_reachable_states()
+        for state in self.reachable_states:
+            if state in self.deadkeys:
+                continue
+            if self.terminators.get(state) is not None:
+                self.deadkeys[state] = self.terminators[state]
+            else:
+                report(
+                    error_msg_deadkey_state.format(state), self.diagnostics,
+                    event_deadkey_state)
 
         # Add the actual deadkeys (grave, acute etc)
         # to the dict action_basekeys
-        self.action_basekeys.update(dict(key_list_2))
+        for key_id, state, key_type, result in none_actions:
+            if key_type == 'next' and result in self.deadkeys:
+                self.action_basekeys[key_id] = self.deadkeys[result]
 
     def match_actions(self):
         '''
@@ -251,10 +1047,10 @@ class KeylayoutParser(object):
 
         for action_data in self.action_list:
             key_id, state, key_type, result = action_data
-            if [state, key_type] == ['none', 'output']:
+            if state == 'none' and key_type == 'output':
                 self.action_basekeys[key_id] = result
 
-            if key_id in self.action_basekeys.keys():
+            if key_id in self.action_basekeys:
                 action_data.append(self.action_basekeys[key_id])
 
     def find_outputs(self):
@@ -283,44 +1079,46 @@ class KeylayoutParser(object):
         Populate self.deadkey_dict, which maps a deadkey
         e.g. (02dc, circumflex) to (base character, accented character) tuples
         e.g. 0041, 00c3 = A, Ã
+        A chained dead key (an action leading from one dead key state to
+        another) results in the next dead key, marked with '@'.
         '''
 
         for action in self.action_list:
-            if action[1] in self.deadkeys.keys():
+            if action[1] in self.deadkeys:
                 action.append(self.deadkeys[action[1]])
 
             if len(action) == 6:
                 deadkey = action[5]
                 basekey = action[4]
                 result = action[3]
+                if action[2] == 'next':
+                    if result not in self.deadkeys:
+                        continue
+                    result = self.deadkeys[result] + '@'
                 if deadkey in self.deadkey_dict:
                     self.deadkey_dict[deadkey].append((basekey, result))
                 else:
                     self.deadkey_dict[deadkey] = [(basekey, result)]
 
+        # Dead keys taken from the terminators have no space bar action;
+        # add it, so the dead key can be typed on its own.
+        for state, deadkey in self.deadkeys.items():
+            if deadkey != self.terminators.get(state):
+                continue
+            base_results = self.deadkey_dict.setdefault(deadkey, [])
+            if not any(basekey == '0020' for basekey, _ in base_results):
+                base_results.append(('0020', deadkey))
+
     def make_output_dict(self):
         '''
-        This script is configured to work for the first keymap set of an
-        XML keyboard layout only.
-        Here, the filtering occurs:
+        Collect the outputs of every key, for each keymap set of the XML
+        keyboard layout; keys inherited from a base keymap (see
+        resolve_keymap) are included. By default, only the first keymap set
+        is converted; self.output_dict and self.output_table refer to it.
         '''
 
-        first_keymapset = self.output_list[0][0]
-        self.output_list = [key_data
-                            for key_data in self.output_list
-                            if key_data[0] == first_keymapset]
-
-        for key_data in self.output_list:
-            keymap_id = key_data[1]
-            key_id = key_data[2]
-
-            # filling the key ID output dict with dummy output
-            li = []
-            for i in range(self.number_of_keymaps + 1):
-                li.append([i, '-1'])
-            self.output_dict[key_id] = dict(li)
-
         for key_data in self.output_list:
+            keymapset_id = key_data[0]
             keymap_id = key_data[1]
             key_id = key_data[2]
 
@@ -330,107 +1128,240 @@ class KeylayoutParser(object):
                 # The @ is marking this key as a deadkey in .klc files.
                 output = key_data[4] + '@'
 
-            self.output_dict[key_id][keymap_id] = output
+            self.keymaps.setdefault(
+                (keymapset_id, keymap_id), {})[key_id] = output
+
+        for keymap in self.keymap_bases:
+            self.resolve_keymap(keymap)
+
+        # {keymap set ID: {keymap index: keys}}
+        keymapsets = {}
+        for (keymapset_id, keymap_id), keys in self.keymaps.items():
+            if keys:
+                keymapsets.setdefault(keymapset_id, {})[keymap_id] = keys
 
-    def get_key_output(self, key_output_dict, state):
+        self.keymapset_ids = list(keymapsets)
+        for keymapset_id in self.keymapset_ids:
+            self.make_keymapset_outputs(keymapset_id, keymapsets)
+        if self.keymapset_ids:
+            self.output_dict = self.output_dicts[self.keymapset_ids[0]]
+
+        self.make_output_table()
+
+    def make_keymapset_outputs(self, keymapset_id, keymapsets, resolving=()):
         '''
-        Used to find output per state, for every key.
-        If no output, return '-1' (a.k.a. not defined).
+        Return the output dict of a keymap set: {key code: {keymap index:
+        output}}. If most keymaps of the set inherit from the same base
+        keymap set, and it has no keys the set lacks, the output dict is a
+        ChainMap of the rows which differ over the output dict of the base
+        (made first); the rows of the base are shared rather than copied.
         '''
 
-        try:
-            output = key_output_dict[self.keymap_assignments[state]]
-        except KeyError:
-            output = '-1'
-        return output
+        if keymapset_id in self.output_dicts:
+            return self.output_dicts[keymapset_id]
+
+        output_dict = {}
+        for keymap_id, keys in keymapsets[keymapset_id].items():
+            for key_id, output in keys.items():
+                if key_id not in output_dict:
+                    # filling the key ID output dict with dummy output
+                    output_dict[key_id] = dict.fromkeys(
+                        range(self.number_of_keymaps + 1), '-1')
+                output_dict[key_id][keymap_id] = output
+
+        base_ids = collections.Counter(
+            base[0] for keymap, base in self.keymap_bases.items()
+            if keymap[0] == keymapset_id and base[0] != keymapset_id)
+        if base_ids:
+            base_id = base_ids.most_common(1)[0][0]
+            resolving += (keymapset_id,)
+            if base_id in keymapsets and base_id not in resolving:
+                base_dict = self.make_keymapset_outputs(
+                    base_id, keymapsets, resolving)
+                if base_dict.keys() <= output_dict.keys():
+                    overrides = {
+                        key_id: key_outputs
+                        for key_id, key_outputs in output_dict.items()
+                        if base_dict.get(key_id) != key_outputs}
+                    output_dict = collections.ChainMap(
+                        overrides, *getattr(base_dict, 'maps', [base_dict]))
+                    self.keymapset_bases[keymapset_id] = base_id
+
+        self.output_dicts[keymapset_id] = output_dict
+        return output_dict
+
+    def resolve_keymap(self, keymap, resolving=()):
+        '''
+        Return the keys of a keymap (a (keymap set ID, keymap index) tuple),
+        including those inherited from its base keymap. The keys of a
+        derived keymap become a ChainMap of its own keys (the overrides) and
+        the maps of its base keymap, so a lookup checks each level of
+        inheritance once. Missing and circular bases are reported once;
+        such keymaps are then marked as resolved with their own keys only.
+        '''
 
-    def get_key_table(self):
-        kt_output = []
-        for win_kc_hex, win_kc_name in sorted(win_keycodes.items()):
-            win_kc_int = int(win_kc_hex, 16)
+        keys = self.keymaps.setdefault(keymap, {})
+        base = self.keymap_bases.get(keymap)
+        if base is None or isinstance(keys, collections.ChainMap):
+            return keys
 
-            if win_kc_int not in win_to_mac_keycodes:
-                print(error_msg_macwin_mismatch.format(
-                    win_kc_int, win_keycodes[win_kc_hex]))
-                continue
+        if base not in self.keymaps:
+            problem = 'does not exist'
+        elif base == keymap or base in resolving:
+            problem = 'inherits from it'
+        else:
+            base_keys = self.resolve_keymap(base, resolving + (keymap,))
+            self.keymaps[keymap] = collections.ChainMap(
+                keys, *getattr(base_keys, 'maps', [base_keys]))
+            return self.keymaps[keymap]
+
+        report(
+            error_msg_keymap_base.format(
+                keymap[1], keymap[0], base[1], base[0], problem),
+            self.diagnostics, event_keymap_base)
+        self.keymaps[keymap] = collections.ChainMap(keys)
+        return self.keymaps[keymap]
+
+    def make_output_table(self):
+        '''
+        Resolve the output dicts to the Windows columns, once, and store the
+        results in dense output tables.
+        '''
 
-            mac_kc = win_to_mac_keycodes[win_kc_int]
-            if mac_kc not in self.output_dict:
-                print(error_msg_winmac_mismatch.format(
-                    win_kc_int, win_keycodes[win_kc_hex], mac_kc))
-                continue
+        column_keymaps = [
+            self.keymap_assignments.get(state)
+            for state in KeyOutputTable.columns]
 
-            outputs = self.output_dict[mac_kc]
-
-            # The key_table follows the syntax of the .klc file.
-            # The columns are as follows:
-
-            # key_table[0]: scan code
-            # key_table[1]: virtual key
-            # key_table[2]: spacer (empty)
-            # key_table[3]: caps (on or off, or SGCaps flag)
-            # key_table[4]: output for default state
-            # key_table[5]: output for shift
-            # key_table[6]: output for ctrl (= cmd on mac)
-            # key_table[7]: output for ctrl-shift (= cmd-caps lock on mac)
-            # key_table[8]: output for altGr (= ctrl-alt)
-            # key_table[9]: output for altGr-shift (= ctrl-alt-shift)
-            # key_table[10]: descriptions.
-
-            key_table = list((win_kc_hex, win_kc_name)) + ([""] * 9)
-
-            default_output = self.get_key_output(outputs, 'default')
-            shift_output = self.get_key_output(outputs, 'shift')
-            alt_output = self.get_key_output(outputs, 'alt')
-            altshift_output = self.get_key_output(outputs, 'altshift')
-            caps_output = self.get_key_output(outputs, 'caps')
-            cmd_output = self.get_key_output(outputs, 'cmd')
-            cmdcaps_output = self.get_key_output(outputs, 'cmdcaps')
-            shiftcaps_output = self.get_key_output(outputs, 'shiftcaps')
-
-            # Check if the caps lock output equals the shift key,
-            # to set the caps lock status.
-            if caps_output == default_output:
-                key_table[3] = '0'
-            elif caps_output == shift_output:
-                key_table[3] = '1'
+        for keymapset_id, output_dict in self.output_dicts.items():
+            base_id = self.keymapset_bases.get(keymapset_id)
+            if base_id is None:
+                output_table = KeyOutputTable(max(output_dict, default=-1) + 1)
             else:
-                # SGCaps is a Windows speciality, it is necessary if the Caps
-                # Lock output is different from the Shift output. Usually, they
-                # accommodate an alternate writing system. Caps Lock + Shift is
-                # considered a separate shift state, boosting the available
-                # shift states to 6.
-                key_table[3] = 'SGCap'
-
-            key_table[4] = default_output
-            key_table[5] = shift_output
-            key_table[6] = cmd_output
-            key_table[7] = cmdcaps_output
-            key_table[8] = alt_output
-            key_table[9] = altshift_output
-            key_table[10] = (
-                f'// {char_description(default_output)}, '
-                f'{char_description(shift_output)}, '
-                f'{char_description(cmd_output)}, '
-                f'{char_description(cmdcaps_output)}, '
-                f'{char_description(alt_output)}, '
-                f'{char_description(altshift_output)}')  # key descriptions
-
-            kt_output.append('\t'.join(key_table))
-
-            if key_table[3] == 'SGCap':
-                print('SGCap character converted: '
-                      'default: {}, shift: {}, '
-                      'caps: {}, shift+caps: {}'.format(
-                          char_description(default_output),
-                          char_description(shift_output),
-                          char_description(caps_output),
-                          char_description(shiftcaps_output)))
-                kt_output.append((
-                    f'-1\t-1\t\t0\t{caps_output}\t'
-                    f'{shiftcaps_output}\t\t\t\t\t'
-                    f'// {char_description(caps_output)}, '
-                    f'{char_description(shiftcaps_output)}'))
+                # only the rows which differ from the base
+                output_table = DerivedKeyOutputTable(
+                    self.output_tables[base_id])
+                output_dict = output_dict.maps[0]
+            for key_id, key_outputs in output_dict.items():
+                output_table.set_row(key_id, [
+                    key_outputs.get(keymap_id, '-1')
+                    for keymap_id in column_keymaps])
+            self.output_tables[keymapset_id] = output_table
+
+        if self.keymapset_ids:
+            self.output_table = self.output_tables[self.keymapset_ids[0]]
+
+    def get_key_table(self, keymapset_id=None, diagnostics=None):
+        '''
+        Key table of the first keymap set, or of the keymap set passed.
+        The events of the keys are reported to diagnostics, if passed
+        (default: self.diagnostics). The gaps of the key code plan are the
+        same for every layout: they are recorded in every Diagnostics
+        object, but printed once per process only (see
+        once_per_process_events).
+        '''
+
+        if keymapset_id is None:
+            output_table = self.output_table
+        else:
+            output_table = self.output_tables[keymapset_id]
+        if diagnostics is None:
+            diagnostics = self.diagnostics
+
+        keycode_plan, keycode_gaps = get_keycode_plan()
+        for message in keycode_gaps:
+            report(message, diagnostics, event_keycode_gap)
+
+        kt_output = []
+        for win_kc_hex, win_kc_name, mac_kc in keycode_plan:
+            kt_output.extend(self.get_key_rows(
+                win_kc_hex, win_kc_name, mac_kc, output_table, diagnostics))
+        return kt_output
+
+    def get_key_rows(
+        self, win_kc_hex, win_kc_name, mac_kc, output_table, diagnostics
+    ):
+        '''
+        Lines of the key table for a single key: none if the key is missing
+        from the output table, two for an SGCaps key. The events of the key
+        are reported to diagnostics.
+        '''
+
+        if mac_kc not in output_table:
+            report(
+                error_msg_winmac_mismatch.format(
+                    int(win_kc_hex, 16), win_kc_name, mac_kc),
+                diagnostics, event_skipped_key, keycode=mac_kc)
+            return []
+
+        # The key_table follows the syntax of the .klc file.
+        # The columns are as follows:
+
+        # key_table[0]: scan code
+        # key_table[1]: virtual key
+        # key_table[2]: spacer (empty)
+        # key_table[3]: caps (on or off, or SGCaps flag)
+        # key_table[4]: output for default state
+        # key_table[5]: output for shift
+        # key_table[6]: output for ctrl (= cmd on mac)
+        # key_table[7]: output for ctrl-shift (= cmd-caps lock on mac)
+        # key_table[8]: output for altGr (= ctrl-alt)
+        # key_table[9]: output for altGr-shift (= ctrl-alt-shift)
+        # key_table[10]: descriptions.
+
+        key_table = list((win_kc_hex, win_kc_name)) + ([""] * 9)
+
+        (
+            default_output, shift_output, cmd_output, cmdcaps_output,
+            alt_output, altshift_output, caps_output, shiftcaps_output
+        ) = output_table.get_row(mac_kc)
+
+        # Check if the caps lock output equals the shift key,
+        # to set the caps lock status.
+        if caps_output == default_output:
+            key_table[3] = '0'
+        elif caps_output == shift_output:
+            key_table[3] = '1'
+        else:
+            # SGCaps is a Windows speciality, it is necessary if the Caps
+            # Lock output is different from the Shift output. Usually, they
+            # accommodate an alternate writing system. Caps Lock + Shift is
+            # considered a separate shift state, boosting the available
+            # shift states to 6.
+            key_table[3] = 'SGCap'
+
+        key_table[4] = default_output
+        key_table[5] = shift_output
+        key_table[6] = cmd_output
+        key_table[7] = cmdcaps_output
+        key_table[8] = alt_output
+        key_table[9] = altshift_output
+        key_table[10] = (
+            f'// {char_description(default_output)}, '
+            f'{char_description(shift_output)}, '
+            f'{char_description(cmd_output)}, '
+            f'{char_description(cmdcaps_output)}, '
+            f'{char_description(alt_output)}, '
+            f'{char_description(altshift_output)}')  # key descriptions
+
+        kt_output = ['\t'.join(key_table)]
+
+        if key_table[3] == 'SGCap':
+            report('SGCap character converted: '
+                   'default: {}, shift: {}, '
+                   'caps: {}, shift+caps: {}'.format(
+                       char_description(default_output),
+                       char_description(shift_output),
+                       char_description(caps_output),
+                       char_description(shiftcaps_output)),
+                   diagnostics, event_sgcap, keycode=mac_kc,
+                   codepoints=(
+                       default_output, shift_output, caps_output,
+                       shiftcaps_output))
+            kt_output.append((
+                f'-1\t-1\t\t0\t{caps_output}\t'
+                f'{shiftcaps_output}\t\t\t\t\t'
+                f'// {char_description(caps_output)}, '
+                f'{char_description(shiftcaps_output)}'))
         return kt_output
 
     def get_deadkey_table(self):
@@ -440,23 +1371,30 @@ class KeylayoutParser(object):
 
         dk_table = ['']
         for cp_dead, base_result_list in self.deadkey_dict.items():
-            # we want the space character to be last in the list,
-            # otherwise MSKLC complains (not sure if consequential)
-            sorted_base_result_list = sorted(
-                base_result_list, key=lambda x: int(x[0], 16), reverse=True)
-            dk_table.extend([''])
-            dk_table.append(f'DEADKEY\t{cp_dead}')
-            dk_table.append('')
-
-            for cp_base, cp_result in sorted_base_result_list:
-                char_base = char_from_hex(cp_base)
-                char_result = char_from_hex(cp_result)
-                line = (
-                    f'{cp_base}\t{cp_result}\t'
-                    f'// {char_base} -> {char_result}')
-                dk_table.append(line)
+            dk_table.extend(self.get_deadkey_block(cp_dead, base_result_list))
         return dk_table
 
+    def get_deadkey_block(self, cp_dead, base_result_list):
+        '''
+        DEADKEY block of a single dead key.
+        '''
+
+        # we want the space character to be last in the list,
+        # otherwise MSKLC complains (not sure if consequential)
+        sorted_base_result_list = sorted(
+            base_result_list, key=lambda x: int(x[0], 16), reverse=True)
+        dk_block = ['', f'DEADKEY\t{cp_dead}', '']
+
+        for cp_base, cp_result in sorted_base_result_list:
+            char_base = char_from_hex(cp_base)
+            # chained dead keys are marked with '@'
+            char_result = char_from_hex(cp_result.rstrip('@'))
+            line = (
+                f'{cp_base}\t{cp_result}\t'
+                f'// {char_base} -> {char_result}')
+            dk_block.append(line)
+        return dk_block
+
     def get_keyname_dead(self):
         '''
         List of dead keys contained in the klc keyboard layout.
@@ -486,7 +1424,7 @@ def read_file(path):
     return data
 
 
-def codepoint_from_char(character):
+def codepoint_from_char(character, diagnostics=None):
     '''
     Return a 4 or 5-digit Unicode hex string for the passed character.
     '''
@@ -502,80 +1440,305 @@ def codepoint_from_char(character):
         # made to insert a placeholder instead.
 
     except TypeError:
-        print(error_msg_conversion.format(
-            character, char_description(replacement_char)))
+        report(
+            error_msg_conversion.format(
+                character, char_description(replacement_char)),
+            diagnostics, event_ligature,
+            codepoints=codepoints_from_chars(character))
         return replacement_char
 
 
-def char_from_hex(hex_string):
+def codepoints_from_chars(characters):
     '''
-    Return character from a Unicode code point.
+    Return the Unicode hex strings of all characters passed.
     '''
 
-    return chr(int(hex_string, 16))
+    return ['{0:04x}'.format(ord(character)) for character in characters]
 
 
-def char_description(hex_string):
+@functools.lru_cache(maxsize=codepoint_cache_size)
+def lookup_codepoint(hex_string):
     '''
-    Return description of characters, e.g. 'DIGIT ONE', 'EXCLAMATION MARK' etc.
+    Return a (character, description) tuple for a Unicode code point.
+    The character is None if hex_string is not a valid code point.
+    Results are memoized, use codepoint_cache_info() to see the statistics.
     '''
-    if hex_string in ['-1', '']:
-        return '<none>'
-    hex_string = hex_string.rstrip('@')
 
     try:
-        return unicodedata.name(char_from_hex(hex_string))
+        character = chr(int(hex_string, 16))
+    except ValueError:
+        return None, 'PUA {}'.format(hex_string)
+
+    try:
+        return character, unicodedata.name(character)
     except ValueError:
-        return 'PUA {}'.format(hex_string)
+        return character, 'PUA {}'.format(hex_string)
 
 
-def filter_xml(input_keylayout):
+def codepoint_cache_info():
     '''
-    Filter xml-based .keylayout file.
-    Unicode entities (&#x0000;) make the ElementTree xml parser choke,
+    Return hits, misses and size of the code point lookup cache.
+    '''
+
+    return lookup_codepoint.cache_info()
+
+
+def char_from_hex(hex_string):
+    '''
+    Return character from a Unicode code point.
+    '''
+
+    character = lookup_codepoint(hex_string)[0]
+    if character is None:
+        raise ValueError(f'invalid code point: {hex_string!r}')
+    return character
+
+
+def char_description(hex_string):
+    '''
+    Return description of characters, e.g. 'DIGIT ONE', 'EXCLAMATION MARK' etc.
+    '''
+    if hex_string in ['-1', '']:
+        return '<none>'
+    return lookup_codepoint(hex_string.rstrip('@'))[1]
+
+
+rx_uni_lig = re.compile(r'((&#x[a-fA-F0-9]{4};){2,})')
+rx_hex_escape = re.compile(r'&#x([a-fA-F0-9]{4,6});')
+rx_output_line = re.compile(r'(output=[\"\'])(.+?)([\"\'])')
+
+# Fixing the first line to make ElementTree not stumble
+# over a capitalized XML tag
+xml_declaration = '<?xml version="1.0" encoding="UTF-8"?>'
+
+
+def filter_xml_line(line, diagnostics=None):
+    '''
+    Filter a single line of a .keylayout file (see filter_xml).
+    '''
+
+    if re.search(rx_output_line, line):
+        if re.search(rx_uni_lig, line):
+            # More than 1 output character.
+            # Not supported, so fill in replacement char instead.
+            lig_characters = re.search(rx_uni_lig, line).group(1)
+            report(
+                error_msg_conversion.format(
+                    lig_characters, char_description(replacement_char)),
+                diagnostics, event_ligature,
+                codepoints=codepoints_from_chars(lig_characters))
+            line = re.sub(rx_uni_lig, replacement_char.lower(), line)
+        elif re.search(rx_hex_escape, line):
+            # Escaped code point, e.g. &#x0020;
+            # Remove everything except the code point.
+            query = re.search(rx_hex_escape, line)
+            codepoint = query.group(1).lower()
+            line = re.sub(rx_hex_escape, codepoint, line)
+        else:
+            # Normal character output.
+            # Replace the character by a code point
+            query = re.search(rx_output_line, line)
+            char_pre = query.group(1)  # output="
+            character = query.group(2)
+            codepoint = codepoint_from_char(character, diagnostics).lower()
+            char_suff = query.group(3)  # "
+            replacement_line = ''.join((char_pre, codepoint, char_suff))
+            line = re.sub(rx_output_line, replacement_line, line)
+
+    return line
+
+
+def filter_xml(input_keylayout, diagnostics=None):
+    '''
+    Filter xml-based .keylayout file.
+    Unicode entities (&#x0000;) make the ElementTree xml parser choke,
     that’s why some replacement operations are necessary.
     Also, all literal output characters are converted to code points
     (0000, ffff, 1ff23 etc) for easier handling downstream.
     '''
 
-    rx_uni_lig = re.compile(r'((&#x[a-fA-F0-9]{4};){2,})')
-    rx_hex_escape = re.compile(r'&#x([a-fA-F0-9]{4,6});')
-    rx_output_line = re.compile(r'(output=[\"\'])(.+?)([\"\'])')
+    filtered_xml = [xml_declaration]
+    for line in read_file(input_keylayout)[1:]:
+        filtered_xml.append(filter_xml_line(line, diagnostics))
 
-    # Fixing the first line to make ElementTree not stumble
-    # over a capitalized XML tag
-    filtered_xml = ['<?xml version="1.0" encoding="UTF-8"?>']
+    return '\n'.join(filtered_xml)
 
-    for line in read_file(input_keylayout)[1:]:
 
-        if re.search(rx_output_line, line):
-            if re.search(rx_uni_lig, line):
-                # More than 1 output character.
-                # Not supported, so fill in replacement char instead.
-                lig_characters = re.search(rx_uni_lig, line).group(1)
-                print(error_msg_conversion.format(
-                    lig_characters, char_description(replacement_char)))
-                line = re.sub(rx_uni_lig, replacement_char.lower(), line)
-            elif re.search(rx_hex_escape, line):
-                # Escaped code point, e.g. &#x0020;
-                # Remove everything except the code point.
-                query = re.search(rx_hex_escape, line)
-                codepoint = query.group(1).lower()
-                line = re.sub(rx_hex_escape, codepoint, line)
+# Combined tokenizer for the prefilter: output attributes and line breaks.
+rx_prefilter = re.compile(rb'''output=(["\'])(.*?)\1|\r\n?''')
+rx_line_break = re.compile(rb'\r\n?|\n')
+rx_char_reference = re.compile(
+    r'&(?:#x([a-fA-F0-9]+)|#([0-9]+)|(amp|lt|gt|quot|apos));')
+rx_single_hex_escape = re.compile(r'&#x([a-fA-F0-9]{4,6});')
+
+xml_entities = {
+    'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+
+def unescape_output(value):
+    '''
+    Resolve character references and predefined entities in the value of
+    an output attribute.
+    '''
+
+    def replace_reference(match):
+        hex_digits, decimal_digits, entity = match.groups()
+        if hex_digits:
+            return chr(int(hex_digits, 16))
+        if decimal_digits:
+            return chr(int(decimal_digits))
+        return xml_entities[entity]
+
+    return rx_char_reference.sub(replace_reference, value)
+
+
+def prefilter_output(value, diagnostics=None):
+    '''
+    Return the code point to be used for the (undecoded) value of an output
+    attribute. Values producing more than one character (ligatures) are
+    not supported, they are replaced by the replacement character.
+    '''
+
+    escape_match = rx_single_hex_escape.fullmatch(value)
+    if escape_match:
+        return escape_match.group(1).lower()
+
+    characters = unescape_output(value)
+    if len(characters) == 1:
+        return codepoint_from_char(characters, diagnostics)
+
+    report(
+        error_msg_conversion.format(
+            value, char_description(replacement_char)),
+        diagnostics, event_ligature,
+        codepoints=codepoints_from_chars(characters))
+    return replacement_char.lower()
+
+
+def iter_prefiltered_xml(buffer, diagnostics=None):
+    '''
+    Single-pass version of filter_xml, working on a bytes-like buffer (e.g.
+    bytes or a memory-mapped file).
+    Yield chunks of the filtered document: unchanged regions as memoryview
+    slices of the buffer (nothing is copied), and the rewritten output
+    attributes and line breaks as bytes. Unlike filter_xml, every output
+    attribute is converted individually, even if several share a line.
+    '''
+
+    # The trailing line break is dropped, as in filter_xml.
+    end = len(buffer)
+    if buffer[end - 1:end] == b'\n':
+        end -= 1
+    if buffer[end - 1:end] == b'\r':
+        end -= 1
+
+    # The first line is replaced with a clean XML declaration.
+    yield xml_declaration.encode('utf-8')
+    first_line_break = rx_line_break.search(buffer, 0, end)
+    if first_line_break is None:
+        return
+    yield from iter_prefiltered_region(
+        buffer, first_line_break.start(), end, diagnostics)
+
+
+def iter_prefiltered_region(buffer, position, end, diagnostics=None):
+    '''
+    Yield the prefiltered chunks of buffer[position:end] (see
+    iter_prefiltered_xml).
+    '''
+
+    view = memoryview(buffer)
+    for match in rx_prefilter.finditer(buffer, position, end):
+        start = match.start()
+        if start > position:
+            yield view[position:start]
+        quote, value = match.groups()
+        if quote is None:
+            # line break
+            yield b'\n'
+        elif value:
+            codepoint = prefilter_output(value.decode('utf-8'), diagnostics)
+            yield b''.join((
+                b'output=', quote, codepoint.encode('ascii'), quote))
+        else:
+            yield view[start:match.end()]
+        position = match.end()
+
+    if end > position:
+        yield view[position:end]
+
+
+def iter_prefiltered_stream(stream, diagnostics=None):
+    '''
+    Version of iter_prefiltered_xml for binary file objects (e.g. members of
+    archives, see ArchiveMember.open): the stream is read and prefiltered
+    in blocks of whole lines, rather than held in memory as a whole. Output
+    attributes never span lines, so the chunks are the same.
+    '''
+
+    yield xml_declaration.encode('utf-8')
+    first_block = True
+    line_break = False
+    while True:
+        block = stream.read(stream_block_size)
+        if not block:
+            return
+        # Complete the last line. Its line break is held back until the
+        # next block, since the trailing line break is dropped.
+        block += stream.readline()
+        end = len(block)
+        if block[end - 1:end] == b'\n':
+            end -= 1
+        if block[end - 1:end] == b'\r':
+            end -= 1
+
+        position = 0
+        if first_block:
+            # The first line is replaced with the XML declaration.
+            first_block = False
+            first_line_break = rx_line_break.search(block, 0, end)
+            if first_line_break is None:
+                position = end
             else:
-                # Normal character output.
-                # Replace the character by a code point
-                query = re.search(rx_output_line, line)
-                char_pre = query.group(1)  # output="
-                character = query.group(2)
-                codepoint = codepoint_from_char(character).lower()
-                char_suff = query.group(3)  # "
-                replacement_line = ''.join((char_pre, codepoint, char_suff))
-                line = re.sub(rx_output_line, replacement_line, line)
-
-        filtered_xml.append(line)
+                position = first_line_break.start()
+        elif line_break:
+            yield b'\n'
+        yield from iter_prefiltered_region(block, position, end, diagnostics)
+        line_break = end < len(block)
 
-    return '\n'.join(filtered_xml)
+
+def prefilter_xml(buffer, diagnostics=None):
+    '''
+    Return the prefiltered document (see iter_prefiltered_xml) as bytes.
+    '''
+
+    return b''.join(iter_prefiltered_xml(buffer, diagnostics))
+
+
+def iter_prefiltered_keylayout(input_keylayout, diagnostics=None):
+    '''
+    Memory-map a .keylayout file, and yield its prefiltered chunks.
+    Chunks are only valid until the next chunk is requested.
+    Members of archives (see ArchiveMember) are streamed from the archive
+    instead (see iter_prefiltered_stream).
+    '''
+
+    if isinstance(input_keylayout, ArchiveMember):
+        with input_keylayout.open() as f:
+            yield from iter_prefiltered_stream(f, diagnostics)
+        return
+
+    with open(input_keylayout, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield from iter_prefiltered_xml(b'', diagnostics)
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for chunk in iter_prefiltered_xml(buffer, diagnostics):
+                yield chunk
+                if isinstance(chunk, memoryview):
+                    # release the view, so the mapping can be closed
+                    chunk.release()
 
 
 def make_klc_filename(keyboard_name):
@@ -611,110 +1774,1664 @@ def make_klc_filename(keyboard_name):
     return filename
 
 
-def process_input_keylayout(input_keylayout):
-    filtered_xml = filter_xml(input_keylayout)
-    tree = ET.XML(filtered_xml)
-    keyboard_data = KeylayoutParser(tree)
+def process_input_keylayout(
+    input_keylayout, streaming=True, profile=None, diagnostics=None
+):
+    '''
+    Parse a .keylayout file. By default, the file is memory-mapped,
+    prefiltered, and streamed into an event-driven parser (the prefilter
+    is timed as part of the parse_stream stage); with streaming=False, an
+    ElementTree of the whole document is built and walked instead.
+    Members of archives (see ArchiveMember) are streamed from the archive,
+    rather than memory-mapped. Intermediate representation files (see
+    write_ir) are loaded without any XML parsing.
+    '''
+
+    if is_ir_file(input_keylayout):
+        return read_ir(input_keylayout, profile, diagnostics)
+
+    if streaming:
+        xml_chunks = iter_prefiltered_keylayout(input_keylayout, diagnostics)
+        return KeylayoutParser(
+            xml_chunks=xml_chunks, profile=profile, diagnostics=diagnostics)
+
+    import xml.etree.ElementTree as ET
+
+    if profile is None:
+        profile = disabled_profile
+    with profile.stage('filter_xml'):
+        if isinstance(input_keylayout, ArchiveMember):
+            filtered_xml = prefilter_xml(input_keylayout.read(), diagnostics)
+        else:
+            filtered_xml = filter_xml(input_keylayout, diagnostics)
+    with profile.stage('ET.XML'):
+        tree = ET.XML(filtered_xml)
+    keyboard_data = KeylayoutParser(
+        tree, profile=profile, diagnostics=diagnostics)
     return keyboard_data
 
 
+def write_ir(keyboard_data, path):
+    '''
+    Write the intermediate representation of a parsed layout (see
+    KeylayoutParser.as_ir) to a compact JSON file, atomically (see
+    write_klc).
+    '''
+
+    import json
+
+    write_klc(json.dumps(
+        keyboard_data.as_ir(), ensure_ascii=False,
+        separators=(',', ':')).encode('utf-8'), path)
+
+
+def read_ir(path, profile=None, diagnostics=None):
+    '''
+    Load an intermediate representation file (see write_ir). Return a
+    KeylayoutParser, ready for rendering; raise ValueError if the file is
+    not valid, or of another version.
+    '''
+
+    import json
+
+    try:
+        with open(path, 'rb') as f:
+            ir = json.loads(f.read())
+        return KeylayoutParser(
+            ir=ir, profile=profile, diagnostics=diagnostics)
+    except (
+        OSError, UnicodeDecodeError, json.JSONDecodeError, ValueError,
+        KeyError, TypeError
+    ) as e:
+        raise ValueError(error_msg_ir_file.format(path, e))
+
+
+def scan_keymapset_ids(input_keylayout):
+    '''
+    Return the IDs of the keymap sets of a .keylayout file which are
+    converted (see KeylayoutParser.keymapset_ids): those with keys of
+    their own, or inherited from a base keymap. Only the keyMapSet elements
+    are looked at, which is much cheaper than a parse of the whole layout.
+    Intermediate representation files (see write_ir) list their IDs.
+    '''
+
+    if is_ir_file(input_keylayout):
+        import json
+
+        with open(input_keylayout, 'rb') as f:
+            return json.loads(f.read())['keymapset_ids']
+
+    # {(keymap set ID, keymap index): has keys}
+    keymaps = {}
+    # {(keymap set ID, keymap index): (base keymap set ID, base index)}
+    keymap_bases = {}
+    open_elements = [(None, {}), (None, {})]
+
+    def start_element(tag, attrs):
+        parent_tag, parent_attrs = open_elements[-1]
+        grandparent_tag, grandparent_attrs = open_elements[-2]
+        if parent_tag == 'keyMapSet':
+            keymap = (parent_attrs['id'], int(attrs['index']))
+            keymaps.setdefault(keymap, False)
+            if attrs.get('baseMapSet') is not None:
+                keymap_bases[keymap] = (
+                    attrs['baseMapSet'],
+                    int(attrs.get('baseIndex', keymap[1])))
+        elif grandparent_tag == 'keyMapSet':
+            keymaps[
+                (grandparent_attrs['id'], int(parent_attrs['index']))] = True
+        open_elements.append((tag, attrs))
+
+    def end_element(tag):
+        open_elements.pop()
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    for chunk in iter_prefiltered_keylayout(input_keylayout):
+        parser.Parse(chunk, False)
+    parser.Parse(b'', True)
+
+    def has_keys(keymap, resolving=()):
+        # as in KeylayoutParser.resolve_keymap
+        if keymaps.get(keymap):
+            return True
+        base = keymap_bases.get(keymap)
+        if base not in keymaps or base == keymap or base in resolving:
+            return False
+        return has_keys(base, resolving + (keymap,))
+
+    keymapset_ids = []
+    for keymap in keymaps:
+        if keymap[0] not in keymapset_ids and has_keys(keymap):
+            keymapset_ids.append(keymap[0])
+    return keymapset_ids
+
+
+def is_ir_file(path):
+    return isinstance(path, str) and path.lower().endswith(ir_suffix)
+
+
 def make_keyboard_name(input_path):
     '''
     Return the base name of the .keylayout file
     '''
+    if isinstance(input_path, ArchiveMember):
+        input_path = input_path.member
     input_file = os.path.basename(input_path)
+    if is_ir_file(input_file):
+        return input_file[:-len(ir_suffix)]
     return os.path.splitext(input_file)[0]
 
 
+def get_input_dir(input_file):
+    '''
+    Return the directory of an input file, or of the archive or .bundle
+    containing it (so nothing is written into a bundle).
+    '''
+    if isinstance(input_file, ArchiveMember):
+        input_file = input_file.archive
+    input_dir = os.path.dirname(input_file)
+
+    parent_dir = input_dir
+    while parent_dir and parent_dir != os.path.dirname(parent_dir):
+        if parent_dir.rstrip('/' + os.sep).lower().endswith('.bundle'):
+            return os.path.dirname(parent_dir.rstrip('/' + os.sep))
+        parent_dir = os.path.dirname(parent_dir)
+    return input_dir
+
+
+def is_archive(path):
+    return path.lower().endswith(archive_suffixes)
+
+
+def is_keylayout_source(path):
+    '''
+    Check if a path is a source of .keylayout files, rather than a single
+    file: a .bundle directory, or a zip or tar archive.
+    '''
+    if os.path.isdir(path):
+        return path.rstrip('/' + os.sep).lower().endswith('.bundle')
+    return is_archive(path)
+
+
 def verify_input_file(parser, input_file):
     '''
     Check if the input file exists, and if the suffix is .keylayout
+    (.bundle directories, zip and tar archives, and intermediate
+    representation files are accepted too)
 
     https://stackoverflow.com/a/15203955
     '''
     if not os.path.exists(input_file):
         parser.error('This input file does not exist')
 
+    if is_keylayout_source(input_file) or is_ir_file(input_file):
+        return input_file
+
     suffix = os.path.splitext(input_file)[-1]
 
     if suffix.lower() != '.keylayout':
-        parser.error('Please use a xml-based .keylayout file')
+        parser.error(
+            'Please use a xml-based .keylayout file, a .bundle, '
+            'or a zip or tar archive')
     return input_file
 
 
-def make_klc_prologue(keyboard_name):
+class ArchiveMember(
+    collections.namedtuple('ArchiveMember', ['archive', 'member'])
+):
+    '''
+    A .keylayout file within a zip or tar archive, which is read from the
+    archive without extracting it. Can be passed (and pickled for worker
+    processes) wherever the path of an input file is expected.
+    '''
+
+    __slots__ = ()
+
+    def __str__(self):
+        return os.path.join(self.archive, self.member)
+
+    def open(self):
+        '''
+        Return a binary file object reading the member from the archive.
+        '''
+        archive = open_archive(self.archive)
+        if hasattr(archive, 'extractfile'):
+            return archive.extractfile(archive.member_infos[self.member])
+        return archive.open(self.member)
+
+    def read(self):
+        '''
+        Return the content of the member, as bytes.
+        '''
+        with self.open() as f:
+            return f.read()
+
+    def offset(self):
+        '''
+        Return the position of the member in the archive.
+        '''
+        archive = open_archive(self.archive)
+        if hasattr(archive, 'extractfile'):
+            return archive.member_infos[self.member].offset
+        return archive.getinfo(self.member).header_offset
+
+
+def get_file_signature(path):
+    '''
+    Return (modification time, size) of a file.
+    '''
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def open_archive(path):
+    '''
+    Open a zip or tar archive for reading. Open archives are reused, so the
+    index of an archive is only read once for all of its members; a
+    changed archive (see get_file_signature) is opened again.
+    Every process opens its own archives: worker processes forked from a
+    process which opened an archive would otherwise share the position of
+    its file, and read each other's members.
+    '''
+    return open_archive_file(path, get_file_signature(path), os.getpid())
+
+
+@functools.lru_cache(maxsize=open_archive_cache_size)
+def open_archive_file(path, signature, pid):
+    '''
+    Open a zip or tar archive (see open_archive).
+    '''
+    if path.lower().endswith('.zip'):
+        import zipfile
+        return zipfile.ZipFile(path)
+
+    import tarfile
+    archive = tarfile.open(path)
+    # {name: TarInfo}, since TarFile.getmember searches all members
+    archive.member_infos = {
+        info.name: info for info in archive.getmembers()}
+    return archive
+
+
+def list_archive_members(path):
+    '''
+    Return the .keylayout files of a zip or tar archive, as ArchiveMember
+    objects. Resource forks stored by macOS (__MACOSX/, ._*) are skipped.
+    '''
+    archive = open_archive(path)
+    if hasattr(archive, 'getmembers'):
+        names = [info.name for info in archive.getmembers() if info.isfile()]
+    else:
+        names = [
+            info.filename for info in archive.infolist() if not info.is_dir()]
+
+    members = []
+    for name in names:
+        if '__MACOSX/' in name or name.rpartition('/')[2].startswith('._'):
+            continue
+        if name.lower().endswith('.keylayout'):
+            members.append(ArchiveMember(path, name))
+    return members
 
-    # company = 'Adobe Systems Incorporated'
-    company = 'myCompany'
+
+def sort_for_reading(input_files):
+    '''
+    Return input files in the order in which they are best read: members of
+    an archive by their position in it, so every process reads an archive
+    front to back (seeking backwards in a compressed tar archive means
+    decompressing it again from the start).
+    '''
+
+    def read_position(input_file):
+        if isinstance(input_file, ArchiveMember):
+            return input_file.archive, input_file.offset()
+        return str(input_file), 0
+
+    return sorted(input_files, key=read_position)
+
+
+def read_input_file(input_file):
+    '''
+    Return the content of an input file (a path, or an ArchiveMember).
+    '''
+    if isinstance(input_file, ArchiveMember):
+        return input_file.read()
+    with open(input_file, 'rb') as f:
+        return f.read()
+
+
+def collect_input_files(sources):
+    '''
+    Expand a list of batch sources into a sorted list of .keylayout files
+    (archive members in the order of the archive, see sort_for_reading).
+    A source can be a directory (searched recursively, which includes the
+    Contents/Resources of .bundle directories), a glob pattern, a single
+    .keylayout file, a zip or tar archive (its .keylayout members are
+    returned as ArchiveMember objects), or a manifest file listing one
+    source per line. Intermediate representation files (see write_ir) are
+    only included if listed explicitly.
+    Blank lines and lines starting with # are ignored in manifest files;
+    relative paths are resolved against the directory of the manifest.
+    '''
+
+    import glob
+
+    input_files = set()
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                for file_name in files:
+                    if file_name.lower().endswith('.keylayout'):
+                        input_files.add(os.path.join(root, file_name))
+
+        elif os.path.isfile(source):
+            if source.lower().endswith('.keylayout') or is_ir_file(source):
+                input_files.add(source)
+            elif is_archive(source):
+                input_files.update(list_archive_members(source))
+            else:
+                # manifest file
+                manifest_dir = os.path.dirname(source)
+                manifest_sources = []
+                for line in read_file(source):
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        manifest_sources.append(
+                            os.path.join(manifest_dir, line))
+                input_files.update(collect_input_files(manifest_sources))
+
+        else:
+            for path in glob.glob(source, recursive=True):
+                if path.lower().endswith('.keylayout'):
+                    input_files.add(path)
+                elif is_keylayout_source(path):
+                    input_files.update(collect_input_files([path]))
+
+    return sort_for_reading(input_files)
+
+
+def make_klc_prologue(keyboard_name, locale=None, company=None):
+    if locale is None:
+        locale = default_locale
+    if company is None:
+        company = default_company
     year = time.localtime()[0]
 
-    return klc_prologue_dummy.format(
-        keyboard_name, keyboard_description, year, company, company,
-        language_tag, language_id)
+    return load_klc_data().klc_prologue_dummy.format(
+        keyboard_name, locale.keyboard_description, year, company, company,
+        locale.language_tag, locale.language_id)
+
+
+def make_klc_epilogue(locale=None):
+    if locale is None:
+        locale = default_locale
 
+    return load_klc_data().klc_epilogue_dummy.format(
+        locale.keyboard_description, locale.language_name)
 
-def make_klc_epilogue():
 
-    return klc_epilogue_dummy.format(
-        keyboard_description, language_name)
+def make_klc_body(keyboard_data, profile=None, keymapset_id=None):
+    '''
+    Return the locale-independent lines of the .klc file (key table, dead
+    key tables and key names), for a keymap set of the keyboard layout
+    (default: the first keymap set).
+    '''
+
+    if profile is None:
+        profile = disabled_profile
+
+    klc_body = []
+    with profile.stage('render_key_table'):
+        klc_body.extend(keyboard_data.get_key_table(keymapset_id))
+    with profile.stage('render_deadkey_table'):
+        klc_body.extend(keyboard_data.get_deadkey_table())
+    klc_body.extend(load_klc_data().klc_keynames)
+    with profile.stage('render_keyname_dead'):
+        klc_body.extend(keyboard_data.get_keyname_dead())
+    return klc_body
 
 
-def make_klc_data(keyboard_name, keyboard_data):
-    klc_prologue = make_klc_prologue(keyboard_name)
-    klc_epilogue = make_klc_epilogue()
+def make_klc_data(
+    keyboard_name, keyboard_data, profile=None, locale=None, company=None,
+    keymapset_id=None, klc_body=None
+):
+    '''
+    Return the lines of the .klc file for a keymap set of the keyboard
+    layout (default: the first keymap set).
+    A klc_body rendered before (see make_klc_body) can be passed, so only
+    the prologue and epilogue are rendered.
+    '''
+
+    if profile is None:
+        profile = disabled_profile
 
     klc_data = []
-    klc_data.extend(klc_prologue.splitlines())
-    klc_data.extend(keyboard_data.get_key_table())
-    klc_data.extend(keyboard_data.get_deadkey_table())
-    klc_data.extend(klc_keynames)
-    klc_data.extend(keyboard_data.get_keyname_dead())
-    klc_data.extend(klc_epilogue.splitlines())
+    with profile.stage('render_prologue'):
+        klc_data.extend(make_klc_prologue(
+            keyboard_name, locale, company).splitlines())
+    if klc_body is None:
+        klc_body = make_klc_body(keyboard_data, profile, keymapset_id)
+    klc_data.extend(klc_body)
+    with profile.stage('render_epilogue'):
+        klc_data.extend(make_klc_epilogue(locale).splitlines())
     return klc_data
 
 
+def make_klc_variants(
+    keyboard_name, keyboard_data, locales=None, all_keymapsets=False,
+    company=None, profile=None
+):
+    '''
+    Render several .klc files from a single parse of a keyboard layout: one
+    for each requested locale (default: the default locale), of the first
+    keymap set, or of all keymap sets (see make_keymapset_names).
+    The locale-independent body is rendered once per keymap set; only the
+    prologue and epilogue are rendered for every locale.
+    Return a list of (locale, keymap set ID, keyboard name, klc lines)
+    tuples.
+    '''
+
+    keymapsets = make_keymapset_names(
+        keyboard_name, keyboard_data.keymapset_ids)
+    if not all_keymapsets:
+        keymapsets = keymapsets[:1]
+
+    klc_variants = []
+    for keymapset_id, keymapset_name in keymapsets:
+        klc_body = make_klc_body(keyboard_data, profile, keymapset_id)
+        for locale in locales or [None]:
+            klc_variants.append((
+                locale, keymapset_id, keymapset_name, make_klc_data(
+                    keymapset_name, keyboard_data, profile, locale, company,
+                    keymapset_id, klc_body)))
+    return klc_variants
+
+
+def load_locale_profiles(locale_file):
+    '''
+    Read locale profiles from a JSON file, of the form
+
+        {"de-CH": {"language_id": "0807", "language_name": "German (CH)",
+                   "keyboard_description": "Swiss German (Mac)"}}
+
+    The language tag defaults to the key of the profile.
+    Return a dict {language tag: Locale}; raise ValueError if the file is
+    not valid.
+    '''
+
+    import json
+
+    try:
+        with open(locale_file, 'r', encoding='utf-8') as f:
+            profiles = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(error_msg_locale_file.format(locale_file, e))
+    if not isinstance(profiles, dict):
+        raise ValueError(error_msg_locale_file.format(
+            locale_file, 'expected an object of locale profiles'))
+
+    locales = {}
+    for tag, fields in profiles.items():
+        try:
+            fields = dict(fields, language_tag=fields.get('language_tag', tag))
+            locales[tag] = Locale(**fields)
+        except (AttributeError, TypeError) as e:
+            raise ValueError(error_msg_locale_file.format(
+                locale_file, f'locale {tag}: {e}'))
+    return locales
+
+
+def resolve_locales(tags, locale_file=None):
+    '''
+    Return the list of Locales for the language tags passed, looked up in
+    the built-in locale profiles and the profiles of the locale file (which
+    take precedence). Raise ValueError for unknown tags.
+    '''
+
+    registry = dict(builtin_locales)
+    if locale_file:
+        registry.update(load_locale_profiles(locale_file))
+
+    locales = []
+    for tag in tags:
+        if tag not in registry:
+            raise ValueError(error_msg_locale_unknown.format(
+                tag, ', '.join(sorted(registry))))
+        locales.append(registry[tag])
+    return locales
+
+
+def make_keymapset_names(keyboard_name, keymapset_ids):
+    '''
+    Return a list of (keymap set ID, keyboard name) tuples, one for each
+    keymap set of the keyboard layout (see KeylayoutParser.keymapset_ids).
+    The first keymap set keeps the keyboard name, the others get their
+    index appended, e.g. 'special_1'.
+    '''
+
+    return [
+        (keymapset_id, f'{keyboard_name}_{index}' if index else keyboard_name)
+        for index, keymapset_id in enumerate(keymapset_ids)]
+
+
+def encode_klc(klc_data):
+    '''
+    Return the lines of a .klc file as UTF-16 bytes (with BOM), with
+    Windows-style line breaks.
+    '''
+
+    return klc_bom + encode_klc_lines(klc_data)
+
+
+def encode_klc_lines(lines):
+    '''
+    Return lines as UTF-16 (little-endian, without BOM) bytes, with
+    Windows-style line breaks. Encoded sections can be concatenated.
+    '''
+
+    return ''.join(line + '\r\n' for line in lines).encode('utf-16-le')
+
+
+@functools.lru_cache(maxsize=None)
+def get_klc_keynames_bytes():
+    '''
+    The static key name sections of the .klc file (see data/klc_data.py),
+    encoded once.
+    '''
+
+    return encode_klc_lines(load_klc_data().klc_keynames)
+
+
+class KlcRenderer(object):
+    '''
+    Render the .klc file of a keyboard layout section by section, straight
+    to UTF-16 bytes. Every section (prologue, the lines of every key, the
+    block of every dead key, dead key names, epilogue) is fingerprinted by
+    its inputs, and only rendered again if they changed since the previous
+    render; the static key names are spliced in pre-encoded.
+    Keep one renderer per layout (and keymap set) which is converted
+    repeatedly, e.g. in watch mode.
+    '''
+
+    def __init__(self):
+        # {section name: (fingerprint, UTF-16 bytes)}
+        self.sections = {}
+
+        # {scan code: (fingerprint, UTF-16 bytes, events)}
+        self.key_rows = {}
+
+        # {dead key: (fingerprint, UTF-16 bytes)}
+        self.deadkey_blocks = {}
+
+        # events of the key table in the last render, including those of
+        # reused keys
+        self.key_table_events = []
+
+        # names of the sections rendered by the last call of render
+        self.rendered = []
+
+    def render(
+        self, keyboard_name, keyboard_data, profile=None, locale=None,
+        company=None, keymapset_id=None
+    ):
+        '''
+        Return the .klc file as UTF-16 bytes (with BOM, see encode_klc), for
+        a keymap set of the keyboard layout (default: the first keymap set).
+        '''
+
+        if profile is None:
+            profile = disabled_profile
+        if locale is None:
+            locale = default_locale
+        if company is None:
+            company = default_company
+
+        self.rendered = []
+        klc_sections = [klc_bom]
+        with profile.stage('render_prologue'):
+            klc_sections.append(self.render_section(
+                'prologue',
+                (keyboard_name, locale, company, time.localtime()[0]),
+                lambda: make_klc_prologue(
+                    keyboard_name, locale, company).splitlines()))
+        with profile.stage('render_key_table'):
+            klc_sections.append(
+                self.render_key_table(keyboard_data, keymapset_id))
+        with profile.stage('render_deadkey_table'):
+            klc_sections.append(self.render_deadkey_table(keyboard_data))
+        klc_sections.append(get_klc_keynames_bytes())
+        with profile.stage('render_keyname_dead'):
+            klc_sections.append(self.render_section(
+                'keyname_dead', tuple(keyboard_data.deadkeys.values()),
+                keyboard_data.get_keyname_dead))
+        with profile.stage('render_epilogue'):
+            klc_sections.append(self.render_section(
+                'epilogue', locale,
+                lambda: make_klc_epilogue(locale).splitlines()))
+        return b''.join(klc_sections)
+
+    def render_section(self, name, fingerprint, make_lines):
+        '''
+        Return the encoded lines of a section, rendered by make_lines unless
+        the fingerprint equals the one of the previous render.
+        '''
+
+        section = self.sections.get(name)
+        if section is None or section[0] != fingerprint:
+            section = (fingerprint, encode_klc_lines(make_lines()))
+            self.sections[name] = section
+            self.rendered.append(name)
+        return section[1]
+
+    def render_key_table(self, keyboard_data, keymapset_id=None):
+        '''
+        Return the encoded key table. Every key is fingerprinted by its row
+        of the output table, so editing a key only renders its own lines
+        again. The diagnostic events of reused keys are reported again.
+        '''
+
+        if keymapset_id is None:
+            output_table = keyboard_data.output_table
+        else:
+            output_table = keyboard_data.output_tables[keymapset_id]
+
+        keycode_plan, keycode_gaps = get_keycode_plan()
+        recorder = Diagnostics()
+        for message in keycode_gaps:
+            report(message, recorder, event_keycode_gap)
+        key_table_events = recorder.events
+
+        key_rows = {}
+        klc_sections = []
+        for win_kc_hex, win_kc_name, mac_kc in keycode_plan:
+            if mac_kc in output_table:
+                fingerprint = tuple(output_table.get_row(mac_kc))
+            else:
+                fingerprint = None
+            key_row = self.key_rows.get(win_kc_hex)
+            if key_row is None or key_row[0] != fingerprint:
+                recorder = Diagnostics()
+                lines = keyboard_data.get_key_rows(
+                    win_kc_hex, win_kc_name, mac_kc, output_table, recorder)
+                key_row = (
+                    fingerprint, encode_klc_lines(lines), recorder.events)
+                self.rendered.append(f'KEY {win_kc_hex}')
+            key_rows[win_kc_hex] = key_row
+            klc_sections.append(key_row[1])
+            key_table_events.extend(key_row[2])
+        self.key_rows = key_rows
+        self.key_table_events = key_table_events
+
+        diagnostics = keyboard_data.diagnostics
+        for event in key_table_events:
+            report(
+                event.message, diagnostics, event.kind,
+                keycode=event.keycode, codepoints=event.codepoints)
+        return b''.join(klc_sections)
+
+    def render_deadkey_table(self, keyboard_data):
+        '''
+        Return the encoded dead key table. Every DEADKEY block is
+        fingerprinted separately, so editing a dead key only renders its
+        own block again.
+        '''
+
+        deadkey_blocks = {}
+        klc_sections = [encode_klc_lines([''])]
+        for cp_dead, base_result_list in keyboard_data.deadkey_dict.items():
+            fingerprint = tuple(base_result_list)
+            block = self.deadkey_blocks.get(cp_dead)
+            if block is None or block[0] != fingerprint:
+                block = (fingerprint, encode_klc_lines(
+                    keyboard_data.get_deadkey_block(
+                        cp_dead, base_result_list)))
+                self.rendered.append(f'DEADKEY {cp_dead}')
+            deadkey_blocks[cp_dead] = block
+            klc_sections.append(block[1])
+        self.deadkey_blocks = deadkey_blocks
+        return b''.join(klc_sections)
+
+
+def write_klc(klc_bytes, output):
+    '''
+    Write an encoded .klc file (see encode_klc) in one go, either to a
+    binary file object (e.g. sys.stdout.buffer), or to a path.
+    A path is replaced atomically: the data is written to a temporary file
+    next to it first, so an interrupted conversion never leaves a partial
+    .klc file behind.
+    '''
+
+    if hasattr(output, 'write'):
+        output.write(klc_bytes)
+        output.flush()
+        return
+
+    temp_path = f'{output}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(klc_bytes)
+        os.replace(temp_path, output)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def convert_keylayout_data(
+    keylayout, keyboard_name, locale=None, company=None, profile=None
+):
+    '''
+    Convert a keyboard layout in memory, without any file system access or
+    printed output.
+
+    keylayout: the .keylayout XML, as bytes, str or a binary or text
+        file-like object
+    keyboard_name: name of the keyboard (used in the KBD line of the .klc)
+    locale: a Locale (default: the locale in data/locale_data.py)
+    company: company name for the COPYRIGHT and COMPANY lines
+    profile: optional ConversionProfile
+
+    Return a tuple (klc_bytes, diagnostics): the encoded UTF-16 .klc file,
+    and a Diagnostics object holding all messages of the conversion.
+    '''
+
+    if hasattr(keylayout, 'read'):
+        keylayout = keylayout.read()
+    if isinstance(keylayout, str):
+        keylayout = keylayout.encode('utf-8')
+
+    diagnostics = Diagnostics()
+    keyboard_data = KeylayoutParser(
+        xml_chunks=iter_prefiltered_xml(keylayout, diagnostics),
+        profile=profile, diagnostics=diagnostics)
+    klc_bytes = KlcRenderer().render(
+        keyboard_name, keyboard_data, profile, locale, company)
+    return klc_bytes, diagnostics
+
+
+class KlcCache(object):
+    '''
+    Content-addressed on-disk cache of converted .klc files.
+    The key of a cache entry is a hash of everything that influences the
+    conversion: the input bytes, the keyboard name, the locale data, the
+    klc data tables, the current year (which ends up in the copyright line)
+    and the converter itself. The diagnostic events of the conversion are
+    stored along with the .klc file, and reported again on a cache hit.
+    Least recently used entries are evicted once the cache grows beyond
+    max_size bytes; with max_size=None, entries are only evicted by an
+    explicit call of prune.
+    '''
+
+    suffix = '.klc'
+    events_suffix = '.events.json'
+
+    def __init__(self, cache_dir, max_size=default_cache_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # running total of the size of the entries, counted by the first
+        # put and updated by every put and prune
+        self.size = None
+
+    def make_key(self, input_bytes, keyboard_name):
+        '''
+        Return the cache key for an input file.
+        '''
+
+        import hashlib
+
+        key_hash = hashlib.sha256(get_converter_fingerprint().encode('utf-8'))
+        key_hash.update(repr((keyboard_name, time.localtime()[0])).encode(
+            'utf-8'))
+        key_hash.update(input_bytes)
+        return key_hash.hexdigest()
+
+    def make_path(self, key, suffix=None):
+        if suffix is None:
+            suffix = self.suffix
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, key):
+        '''
+        Return the cached .klc bytes for a key, or None.
+        '''
+
+        path = self.make_path(key)
+        try:
+            with open(path, 'rb') as f:
+                klc_bytes = f.read()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return klc_bytes
+
+    def get_events(self, key):
+        '''
+        Return the diagnostic events stored for a key, as a list of
+        (kind, message, keycode, codepoints) tuples.
+        '''
+
+        import json
+
+        try:
+            with open(self.make_path(key, self.events_suffix)) as f:
+                events = json.load(f)
+        except FileNotFoundError:
+            return []
+        return [
+            (kind, message, keycode, tuple(codepoints))
+            for kind, message, keycode, codepoints in events]
+
+    def write_file(self, path, data):
+        '''
+        Replace a file of the cache atomically.
+        '''
+
+        import tempfile
+
+        with tempfile.NamedTemporaryFile(
+            dir=self.cache_dir, suffix='.tmp', delete=False
+        ) as temp_file:
+            temp_file.write(data)
+        os.replace(temp_file.name, path)
+
+    def put(self, key, klc_bytes, events=()):
+        '''
+        Store .klc bytes in the cache, along with the diagnostic events of
+        the conversion (DiagnosticEvent objects), and evict old entries if
+        the cache grew beyond its size limit.
+        '''
+
+        import json
+
+        added_size = len(klc_bytes)
+        events_path = self.make_path(key, self.events_suffix)
+        if events:
+            events_bytes = json.dumps([
+                [event.kind, event.message, event.keycode, event.codepoints]
+                for event in events], ensure_ascii=False).encode('utf-8')
+            # written first, so a cache hit always finds its events
+            self.write_file(events_path, events_bytes)
+            added_size += len(events_bytes)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(events_path)
+        self.write_file(self.make_path(key), klc_bytes)
+
+        if self.max_size is None:
+            return
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.list_entries())
+        else:
+            self.size += added_size
+        if self.size > self.max_size:
+            self.prune()
+
+    def list_entries(self):
+        '''
+        Return a list of (modification time, size, paths) tuples, one for
+        each entry of the cache; the size and paths include the events.
+        '''
+
+        entries = {}
+        with os.scandir(self.cache_dir) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.endswith(self.events_suffix):
+                    key = entry.name[:-len(self.events_suffix)]
+                elif entry.name.endswith(self.suffix):
+                    key = entry.name[:-len(self.suffix)]
+                else:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                cache_entry = entries.setdefault(key, [0, 0, []])
+                if entry.name.endswith(self.suffix):
+                    # the .klc file is marked as recently used (see get)
+                    cache_entry[0] = stat.st_mtime
+                cache_entry[1] += stat.st_size
+                cache_entry[2].append(entry.path)
+        return [tuple(cache_entry) for cache_entry in entries.values()]
+
+    def prune(self, max_size=None):
+        '''
+        Evict least recently used entries until the cache is no larger than
+        max_size bytes (default: the size limit of the cache, if any).
+        Return the number of evicted entries.
+        '''
+
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+
+        entries = self.list_entries()
+        total_size = sum(size for mtime, size, paths in entries)
+        evicted = 0
+        for mtime, size, paths in sorted(entries):
+            if total_size <= max_size:
+                break
+            for path in paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            total_size -= size
+            evicted += 1
+        self.size = total_size
+        return evicted
+
+
+@functools.lru_cache(maxsize=None)
+def get_converter_fingerprint():
+    '''
+    Return a string identifying the converter and its data: the version,
+    the hash of this script, the klc data tables and the locale data.
+    '''
+
+    import hashlib
+
+    with open(__file__, 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+
+    data_tables = [
+        (name, value)
+        for module in (load_klc_data(), locale_data)
+        for name, value in sorted(vars(module).items())
+        if not name.startswith('_')]
+
+    return repr((__version__, source_hash, data_tables))
+
+
+class KeylayoutWatcher(object):
+    '''
+    Poll batch sources (see collect_input_files) for .keylayout files which
+    changed since their last conversion, and convert them again.
+    A file is only converted once it has not changed for the debounce time,
+    so several saves in a row trigger a single conversion. Files whose
+    modification time changed, but whose content did not, are skipped.
+    A KlcRenderer is kept for every file, so only the changed sections of
+    its .klc file are rendered again.
+    With profile=True, a .profile.json file is written for every conversion.
+    Further keyword arguments are passed on to convert_keylayout.
+    '''
+
+    def __init__(
+        self, sources, output_dir=None, cache=None, debounce=watch_debounce,
+        profile=False, **options
+    ):
+        self.sources = sources
+        self.output_dir = output_dir
+        self.cache = cache
+        self.debounce = debounce
+        self.profile = profile
+        self.options = options
+
+        # {input file: (modification time, size)}
+        self.signatures = {}
+
+        # {input file: content hash at the time of the last conversion}
+        self.content_hashes = {}
+
+        # {input file: time of the last observed change}
+        self.pending = {}
+
+        # {input file: KlcRenderer}
+        self.renderers = {}
+
+    def poll(self, now=None):
+        '''
+        Check all sources once, and convert changed files.
+        Return a list of (input_file, output_path, error) tuples, one for
+        each conversion.
+        '''
+
+        import hashlib
+
+        if now is None:
+            now = time.monotonic()
+
+        signatures = {}
+        for input_file in collect_input_files(self.sources):
+            try:
+                # members of an archive change with the archive
+                signature = get_file_signature(
+                    getattr(input_file, 'archive', input_file))
+            except FileNotFoundError:
+                continue
+            signatures[input_file] = signature
+            if self.signatures.get(input_file) != signature:
+                self.pending[input_file] = now
+        self.signatures = signatures
+
+        results = []
+        for input_file, changed in list(self.pending.items()):
+            if input_file not in signatures:
+                # deleted
+                del self.pending[input_file]
+                self.renderers.pop(input_file, None)
+                continue
+            if now - changed < self.debounce:
+                continue
+            del self.pending[input_file]
+
+            content_hash = hashlib.sha256(
+                read_input_file(input_file)).hexdigest()
+            if self.content_hashes.get(input_file) == content_hash:
+                continue
+            self.content_hashes[input_file] = content_hash
+            renderer = self.renderers.setdefault(input_file, KlcRenderer())
+            results.append(convert_batch_item(
+                input_file, self.output_dir, self.cache, self.profile,
+                renderer=renderer, **self.options))
+        return results
+
+    def get_poll_delay(self, interval=watch_interval, now=None):
+        '''
+        Return the time to wait before the next poll: the polling interval,
+        or less if a changed file becomes stable (see debounce) earlier.
+        '''
+
+        if now is None:
+            now = time.monotonic()
+
+        delay = interval
+        for changed in self.pending.values():
+            delay = min(delay, changed + self.debounce - now)
+        return max(delay, 0)
+
+    def run(self, interval=watch_interval):
+        '''
+        Poll until interrupted.
+        '''
+
+        diagnostics_mode = self.options.get('diagnostics_mode')
+        print_status(
+            'Watching for changes, press Ctrl-C to stop.', diagnostics_mode)
+        try:
+            while True:
+                for input_file, output_path, error in self.poll():
+                    if error:
+                        print_status(
+                            f'FAILED  {input_file}: {error}',
+                            diagnostics_mode)
+                time.sleep(self.get_poll_delay(interval))
+        except KeyboardInterrupt:
+            pass
+
+
 def get_args(args=None):
+    import argparse
 
     parser = argparse.ArgumentParser(
         description=__doc__)
 
     parser.add_argument(
         'input',
+        nargs='?',
         type=lambda input_file: verify_input_file(parser, input_file),
-        help='input .keylayout file'
+        help='input .keylayout file (or .bundle, zip or tar archive)'
+    )
+
+    parser.add_argument(
+        '-b', '--batch',
+        nargs='+',
+        help=(
+            'convert all .keylayout files found in directories, '
+            'glob patterns, archives or manifest files'),
+        metavar='SOURCE',
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help=(
+            'number of worker processes for batch conversion '
+            '(default: number of CPU cores)'),
+        metavar='N',
     )
 
     parser.add_argument(
         '-o', '--output_dir',
-        help='output directory',
+        help=(
+            'output directory; - writes the .klc file to standard output '
+            '(status messages go to standard error)'),
         metavar='DIR',
     )
 
-    return parser.parse_args(args)
+    parser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help=(
+            'keep running, and convert the input file (or batch sources) '
+            'again whenever they change'),
+    )
 
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=(
+            'write the timings of all conversion stages, and the sizes of '
+            'intermediate data, to a .profile.json file next to each .klc '
+            'file'),
+    )
 
-def run(args):
-    input_file = args.input
+    parser.add_argument(
+        '--cprofile',
+        help='write cProfile statistics of the whole run to a file',
+        metavar='FILE',
+    )
+
+    parser.add_argument(
+        '--cache',
+        help='directory for caching converted .klc files',
+        metavar='DIR',
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=float,
+        default=default_cache_size / 1024 / 1024,
+        help='size limit of the cache, in MB (default: %(default)d)',
+        metavar='MB',
+    )
+
+    parser.add_argument(
+        '--all-keymapsets',
+        action='store_true',
+        help=(
+            'write a .klc file for every keyMapSet of the layout, not only '
+            'the first one (the cache is not used)'),
+    )
+
+    parser.add_argument(
+        '--ir',
+        action='store_true',
+        help=(
+            'also write the parsed layout to an intermediate representation '
+            f'file ({ir_suffix}), which can be converted instead of the '
+            '.keylayout file, without parsing it again (the cache is not '
+            'used)'),
+    )
+
+    parser.add_argument(
+        '-l', '--locale',
+        action='append',
+        help=(
+            'write a .klc file for this locale (language tag, e.g. de-DE) '
+            'to a subdirectory of the same name; can be used several times, '
+            'the layout is parsed only once (the cache is not used)'),
+        metavar='TAG',
+    )
+
+    parser.add_argument(
+        '--locale-file',
+        help=(
+            'JSON file with additional locale profiles '
+            '(see load_locale_profiles)'),
+        metavar='FILE',
+    )
+
+    parser.add_argument(
+        '--diagnostics',
+        choices=diagnostics_modes,
+        default='print',
+        help=(
+            'how to report skipped keys, SGCaps conversions, replaced '
+            'ligatures etc.: print every message, quiet, a summary per '
+            'file, or JSON lines on standard output (status messages '
+            'then go to standard error) (default: %(default)s)'),
+    )
 
-    if args.output_dir:
-        output_dir = args.output_dir
+    parser.add_argument(
+        '--prune-cache',
+        action='store_true',
+        help='evict least recently used entries exceeding the cache size',
+    )
+
+    parsed_args = parser.parse_args(args)
+    if parsed_args.input and parsed_args.batch:
+        parser.error('Please use either an input file or --batch')
+    if parsed_args.prune_cache and not parsed_args.cache:
+        parser.error('Please specify the --cache directory to prune')
+    if not any((
+        parsed_args.input, parsed_args.batch, parsed_args.prune_cache
+    )):
+        parser.error('Please specify an input file or --batch sources')
+    if parsed_args.output_dir == stdout_sink and any((
+        parsed_args.batch, parsed_args.watch, parsed_args.locale,
+        parsed_args.all_keymapsets,
+        parsed_args.input and is_keylayout_source(parsed_args.input)
+    )):
+        parser.error(
+            'Standard output (-o -) only takes the .klc file of a single '
+            'input file')
+    parsed_args.locales = None
+    if parsed_args.locale:
+        try:
+            parsed_args.locales = resolve_locales(
+                parsed_args.locale, parsed_args.locale_file)
+        except ValueError as e:
+            parser.error(str(e))
+    return parsed_args
+
+
+def convert_keylayout(
+    input_file, output_dir=None, cache=None, profile=None,
+    all_keymapsets=False, locales=None, output=None, diagnostics=None,
+    renderer=None, ir=False
+):
+    '''
+    Convert a single .keylayout file, and write the resulting .klc file
+    to the output directory (default: alongside the input file), or to the
+    binary file object passed as output.
+    If a KlcCache is passed, unchanged input files are not converted again,
+    the cached .klc file is copied instead.
+    If a ConversionProfile is passed, all stages of the conversion are
+    recorded in it, and written to a .profile.json file next to the .klc
+    file.
+    With all_keymapsets=True, one .klc file is written for every keymap set
+    of the layout (see make_keymapset_names), from a single parse.
+    With a list of locales, one .klc file is written for every locale, to
+    a subdirectory named after the language tag, from a single parse.
+    The cache is not used in these cases, and no output file object can be
+    passed.
+    Messages of the conversion are printed, unless a Diagnostics object is
+    passed.
+    A KlcRenderer kept between conversions of the same file only renders
+    the sections of the .klc file which changed (not used for several
+    keymap sets or locales).
+    With ir=True, the intermediate representation of the layout (see
+    write_ir) is written next to the (first) .klc file; the cache is not
+    used then.
+    Return the path of the (first) .klc file, or None if written to output.
+    '''
+
+    if output is not None and (all_keymapsets or locales):
+        raise ValueError(error_msg_output_variants)
+
+    if profile is None:
+        return make_klc_file(
+            input_file, output_dir, cache, disabled_profile, all_keymapsets,
+            locales, output, diagnostics, renderer, ir)
+
+    with profile.stage('total'):
+        output_path = make_klc_file(
+            input_file, output_dir, cache, profile, all_keymapsets, locales,
+            output, diagnostics, renderer, ir)
+    if output_path is None:
+        # next to the input file
+        profile_path = os.path.join(
+            get_input_dir(input_file),
+            make_keyboard_name(input_file) + '.profile.json')
     else:
-        output_dir = os.path.abspath(os.path.dirname(input_file))
+        profile_path = os.path.splitext(output_path)[0] + '.profile.json'
+    profile.write_json(profile_path)
+    return output_path
+
+
+def make_klc_file(
+    input_file, output_dir, cache, profile, all_keymapsets, locales, output,
+    diagnostics, renderer=None, ir=False
+):
+    '''
+    Convert a .keylayout file, and write the .klc file(s) (see
+    convert_keylayout). Return the path of the (first) .klc file.
+    '''
+
+    if not output_dir:
+        output_dir = os.path.abspath(get_input_dir(input_file))
+    status_mode = getattr(diagnostics, 'mode', None)
 
-    keyboard_data = process_input_keylayout(input_file)
     keyboard_name = make_keyboard_name(input_file)
     klc_filename = make_klc_filename(keyboard_name)
-    klc_data = make_klc_data(keyboard_name, keyboard_data)
+    output_path = make_output_path(input_file, output_dir)
+
+    if all_keymapsets or locales:
+        keyboard_data = process_input_keylayout(
+            input_file, profile=profile, diagnostics=diagnostics)
+        if ir:
+            write_ir(keyboard_data, os.path.join(
+                output_dir, keyboard_name + ir_suffix))
+        output_paths = []
+        for locale, keymapset_id, keymapset_name, klc_data in (
+            make_klc_variants(
+                keyboard_name, keyboard_data, locales, all_keymapsets,
+                profile=profile)
+        ):
+            klc_filename = make_klc_filename(keymapset_name)
+            variant = [f'keyMapSet {keymapset_id}']
+            if locale:
+                klc_filename = os.path.join(locale.language_tag, klc_filename)
+                os.makedirs(
+                    os.path.join(output_dir, locale.language_tag),
+                    exist_ok=True)
+                variant.append(locale.language_tag)
+            output_path = os.sep.join((output_dir, klc_filename))
+            with profile.stage('write'):
+                write_klc(encode_klc(klc_data), output_path)
+            print_status(
+                f'{keyboard_name} ({", ".join(variant)}) '
+                f'written to {klc_filename}', status_mode)
+            output_paths.append(output_path)
+        return output_paths[0]
+
+    if output is None:
+        output = output_path
+    else:
+        output_path = None
+        klc_filename = getattr(output, 'name', 'output')
+
+    if cache and not ir:
+        with profile.stage('cache_lookup'):
+            cache_key = cache.make_key(
+                read_input_file(input_file), keyboard_name)
+            klc_bytes = cache.get(cache_key)
+        if klc_bytes is not None:
+            with profile.stage('write'):
+                write_klc(klc_bytes, output)
+            for kind, message, keycode, codepoints in cache.get_events(
+                cache_key
+            ):
+                report(
+                    message, diagnostics, kind, keycode=keycode,
+                    codepoints=codepoints)
+            print_status(
+                f'{keyboard_name} written to {klc_filename} (cached)',
+                status_mode)
+            return output_path
+        if diagnostics is None:
+            # record the events for the cache entry, printing them as usual
+            diagnostics = Diagnostics('print')
+        first_event = len(diagnostics.events)
+
+    keyboard_data = process_input_keylayout(
+        input_file, profile=profile, diagnostics=diagnostics)
+    if ir:
+        write_ir(keyboard_data, os.path.join(
+            get_input_dir(input_file) if output_path is None else output_dir,
+            keyboard_name + ir_suffix))
+    if renderer is None:
+        renderer = KlcRenderer()
+    klc_bytes = renderer.render(keyboard_name, keyboard_data, profile)
+
+    with profile.stage('write'):
+        write_klc(klc_bytes, output)
+
+    if cache and not ir:
+        cache.put(cache_key, klc_bytes, diagnostics.events[first_event:])
+
+    print_status(f'{keyboard_name} written to {klc_filename}', status_mode)
+    return output_path
+
+
+def make_output_path(input_file, output_dir=None):
+    '''
+    Return the path of the .klc file of an input file, in the output
+    directory (default: alongside the input file, see get_input_dir).
+    '''
+
+    if not output_dir:
+        output_dir = os.path.abspath(get_input_dir(input_file))
+    klc_filename = make_klc_filename(make_keyboard_name(input_file))
+    return os.sep.join((output_dir, klc_filename))
+
+
+def make_output_paths(
+    input_file, output_dir=None, all_keymapsets=False, locales=None
+):
+    '''
+    Return the paths of all .klc files written for an input file by
+    make_klc_file: one for each keymap set (with all_keymapsets=True) and
+    locale, or a single one (see make_output_path). The keymap sets are
+    found by scan_keymapset_ids, without converting the layout.
+    '''
+
+    if not (all_keymapsets or locales):
+        return [make_output_path(input_file, output_dir)]
+
+    if not output_dir:
+        output_dir = os.path.abspath(get_input_dir(input_file))
+    keyboard_name = make_keyboard_name(input_file)
+    keymapset_names = [keyboard_name]
+    if all_keymapsets:
+        keymapset_names = [
+            keymapset_name for keymapset_id, keymapset_name
+            in make_keymapset_names(
+                keyboard_name, scan_keymapset_ids(input_file))]
+
+    output_paths = []
+    for keymapset_name in keymapset_names:
+        klc_filename = make_klc_filename(keymapset_name)
+        for locale in locales or [None]:
+            if locale:
+                output_paths.append(os.sep.join((
+                    output_dir,
+                    os.path.join(locale.language_tag, klc_filename))))
+            else:
+                output_paths.append(os.sep.join((output_dir, klc_filename)))
+    return output_paths
 
-    output_path = os.sep.join((output_dir, klc_filename))
-    with codecs.open(output_path, 'w', 'utf-16') as output_file:
-        for line in klc_data:
-            output_file.write(line)
-            output_file.write(os.linesep)
 
-    print(f'{keyboard_name} written to {klc_filename}')
+def find_output_collisions(
+    input_files, output_dir=None, all_keymapsets=False, locales=None
+):
+    '''
+    Return {input file: error} for input files with a .klc file of the same
+    path as one of an earlier input file (e.g. after truncation to 8
+    characters, or for files of the same name in several directories) or
+    of another variant of the same file (see make_output_paths), or whose
+    name is not usable (see make_klc_filename).
+    '''
+
+    errors = {}
+    output_files = {}
+    for input_file in input_files:
+        try:
+            output_paths = make_output_paths(
+                input_file, output_dir, all_keymapsets, locales)
+        except (Exception, SystemExit) as e:
+            errors[input_file] = f'{type(e).__name__}: {e}'
+            continue
+
+        output_keys = {}
+        for output_path in output_paths:
+            output_key = os.path.normcase(os.path.abspath(output_path))
+            if output_key in output_files:
+                errors[input_file] = error_msg_output_collision.format(
+                    output_path, output_files[output_key])
+                break
+            if output_key in output_keys:
+                errors[input_file] = error_msg_variant_collision.format(
+                    output_path)
+                break
+            output_keys[output_key] = input_file
+        else:
+            output_files.update(output_keys)
+    return errors
+
+
+def convert_batch_item(
+    input_file, output_dir=None, cache=None, profile=False,
+    diagnostics_mode=None, **options
+):
+    '''
+    Worker function for batch conversion. Failures (including the SystemExit
+    raised for unusable file names) are returned rather than raised, so one
+    broken layout does not stop the batch.
+    With profile=True, a .profile.json file is written for every file.
+    With a diagnostics_mode (see diagnostics_modes), the messages of every
+    file are recorded in a Diagnostics object of that mode.
+    Further keyword arguments are passed on to convert_keylayout.
+    Return a tuple (input_file, output_path, error).
+    '''
+
+    diagnostics = None
+    if diagnostics_mode:
+        diagnostics = Diagnostics(diagnostics_mode, str(input_file))
+    try:
+        output_path = convert_keylayout(
+            input_file, output_dir, cache,
+            ConversionProfile() if profile else None,
+            diagnostics=diagnostics, **options)
+    except (Exception, SystemExit) as e:
+        return input_file, None, f'{type(e).__name__}: {e}'
+    finally:
+        if diagnostics:
+            diagnostics.finish()
+    return input_file, output_path, None
+
+
+def run_batch(
+    input_files, output_dir=None, jobs=None, cache=None, profile=False,
+    **options
+):
+    '''
+    Convert many .keylayout files using a pool of worker processes.
+    Each .klc file is written by its worker as soon as it is finished.
+    Files which would overwrite the .klc file of an earlier file are not
+    converted, but reported as failed (see find_output_collisions).
+    With several workers, the cache is pruned once at the end.
+    Further keyword arguments are passed on to convert_keylayout.
+    Return a list of (input_file, output_path, error) tuples, in the order
+    of input_files.
+    '''
+
+    results = {
+        input_file: (input_file, None, error)
+        for input_file, error
+        in find_output_collisions(
+            input_files, output_dir, options.get('all_keymapsets', False),
+            options.get('locales')).items()}
+    pending_files = sort_for_reading(
+        input_file for input_file in input_files
+        if input_file not in results)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(pending_files)))
+
+    if jobs == 1:
+        for input_file in pending_files:
+            results[input_file] = convert_batch_item(
+                input_file, output_dir, cache, profile, **options)
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        worker_cache = None
+        if cache:
+            # the workers do not know about each other's entries; the cache
+            # is pruned once at the end of the batch instead
+            worker_cache = KlcCache(cache.cache_dir, max_size=None)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    convert_batch_item, input_file, output_dir, worker_cache,
+                    profile, **options)
+                for input_file in pending_files]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result[0]] = result
+        if cache:
+            cache.prune()
+
+    return [results[input_file] for input_file in input_files]
+
+
+def print_batch_summary(results, diagnostics_mode=None):
+    '''
+    Print the outcome of every file in a batch conversion, and a total
+    (see print_status).
+    '''
+
+    failures = [result for result in results if result[2]]
+    print_status('', diagnostics_mode)
+    for input_file, output_path, error in results:
+        if error:
+            print_status(f'FAILED  {input_file}: {error}', diagnostics_mode)
+        else:
+            print_status(
+                f'ok      {input_file} -> {output_path}', diagnostics_mode)
+    print_status(
+        f'{len(results) - len(failures)} of {len(results)} '
+        f'files converted, {len(failures)} failed.', diagnostics_mode)
+
+
+def run(args):
+    cprofile_path = getattr(args, 'cprofile', None)
+    if not cprofile_path:
+        return run_conversions(args)
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run_conversions, args)
+    finally:
+        profiler.dump_stats(cprofile_path)
+
+
+def run_conversions(args):
+    profile = getattr(args, 'profile', False)
+    options = {
+        'all_keymapsets': getattr(args, 'all_keymapsets', False),
+        'locales': getattr(args, 'locales', None),
+        'ir': getattr(args, 'ir', False),
+    }
+    diagnostics_mode = getattr(args, 'diagnostics', None)
+    cache = None
+    if getattr(args, 'cache', None):
+        cache = KlcCache(args.cache, int(args.cache_size * 1024 * 1024))
+        if args.prune_cache:
+            evicted = cache.prune()
+            print_status(
+                f'{evicted} cache entries evicted.', diagnostics_mode)
+
+    batch_sources = getattr(args, 'batch', None)
+    if args.input and is_keylayout_source(args.input):
+        # a .bundle or an archive may contain several layouts
+        batch_sources = [args.input]
+    if getattr(args, 'watch', False):
+        watcher = KeylayoutWatcher(
+            batch_sources or [args.input], args.output_dir, cache,
+            profile=profile, diagnostics_mode=diagnostics_mode, **options)
+        watcher.run()
+        return 0
+
+    if batch_sources:
+        input_files = collect_input_files(batch_sources)
+        if not input_files:
+            print_status('No .keylayout files found.', diagnostics_mode)
+            return 1
+        results = run_batch(
+            input_files, args.output_dir, getattr(args, 'jobs', None), cache,
+            profile, diagnostics_mode=diagnostics_mode, **options)
+        print_batch_summary(results, diagnostics_mode)
+        return 1 if any(result[2] for result in results) else 0
+
+    if args.input:
+        diagnostics = None
+        if diagnostics_mode:
+            diagnostics = Diagnostics(diagnostics_mode, args.input)
+        output = None
+        redirect = contextlib.nullcontext()
+        if args.output_dir == stdout_sink:
+            output = sys.stdout.buffer
+            # keep the .klc data apart from status messages and diagnostics
+            redirect = contextlib.redirect_stdout(sys.stderr)
+        with redirect:
+            convert_keylayout(
+                args.input, args.output_dir, cache,
+                ConversionProfile() if profile else None, output=output,
+                diagnostics=diagnostics, **options)
+            if diagnostics:
+                diagnostics.finish()
+    return 0
 
 
 if __name__ == '__main__':
     args = get_args()
-    run(args)
+    sys.exit(run(args))
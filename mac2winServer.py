@@ -0,0 +1,487 @@
+#!/bin/env python
+'''
+Local conversion service for mac2winKeyboard.py.
+Accepts .keylayout files over HTTP (TCP, or a Unix socket), and returns the
+converted .klc files. Conversions run on a pool of warm worker processes.
+
+    POST /convert?name=NAME    body: .keylayout data, returns the .klc file
+    GET /health                service status and metrics (JSON)
+
+Optional query parameters of /convert: company, language_id, language_tag,
+language_name, keyboard_description (default: data/locale_data.py).
+'''
+
+import os
+import time
+
+import argparse
+import asyncio
+import json
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, quote, urlsplit
+
+from mac2winKeyboard import (
+    Locale, convert_keylayout_data, default_locale, make_klc_filename,
+)
+
+
+default_host = '127.0.0.1'
+default_port = 8765
+
+# Size limit of a .keylayout upload, in bytes.
+default_max_body = 16 * 1024 * 1024
+
+# Requests (uploading, waiting or converting) accepted before answering
+# 503. Checked before the body of a request is read.
+default_max_pending = 256
+
+# Limits of the request head: number of header lines, and their total size
+# in bytes (a single line is limited to 64 KiB by the stream reader).
+max_header_lines = 100
+max_header_size = 32 * 1024
+
+# Size of the chunks in which the .klc file is sent.
+response_chunk_size = 64 * 1024
+
+# Size limit of the X-Diagnostics header, in bytes; messages beyond it are
+# left out (X-Diagnostics-Count holds the number of all messages).
+diagnostics_header_limit = 8 * 1024
+
+http_reasons = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    414: 'URI Too Long',
+    422: 'Unprocessable Entity',
+    431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+}
+
+
+def warm_worker():
+    '''
+    Initializer of the worker processes: load the data tables once, by
+    running a conversion of a minimal layout.
+    '''
+
+    convert_keylayout_data(
+        '<?xml version="1.1" encoding="UTF-8"?>\n'
+        '<keyboard><keyMapSet id="0"><keyMap index="0">'
+        '<key code="0" output="a"/></keyMap></keyMapSet></keyboard>',
+        'warmup')
+
+
+def convert_payload(keylayout, keyboard_name, locale, company):
+    '''
+    Worker function: convert .keylayout bytes.
+    Return a tuple (klc_bytes, messages).
+    '''
+
+    klc_bytes, diagnostics = convert_keylayout_data(
+        keylayout, keyboard_name, locale, company)
+    return klc_bytes, diagnostics.messages
+
+
+def make_content_disposition(filename):
+    '''
+    Return the Content-Disposition header of a .klc file (RFC 6266): an
+    ASCII fallback of the filename, and the UTF-8 filename if it differs.
+    '''
+
+    fallback = ''.join(
+        char if ' ' <= char <= '~' and char not in '"\\' else '_'
+        for char in filename)
+    header = f'attachment; filename="{fallback}"'
+    if fallback != filename:
+        header += f"; filename*=UTF-8''{quote(filename, safe='')}"
+    return header
+
+
+def is_klc_text(value):
+    '''
+    Whether a query value can be written into the .klc file: not empty, and
+    without control characters (line breaks, tabs) or double quotes, which
+    would break the quoted strings of the .klc prologue.
+    '''
+
+    return bool(value) and not any(
+        ord(char) < 32 or ord(char) == 127 or char == '"' for char in value)
+
+
+def make_diagnostics_header(messages, limit=diagnostics_header_limit):
+    '''
+    Return the messages of a conversion as a JSON list (ASCII), of at most
+    limit bytes: messages which do not fit are left out.
+    '''
+
+    included = []
+    size = 2
+    for message in messages:
+        size += len(json.dumps(message, ensure_ascii=True)) + 2
+        if size > limit:
+            break
+        included.append(message)
+    return json.dumps(included, ensure_ascii=True)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=''):
+        super().__init__(message)
+        self.status = status
+
+
+class ConversionServer(object):
+    '''
+    asyncio front end, dispatching conversions to a process pool.
+    At most `concurrency` conversions run at the same time; further
+    requests wait, up to a total of `max_pending` requests (counted from
+    the moment their body is read). Beyond that, requests are rejected
+    (503) to push back on clients. If a worker process dies, the pool is
+    replaced.
+    '''
+
+    def __init__(
+        self, workers=None, concurrency=None,
+        max_pending=default_max_pending, max_body=default_max_body
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.concurrency = concurrency or self.workers
+        self.max_pending = max(max_pending, self.concurrency)
+        self.max_body = max_body
+
+        self.executor = None
+        self.semaphore = None
+        self.start_time = time.monotonic()
+
+        self.pending = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.conversion_time = 0.0
+
+    async def start(self, host=default_host, port=default_port, path=None):
+        '''
+        Start the worker pool, and listen on a TCP port or a Unix socket.
+        Return the asyncio server.
+        '''
+
+        self.executor = self.make_executor()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        if path:
+            return await asyncio.start_unix_server(
+                self.handle_connection, path=path)
+        return await asyncio.start_server(
+            self.handle_connection, host=host, port=port)
+
+    def make_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers, initializer=warm_worker)
+
+    def restart_executor(self, broken_executor):
+        '''
+        Replace a broken worker pool (unless another request already did).
+        '''
+
+        if self.executor is broken_executor:
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.make_executor()
+            self.restarts += 1
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def metrics(self):
+        average = (
+            self.conversion_time / self.completed if self.completed else 0)
+        return {
+            'status': 'ok',
+            'uptime': round(time.monotonic() - self.start_time, 3),
+            'workers': self.workers,
+            'concurrency': self.concurrency,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'restarts': self.restarts,
+            'average_conversion_time': round(average, 6),
+        }
+
+    async def handle_connection(self, reader, writer):
+        '''
+        Serve the requests of a connection (HTTP/1.1, keep-alive).
+        '''
+
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HTTPError as e:
+                    await self.send_response(
+                        writer, e.status, str(e).encode('utf-8'),
+                        keep_alive=False)
+                    break
+                if request is None:
+                    break
+
+                method, target, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    status, content_type, payload, extra_headers = (
+                        await self.dispatch(method, target, body))
+                except HTTPError as e:
+                    status, content_type, payload, extra_headers = (
+                        e.status, 'text/plain; charset=utf-8',
+                        str(e).encode('utf-8'), {})
+                finally:
+                    if method == 'POST':
+                        # accepted in read_request
+                        self.pending -= 1
+                await self.send_response(
+                    writer, status, payload, content_type, extra_headers,
+                    keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        '''
+        Read an HTTP request. Return (method, target, headers, body), or None
+        if the client closed the connection.
+        A POST request is counted as pending before its body is read (or
+        rejected, if there are too many); the caller releases it.
+        '''
+
+        try:
+            request_line = await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HTTPError(414, 'Request line too long')
+        if not request_line.strip():
+            return None
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, 'Malformed request line')
+
+        headers = {}
+        header_lines = 0
+        header_size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                raise HTTPError(431, 'Header line too long')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines += 1
+            header_size += len(line)
+            if (
+                header_lines > max_header_lines or
+                header_size > max_header_size
+            ):
+                raise HTTPError(431, 'Too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        body = b''
+        if method == 'POST':
+            if 'content-length' not in headers:
+                raise HTTPError(411, 'Content-Length required')
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise HTTPError(400, 'Invalid Content-Length')
+            if length < 0:
+                raise HTTPError(400, 'Invalid Content-Length')
+            if length > self.max_body:
+                raise HTTPError(413, 'Keyboard layout too large')
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPError(503, 'Too many pending conversions')
+            self.pending += 1
+            try:
+                body = await reader.readexactly(length)
+            except BaseException:
+                self.pending -= 1
+                raise
+        return method, target, headers, body
+
+    async def dispatch(self, method, target, body):
+        '''
+        Return (status, content type, payload, extra headers) for a request.
+        '''
+
+        url = urlsplit(target)
+        if url.path in ('/health', '/metrics'):
+            if method != 'GET':
+                raise HTTPError(405, 'Use GET')
+            payload = json.dumps(self.metrics()).encode('utf-8')
+            return 200, 'application/json', payload, {}
+
+        if url.path != '/convert':
+            raise HTTPError(404, 'Not found')
+        if method != 'POST':
+            raise HTTPError(405, 'Use POST')
+
+        query = {
+            name: values[-1] for name, values in parse_qs(url.query).items()}
+        # all values end up in the .klc file
+        for field in ('name', 'company') + Locale._fields:
+            if field in query and not is_klc_text(query[field]):
+                raise HTTPError(400, f'Invalid {field}')
+        keyboard_name = query.get('name', 'keyboard')
+        locale = Locale(*(
+            query.get(field, getattr(default_locale, field))
+            for field in Locale._fields))
+        company = query.get('company')
+
+        async with self.semaphore:
+            self.in_flight += 1
+            start = time.monotonic()
+            executor = self.executor
+            try:
+                klc_bytes, messages = (
+                    await asyncio.get_running_loop().run_in_executor(
+                        executor, convert_payload, body,
+                        keyboard_name, locale, company))
+            except Exception as e:
+                self.failed += 1
+                if isinstance(e, BrokenProcessPool):
+                    self.restart_executor(executor)
+                raise HTTPError(
+                    422, f'Conversion failed: {type(e).__name__}: {e}')
+            finally:
+                self.in_flight -= 1
+            self.completed += 1
+            self.conversion_time += time.monotonic() - start
+
+        try:
+            klc_filename = make_klc_filename(keyboard_name)
+        except SystemExit:
+            klc_filename = 'keyboard.klc'
+        extra_headers = {
+            'Content-Disposition': make_content_disposition(klc_filename),
+            'X-Diagnostics': make_diagnostics_header(messages),
+            'X-Diagnostics-Count': str(len(messages)),
+        }
+        return 200, 'text/plain; charset=utf-16', klc_bytes, extra_headers
+
+    async def send_response(
+        self, writer, status, payload,
+        content_type='text/plain; charset=utf-8', extra_headers=None,
+        keep_alive=True
+    ):
+        '''
+        Send an HTTP response, streaming the payload in chunks.
+        '''
+
+        headers = {
+            'Content-Type': content_type,
+            'Content-Length': str(len(payload)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+        }
+        if status == 503:
+            headers['Retry-After'] = '1'
+        headers.update(extra_headers or {})
+
+        head = [f'HTTP/1.1 {status} {http_reasons[status]}']
+        head.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        view = memoryview(payload)
+        for start in range(0, len(view), response_chunk_size):
+            writer.write(view[start:start + response_chunk_size])
+            await writer.drain()
+        await writer.drain()
+
+
+async def serve(args):
+    server = ConversionServer(
+        args.workers, args.concurrency, args.max_pending)
+    listener = await server.start(args.host, args.port, args.socket)
+    address = args.socket or '{}:{}'.format(
+        *listener.sockets[0].getsockname()[:2])
+    print(f'Serving on {address} with {server.workers} workers.')
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def get_args(args=None):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        '--host',
+        default=default_host,
+        help='address to bind to (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '-p', '--port',
+        type=int,
+        default=default_port,
+        help='port to listen on (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '-s', '--socket',
+        help='listen on a Unix socket instead of a TCP port',
+        metavar='PATH',
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        help='number of worker processes (default: number of CPU cores)',
+        metavar='N',
+    )
+
+    parser.add_argument(
+        '-c', '--concurrency',
+        type=int,
+        help='maximum number of simultaneous conversions (default: workers)',
+        metavar='N',
+    )
+
+    parser.add_argument(
+        '--max-pending',
+        type=int,
+        default=default_max_pending,
+        help=(
+            'maximum number of accepted requests, before rejecting '
+            'new ones (default: %(default)s)'),
+        metavar='N',
+    )
+
+    return parser.parse_args(args)
+
+
+def run(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    args = get_args()
+    run(args)
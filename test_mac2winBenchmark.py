@@ -0,0 +1,122 @@
+import json
+import sys
+import unittest
+
+from mac2winBenchmark import *
+from mac2winKeyboard import KeylayoutParser, prefilter_xml
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_make_synthetic_keylayout(self):
+        keylayout = make_synthetic_keylayout(
+            keymaps=4, actions=30, deadkey_states=3, ligatures=2)
+        keyboard_data = KeylayoutParser(
+            xml_chunks=[prefilter_xml(keylayout.encode('utf-8'))])
+        self.assertEqual(keyboard_data.number_of_keymaps, 3)
+        self.assertEqual(
+            len({action[0] for action in keyboard_data.action_list}),
+            30 + 3 + 1)
+        self.assertEqual(len(keyboard_data.deadkeys), 3)
+        self.assertEqual(len(keyboard_data.deadkey_dict), 3)
+        self.assertEqual(
+            sum(
+                list(key_outputs.values()).count('007e')
+                for key_outputs in keyboard_data.output_dict.values()),
+            2)
+
+    def test_run_benchmark(self):
+        results = run_benchmark(scales=[1], repeat=1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(
+            set(results[0]['timings']),
+            {'filter_xml', 'prefilter_xml', 'ET.XML', 'stream_parse',
+             'make_klc_data', 'write_utf16'} |
+            {f'KeylayoutParser.{name}' for name in parser_passes})
+        self.assertEqual(
+            set(stage_sizes.values()) - set(results[0]['sizes']), set())
+
+    def test_check_scaling(self):
+        results = [
+            {'input_size': 1000, 'timings': {'linear': 0.01, 'square': 0.01}},
+            {'input_size': 4000, 'timings': {'linear': 0.04, 'square': 0.16}},
+        ]
+        errors = check_scaling(results)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('square'))
+
+        # stages are fitted against the size which drives them
+        stage = 'KeylayoutParser.make_deadkey_dict'
+        results = [
+            {'input_size': 1000, 'sizes': {'action_list': 100},
+             'timings': {stage: 0.01}},
+            {'input_size': 2000, 'sizes': {'action_list': 400},
+             'timings': {stage: 0.04}},
+        ]
+        self.assertEqual(check_scaling(results), [])
+        results[1]['sizes']['action_list'] = 200
+        self.assertEqual(len(check_scaling(results)), 1)
+
+        # a stage driven by a size which does not grow is fitted against
+        # the input size
+        stage = 'KeylayoutParser.make_output_dict'
+        results = [
+            {'input_size': 1000, 'sizes': {'key_list': 100},
+             'timings': {stage: 0.01}},
+            {'input_size': 4000, 'sizes': {'key_list': 100},
+             'timings': {stage: 0.02}},
+        ]
+        self.assertEqual(check_scaling(results), [])
+
+        # timings too short to be reliable are left out
+        results = [
+            {'input_size': 1000, 'timings': {'stage': 0.0001}},
+            {'input_size': 2000, 'timings': {'stage': 0.01}},
+            {'input_size': 4000, 'timings': {'stage': 0.02}},
+        ]
+        self.assertEqual(check_scaling(results), [])
+
+    def test_compare_baseline(self):
+        results = [{
+            'scale': 1,
+            'spec': {},
+            'input_size': 1000,
+            'sizes': {},
+            'timings': {'stage': 0.01},
+            'reference_time': 0.01,
+            'peak_memory': {'tree': 1000}}]
+        baseline = make_baseline(results)
+        self.assertNotIn('timings', baseline[0])
+        self.assertEqual(baseline[0]['relative_timings'], {'stage': 1.0})
+
+        # the same relative timings on a slower machine
+        results[0]['timings']['stage'] = 0.04
+        results[0]['reference_time'] = 0.02
+        self.assertEqual(compare_baseline(results, baseline), [])
+        results[0]['timings']['stage'] = 0.1
+        results[0]['peak_memory']['tree'] = 5000
+        self.assertEqual(len(compare_baseline(results, baseline)), 2)
+
+    def test_baseline_file(self):
+        with open(default_baseline) as f:
+            baseline = json.load(f)
+        for result in baseline:
+            self.assertNotIn('timings', result)
+            self.assertIn('relative_timings', result)
+
+    def test_import_time(self):
+        elapsed, imported = measure_import_time(repeat=1)
+        self.assertGreater(elapsed, 0)
+        self.assertIn('mac2winKeyboard', imported)
+        self.assertEqual(check_lazy_imports(imported), [])
+        self.assertEqual(
+            check_lazy_imports(['os', 'json']),
+            ['json is imported on start-up'])
+
+        # sys is loaded before any import
+        elapsed, imported = measure_import_time('sys', repeat=1)
+        self.assertIsNone(elapsed)
+
+
+if __name__ == "__main__":
+    sys.exit(unittest.main())
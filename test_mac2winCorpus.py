@@ -0,0 +1,123 @@
+import sys
+import unittest
+
+from mac2winCorpus import *
+from mac2winKeyboard import process_input_keylayout
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class CorpusTest(unittest.TestCase):
+
+    def make_corpus(self, temp_dir):
+        import shutil
+
+        us_test = os.path.join('tests', 'us_test.keylayout')
+        shutil.copy(us_test, os.path.join(temp_dir, 'us_copy.keylayout'))
+        with open(us_test, encoding='utf-8') as f:
+            keylayout = f.read()
+        # one key changed in keymap 0 (default and command states)
+        with open(
+            os.path.join(temp_dir, 'us_edit.keylayout'), 'w', encoding='utf-8'
+        ) as f:
+            f.write(keylayout.replace(
+                '<key code="1" output="s"/>',
+                '<key code="1" output="ß"/>', 1))
+        input_files = [
+            us_test, os.path.join('tests', 'sgcap.keylayout'),
+            os.path.join(temp_dir, 'us_copy.keylayout'),
+            os.path.join(temp_dir, 'us_edit.keylayout'),
+            os.path.join('tests', 'nonexistent.keylayout')]
+        return LayoutCorpus.from_files(input_files, jobs=2)
+
+    def test_output_value(self):
+        self.assertEqual(output_value('-1'), undefined_output)
+        self.assertEqual(output_value('00e9'), 0xe9)
+        self.assertEqual(output_value('00b4@'), 0xb4 | deadkey_flag)
+        self.assertEqual(output_value('x'), unknown_output)
+        for output in ('-1', '00e9', '00b4@', '1f600'):
+            self.assertEqual(format_value(output_value(output)), output)
+
+    def test_layout_row(self):
+        keycodes = get_corpus_keycodes()
+        keyboard_data = process_input_keylayout(
+            os.path.join('tests', 'us_test.keylayout'),
+            diagnostics=Diagnostics())
+        row = layout_row(keyboard_data, keycodes).reshape(len(keycodes), -1)
+        for index, keycode in enumerate(keycodes):
+            if keycode in keyboard_data.output_table:
+                expected = [
+                    output_value(output)
+                    for output in keyboard_data.output_table.get_row(keycode)]
+            else:
+                expected = [undefined_output] * len(KeyOutputTable.columns)
+            self.assertEqual(list(row[index]), expected)
+
+    def test_corpus(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            corpus, failures = self.make_corpus(temp_dir)
+            us_test, sgcap, us_copy, us_edit = corpus.names
+
+            self.assertEqual(len(failures), 1)
+            self.assertEqual(corpus.matrix.shape, (
+                4, len(get_corpus_keycodes()) * len(KeyOutputTable.columns)))
+            self.assertEqual(corpus.duplicates(), [[us_test, us_copy]])
+
+            distances = corpus.hamming_distances()
+            self.assertEqual(distances[0, 2], 0)
+            self.assertEqual(distances[0, 3], 2)
+            self.assertEqual(distances[3, 0], 2)
+            self.assertGreater(distances[0, 1], 4)
+            self.assertCountEqual(
+                corpus.near_duplicates(), [
+                    (2, us_test, us_edit), (2, us_copy, us_edit)])
+            self.assertEqual(
+                corpus.differing_columns(us_test, us_edit),
+                [(1, 'default', '0073', '00df'), (1, 'cmd', '0073', '00df')])
+
+            histograms = corpus.column_histograms()
+            self.assertIn((1, 'default', '0073', 2), histograms)
+            self.assertIn((1, 'default', '00df', 1), histograms)
+            columns = group_column_histograms(histograms)
+            # sgcap.keylayout has an output which is not a code point there
+            self.assertEqual(
+                columns[0],
+                (1, 'default', [('?', 1), ('0073', 2), ('00df', 1)]))
+            self.assertEqual(
+                sum(len(outputs) for _, _, outputs in columns),
+                len(histograms))
+            usage = dict(corpus.codepoint_usage())
+            # also on option-s of the US layouts
+            self.assertEqual(usage['00df'], 3)
+            self.assertEqual(usage['0073'], 2)
+
+    def test_run(self):
+        import contextlib
+        import io
+        import json
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.make_corpus(temp_dir)
+            json_path = os.path.join(temp_dir, 'corpus.json')
+            args = get_args([temp_dir, '-j', '1', '--json', json_path])
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertEqual(run(args), 0)
+            self.assertIn('0 groups of identical layouts', output.getvalue())
+            # the columns of the edited key
+            self.assertIn(
+                '2 keys/states with different outputs', output.getvalue())
+            self.assertIn(
+                'key 1 default: 0073 (1), 00df (1)', output.getvalue())
+            with open(json_path) as f:
+                results = json.load(f)
+            self.assertEqual(len(results['layouts']), 2)
+            self.assertEqual(len(results['duplicates']), 0)
+            self.assertEqual(len(results['near_duplicates']), 1)
+            self.assertIn(
+                [1, 'cmd', '00df', 1], results['column_histograms'])
+
+
+if __name__ == "__main__":
+    sys.exit(unittest.main())
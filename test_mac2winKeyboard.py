@@ -1,8 +1,15 @@
 import re
 import sys
 import time
+
+import argparse
+import codecs
 import unittest
 
+from unittest import mock
+
+import xml.etree.ElementTree as ET
+
 from mac2winKeyboard import *
 
 
@@ -24,6 +31,23 @@ class KLTest(unittest.TestCase):
         self.assertEqual(
             char_description('E000'), 'PUA E000')
 
+    def test_lookup_codepoint(self):
+        self.assertEqual(
+            lookup_codepoint('0041'), ('A', 'LATIN CAPITAL LETTER A'))
+        self.assertEqual(lookup_codepoint('e000'), ('\ue000', 'PUA e000'))
+        self.assertEqual(lookup_codepoint('xyz'), (None, 'PUA xyz'))
+        self.assertEqual(char_from_hex('0041'), 'A')
+        with self.assertRaises(ValueError):
+            char_from_hex('xyz')
+
+        lookup_codepoint.cache_clear()
+        char_description('e001')
+        char_description('e001@')
+        char_from_hex('e001')
+        cache_info = codepoint_cache_info()
+        self.assertEqual(cache_info.misses, 1)
+        self.assertEqual(cache_info.hits, 2)
+
     def test_make_keyboard_name(self):
         self.assertEqual(
             make_keyboard_name('test'), 'test')
@@ -92,6 +116,96 @@ class KLTest(unittest.TestCase):
                 os.path.join('tests', 'dummy_filtered.keylayout')))
         )
 
+    def test_prefilter_xml(self):
+        for sample_keylayout in ['dummy.keylayout', 'us_test.keylayout']:
+            input_keylayout = os.path.join('tests', sample_keylayout)
+            with open(input_keylayout, 'rb') as f:
+                self.assertEqual(
+                    prefilter_xml(f.read()).decode('utf-8'),
+                    filter_xml(input_keylayout))
+
+        self.assertEqual(
+            prefilter_xml(
+                b'<?xml version="1.1"?>\r\n'
+                b'<a><key code="1" output="&#x0041;"/>'
+                b'<key code="2" output="b"/><key output="&amp;"/>'
+                b'<key output=""/></a>\r\n'),
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<a><key code="1" output="0041"/>'
+            b'<key code="2" output="0062"/><key output="0026"/>'
+            b'<key output=""/></a>')
+
+    def test_prefiltered_stream(self):
+        import io
+
+        buffers = [b'', b'<?xml?>', b'<?xml?>\n', b'<?xml?>\r\n<a/>\r\n']
+        for sample_keylayout in [
+            'dummy.keylayout', 'us_test.keylayout', 'sgcap.keylayout'
+        ]:
+            with open(os.path.join('tests', sample_keylayout), 'rb') as f:
+                buffer = f.read()
+            buffers.extend([
+                buffer, buffer.rstrip(), buffer.replace(b'\n', b'\r\n'),
+                buffer.replace(b'\n', b'\r')])
+        for block_size in (1, 7, stream_block_size):
+            with mock.patch('mac2winKeyboard.stream_block_size', block_size):
+                for buffer in buffers:
+                    self.assertEqual(
+                        b''.join(iter_prefiltered_stream(io.BytesIO(buffer))),
+                        prefilter_xml(buffer), (block_size, buffer[:40]))
+
+    def test_process_input_keylayout(self):
+        for sample_keylayout in [
+            'us_test.keylayout', 'sgcap.keylayout', 'dummy.keylayout'
+        ]:
+            input_keylayout = os.path.join('tests', sample_keylayout)
+            stream_data = process_input_keylayout(input_keylayout)
+            tree_data = process_input_keylayout(
+                input_keylayout, streaming=False)
+            self.assertEqual(
+                stream_data.output_dicts, tree_data.output_dicts)
+            self.assertEqual(
+                stream_data.keymapset_bases, tree_data.keymapset_bases)
+            self.assertEqual(stream_data.action_list, tree_data.action_list)
+            self.assertEqual(
+                stream_data.keymap_assignments, tree_data.keymap_assignments)
+            self.assertEqual(stream_data.output_dict, tree_data.output_dict)
+            self.assertEqual(stream_data.deadkey_dict, tree_data.deadkey_dict)
+
+    def test_action_indexes(self):
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        keyboard_data = process_input_keylayout(input_keylayout)
+        self.assertEqual(
+            sum(map(len, keyboard_data.actions_by_id.values())),
+            len(keyboard_data.action_list))
+        self.assertEqual(
+            sum(map(len, keyboard_data.actions_by_state.values())),
+            len(keyboard_data.action_list))
+        self.assertEqual(
+            keyboard_data.empty_actions,
+            {action[0] for action in keyboard_data.action_list
+             if action[1:3] == ['none', 'next']})
+        for state, deadkey in keyboard_data.deadkeys.items():
+            self.assertIn(state, keyboard_data.actions_by_state)
+            self.assertIn(deadkey, keyboard_data.deadkey_dict)
+
+    def test_output_table(self):
+        import pickle
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        keyboard_data = process_input_keylayout(input_keylayout)
+        output_table = pickle.loads(pickle.dumps(keyboard_data.output_table))
+        keymap_assignments = keyboard_data.keymap_assignments
+        for key_id, key_outputs in keyboard_data.output_dict.items():
+            self.assertIn(key_id, output_table)
+            self.assertEqual(
+                output_table.get_row(key_id),
+                tuple(
+                    key_outputs.get(keymap_assignments.get(state), '-1')
+                    for state in KeyOutputTable.columns))
+        self.assertEqual(output_table.get(0, 'shift'), '0041')
+        self.assertNotIn(200, output_table)
+
     def test_make_klc_data(self):
         input_keylayout = os.path.join('tests', 'us_test.keylayout')
         output_klc = os.path.join('tests', 'us_test.klc')
@@ -113,6 +227,39 @@ class KLTest(unittest.TestCase):
             make_klc_data(keyboard_name, keyboard_data),
             klc_data.splitlines())
 
+    def test_convert_keylayout_data(self):
+        import contextlib
+        import io
+
+        for sample_keylayout in ['us_test.keylayout', 'dummy.keylayout']:
+            input_keylayout = os.path.join('tests', sample_keylayout)
+            example_klc = os.path.join(
+                'tests', sample_keylayout.split('.')[0] + '.klc')
+            with open(
+                example_klc, 'r', encoding='utf-16', newline=''
+            ) as xklc:
+                example_klc_data = actualize_copyright_year(xklc.read())
+
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                with open(input_keylayout, 'rb') as f:
+                    klc_bytes, diagnostics = convert_keylayout_data(
+                        f, make_keyboard_name(input_keylayout))
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(klc_bytes.decode('utf-16'), example_klc_data)
+            self.assertTrue(diagnostics.messages)
+
+        with open(input_keylayout, 'r', encoding='utf-8') as f:
+            keylayout = f.read()
+        locale = Locale('0407', 'de-DE', 'German (DE)', 'German (Mac)')
+        klc_bytes, diagnostics = convert_keylayout_data(
+            keylayout, 'dummy', locale, 'Example Inc.')
+        klc_text = klc_bytes.decode('utf-16')
+        self.assertIn('LOCALEID\t"00000407"', klc_text)
+        self.assertIn('COMPANY\t"Example Inc."', klc_text)
+        self.assertIn('0409\tGerman (Mac)', klc_text)
+        self.assertTrue(klc_bytes.startswith(codecs.BOM_UTF16))
+
     def test_run(self):
         import tempfile
 
@@ -132,6 +279,1006 @@ class KLTest(unittest.TestCase):
                 output_klc_data = oklc.read()
             self.assertEqual(example_klc_data, output_klc_data)
 
+    def test_collect_input_files(self):
+        import tempfile
+
+        us_test = os.path.join('tests', 'us_test.keylayout')
+        sgcap = os.path.join('tests', 'sgcap.keylayout')
+        dummy = os.path.join('tests', 'dummy.keylayout')
+        self.assertEqual(
+            collect_input_files(['tests']),
+            sorted([
+                dummy, os.path.join('tests', 'dummy_filtered.keylayout'),
+                sgcap, us_test]))
+        self.assertEqual(
+            collect_input_files([os.path.join('tests', 's*.keylayout')]),
+            [sgcap])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest = os.path.join(temp_dir, 'manifest.txt')
+            with open(manifest, 'w') as f:
+                f.write('# comment\n\n')
+                f.write(os.path.abspath(us_test) + '\n')
+                f.write(os.path.abspath(us_test) + '\n')
+            self.assertEqual(
+                collect_input_files([manifest]), [os.path.abspath(us_test)])
+
+    def test_run_batch(self):
+        import tempfile
+
+        input_files = [
+            os.path.join('tests', 'us_test.keylayout'),
+            os.path.join('tests', 'sgcap.keylayout'),
+            os.path.join('tests', 'nonexistent.keylayout')]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = run_batch(input_files, temp_dir, jobs=2)
+            self.assertEqual([r[0] for r in results], input_files)
+            self.assertIsNone(results[0][2])
+            self.assertIsNone(results[1][2])
+            self.assertIsNotNone(results[2][2])
+
+            for klc_filename in ['us_test.klc', 'sgcap.klc']:
+                example_klc = os.path.join('tests', klc_filename)
+                output_klc = os.path.join(temp_dir, klc_filename)
+                with open(example_klc, 'r', encoding='utf-16') as xklc:
+                    example_klc_data = actualize_copyright_year(xklc.read())
+                with open(output_klc, 'r', encoding='utf-16') as oklc:
+                    self.assertEqual(example_klc_data, oklc.read())
+
+    def test_output_collisions(self):
+        import contextlib
+        import io
+        import shutil
+        import tempfile
+
+        us_test = os.path.join('tests', 'us_test.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_files = []
+            for sub_dir, name in [
+                ('a', 'PiFontSymbols'), ('a', 'PiFontSymbolsBold'),
+                ('b', 'us_test'), ('c', 'us_test'), ('c', 'sgcap')
+            ]:
+                os.makedirs(os.path.join(temp_dir, sub_dir), exist_ok=True)
+                input_file = os.path.join(
+                    temp_dir, sub_dir, name + '.keylayout')
+                shutil.copy(us_test, input_file)
+                input_files.append(input_file)
+            output_dir = os.path.join(temp_dir, 'klc')
+            os.mkdir(output_dir)
+
+            errors = find_output_collisions(input_files, output_dir)
+            self.assertEqual(
+                sorted(errors), [input_files[1], input_files[3]])
+            self.assertIn(input_files[0], errors[input_files[1]])
+            self.assertIn(input_files[2], errors[input_files[3]])
+            # no collisions when written next to each input file
+            self.assertEqual(
+                find_output_collisions(input_files[2:]), {})
+
+            results = run_batch(input_files, output_dir, jobs=2)
+            self.assertEqual([r[0] for r in results], input_files)
+            self.assertEqual(
+                [r[2] is None for r in results],
+                [True, False, True, False, True])
+            self.assertEqual(
+                sorted(os.listdir(output_dir)),
+                ['PiFontSy.klc', 'sgcap.klc', 'us_test.klc'])
+
+            # the names of the variants are checked, too: us_test_1 (the
+            # second keyMapSet) is written to us_tes_1.klc, as is us_tes_1;
+            # both variants of layout1 are written to layout_1.klc
+            self.assertEqual(scan_keymapset_ids(us_test), ['16c', '984'])
+            input_files = []
+            for name in ['us_test', 'us_tes_1', 'layout1']:
+                input_file = os.path.join(temp_dir, 'd', name + '.keylayout')
+                os.makedirs(os.path.dirname(input_file), exist_ok=True)
+                shutil.copy(us_test, input_file)
+                input_files.append(input_file)
+            self.assertEqual(find_output_collisions(input_files), {})
+            errors = find_output_collisions(input_files, all_keymapsets=True)
+            self.assertEqual(sorted(errors), sorted(input_files[1:]))
+            self.assertIn(input_files[0], errors[input_files[1]])
+            self.assertIn('two variants', errors[input_files[2]])
+            # locales are written to separate directories
+            locales = resolve_locales(['en-US', 'de-DE'])
+            self.assertEqual(
+                find_output_collisions(input_files[:1], locales=locales), {})
+            self.assertEqual(
+                make_output_paths(
+                    input_files[0], output_dir, True, locales[1:]), [
+                    os.path.join(output_dir, 'de-DE', 'us_test.klc'),
+                    os.path.join(output_dir, 'de-DE', 'us_tes_1.klc')])
+
+            shutil.rmtree(output_dir)
+            os.mkdir(output_dir)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run_batch(
+                    input_files, output_dir, jobs=1, all_keymapsets=True)
+            self.assertEqual(
+                [r[2] is None for r in results], [True, False, False])
+            self.assertEqual(
+                sorted(os.listdir(output_dir)),
+                ['us_tes_1.klc', 'us_test.klc'])
+
+    def test_archive_sources(self):
+        import shutil
+        import tarfile
+        import tempfile
+        import zipfile
+
+        us_test = os.path.join('tests', 'us_test.keylayout')
+        sgcap = os.path.join('tests', 'sgcap.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bundle_dir = os.path.join(
+                temp_dir, 'layouts.bundle', 'Contents', 'Resources')
+            os.makedirs(bundle_dir)
+            shutil.copy(us_test, bundle_dir)
+            zip_path = os.path.join(temp_dir, 'layouts.zip')
+            with zipfile.ZipFile(zip_path, 'w') as archive:
+                archive.write(us_test, 'layouts/us_test.keylayout')
+                archive.write(us_test, '__MACOSX/layouts/._us_test.keylayout')
+                archive.writestr('layouts/readme.txt', 'not a layout')
+            tar_path = os.path.join(temp_dir, 'layouts.tar.gz')
+            with tarfile.open(tar_path, 'w:gz') as archive:
+                archive.add(sgcap, 'sgcap.keylayout')
+
+            input_files = collect_input_files([temp_dir])
+            self.assertEqual(input_files, [
+                os.path.join(bundle_dir, 'us_test.keylayout')])
+            input_files = collect_input_files([zip_path, tar_path])
+            self.assertEqual(input_files, [
+                ArchiveMember(tar_path, 'sgcap.keylayout'),
+                ArchiveMember(zip_path, 'layouts/us_test.keylayout')])
+            self.assertEqual(
+                str(input_files[0]), os.path.join(tar_path, 'sgcap.keylayout'))
+            self.assertEqual(make_keyboard_name(input_files[1]), 'us_test')
+
+            parser = argparse.ArgumentParser()
+            self.assertEqual(verify_input_file(parser, zip_path), zip_path)
+            with self.assertRaises(SystemExit):
+                verify_input_file(parser, os.path.join(temp_dir))
+
+            output_dir = os.path.join(temp_dir, 'klc')
+            os.mkdir(output_dir)
+            results = run_batch(input_files, output_dir, jobs=2)
+            self.assertEqual([r[0] for r in results], input_files)
+            self.assertEqual([r[2] for r in results], [None, None])
+            for klc_filename in ['us_test.klc', 'sgcap.klc']:
+                example_klc = os.path.join('tests', klc_filename)
+                output_klc = os.path.join(output_dir, klc_filename)
+                with open(example_klc, 'r', encoding='utf-16') as xklc:
+                    example_klc_data = actualize_copyright_year(xklc.read())
+                with open(output_klc, 'r', encoding='utf-16') as oklc:
+                    self.assertEqual(example_klc_data, oklc.read())
+
+            # converted next to the bundle, not into it
+            args = argparse.ArgumentParser()
+            args.input = os.path.join(temp_dir, 'layouts.bundle')
+            args.output_dir = None
+            run(args)
+            self.assertEqual(os.listdir(bundle_dir), ['us_test.keylayout'])
+            os.remove(os.path.join(temp_dir, 'us_test.klc'))
+
+            # converted next to the archive, without extracting it
+            args = argparse.ArgumentParser()
+            args.input = zip_path
+            args.output_dir = None
+            run(args)
+            self.assertTrue(
+                os.path.exists(os.path.join(temp_dir, 'us_test.klc')))
+            self.assertFalse(os.path.exists(os.path.join(temp_dir, 'layouts')))
+
+    def test_archive_members_parallel(self):
+        import contextlib
+        import io
+        import tarfile
+        import tempfile
+        import zipfile
+
+        samples = {}
+        for sample in ('us_test', 'sgcap'):
+            with open(os.path.join('tests', sample + '.keylayout'), 'rb') as f:
+                keylayout = f.read()
+            samples[sample] = (
+                keylayout,
+                convert_keylayout_data(keylayout, 'x')[0].decode('utf-16'))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = os.path.join(temp_dir, 'layouts.zip')
+            tar_path = os.path.join(temp_dir, 'layouts.tar')
+            expected = {}
+            with zipfile.ZipFile(zip_path, 'w') as zip_archive, \
+                    tarfile.open(tar_path, 'w') as tar_archive:
+                for index in range(40):
+                    sample = ('us_test', 'sgcap')[index % 2]
+                    keylayout = samples[sample][0]
+                    zip_archive.writestr(f'zip{index}.keylayout', keylayout)
+                    info = tarfile.TarInfo(f'tar{index}.keylayout')
+                    info.size = len(keylayout)
+                    tar_archive.addfile(info, io.BytesIO(keylayout))
+                    expected[f'zip{index}'] = sample
+                    expected[f'tar{index}'] = sample
+
+            # the archives are opened here, before the workers start
+            input_files = collect_input_files([zip_path, tar_path])
+            self.assertEqual(len(input_files), 80)
+            output_dir = os.path.join(temp_dir, 'klc')
+            os.mkdir(output_dir)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run_batch(input_files, output_dir, jobs=4)
+            self.assertEqual([r[2] for r in results], [None] * 80)
+            for input_file, output_path, error in results:
+                keyboard_name = make_keyboard_name(input_file)
+                with open(
+                    output_path, 'r', encoding='utf-16', newline=''
+                ) as oklc:
+                    klc_data = oklc.read()
+                self.assertEqual(
+                    klc_data.replace(f'KBD\t{keyboard_name}\t', 'KBD\tx\t'),
+                    samples[expected[keyboard_name]][1])
+
+    def test_archive_read_order(self):
+        import contextlib
+        import io
+        import random
+        import tarfile
+        import tempfile
+
+        us_test = os.path.join('tests', 'us_test.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tar_path = os.path.join(temp_dir, 'layouts.tar.gz')
+            with tarfile.open(tar_path, 'w:gz') as archive:
+                for index in range(20):
+                    archive.add(us_test, f'{chr(ord("t") - index)}.keylayout')
+            input_files = collect_input_files([tar_path])
+            offsets = [member.offset() for member in input_files]
+            # in the order of the archive, not by name
+            self.assertEqual(offsets, sorted(offsets))
+            self.assertEqual(make_keyboard_name(input_files[0]), 't')
+
+            random.shuffle(input_files)
+            read_offsets = []
+            extractfile = tarfile.TarFile.extractfile
+
+            def record_extractfile(archive, member):
+                read_offsets.append(member.offset)
+                return extractfile(archive, member)
+
+            output_dir = os.path.join(temp_dir, 'klc')
+            os.mkdir(output_dir)
+            with mock.patch.object(
+                tarfile.TarFile, 'extractfile', record_extractfile
+            ), mock.patch.object(
+                tarfile.TarFile, 'getmember', side_effect=AssertionError
+            ), contextlib.redirect_stdout(io.StringIO()):
+                results = run_batch(input_files, output_dir, jobs=1)
+            self.assertEqual([r[2] for r in results], [None] * 20)
+            self.assertEqual(read_offsets, sorted(offsets))
+
+    def test_klc_cache(self):
+        import contextlib
+        import io
+        import tempfile
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = KlcCache(os.path.join(temp_dir, 'cache'))
+            output_path = convert_keylayout(input_keylayout, temp_dir, cache)
+            with open(output_path, 'rb') as f:
+                klc_bytes = f.read()
+            with open(input_keylayout, 'rb') as f:
+                cache_key = cache.make_key(f.read(), 'us_test')
+            self.assertEqual(cache.get(cache_key), klc_bytes)
+            self.assertNotEqual(
+                cache.make_key(b'', 'us_test'), cache_key)
+            self.assertNotEqual(
+                cache.make_key(klc_bytes, 'us_test2'), cache_key)
+
+            # a cache hit does not parse the input file, but reports the
+            # events of the conversion again
+            os.remove(output_path)
+            diagnostics = Diagnostics()
+            with mock.patch(
+                'mac2winKeyboard.process_input_keylayout',
+                side_effect=AssertionError
+            ):
+                convert_keylayout(
+                    input_keylayout, temp_dir, cache, diagnostics=diagnostics)
+            with open(output_path, 'rb') as f:
+                self.assertEqual(f.read(), klc_bytes)
+            expected = Diagnostics()
+            process_input_keylayout(input_keylayout, diagnostics=expected)
+            self.assertEqual(diagnostics.counts(), expected.counts())
+            self.assertEqual(diagnostics.counts()[event_ligature], 2)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                convert_keylayout(input_keylayout, temp_dir, cache)
+            self.assertIn('Could not convert', stdout.getvalue())
+
+            cache.put('other', b'x' * 10)
+            entry_size = len(klc_bytes) + os.path.getsize(
+                cache.make_path(cache_key, cache.events_suffix))
+            self.assertEqual(cache.prune(max_size=entry_size), 1)
+            self.assertEqual(cache.prune(max_size=0), 1)
+            self.assertIsNone(cache.get(cache_key))
+            self.assertEqual(cache.get_events(cache_key), [])
+            self.assertEqual(os.listdir(cache.cache_dir), [])
+
+            # the cache is only scanned when it grows beyond its limit
+            cache = KlcCache(os.path.join(temp_dir, 'cache'), max_size=100)
+            with mock.patch.object(
+                cache, 'list_entries', wraps=cache.list_entries
+            ) as list_entries:
+                for index in range(10):
+                    cache.put(f'entry{index}', b'x' * 10)
+                self.assertEqual(list_entries.call_count, 1)
+                cache.put('entry10', b'x' * 10)
+                self.assertEqual(list_entries.call_count, 2)
+            self.assertEqual(cache.size, 100)
+            self.assertIsNone(cache.get('entry0'))
+
+            # parallel workers leave the pruning to the end of the batch
+            cache = KlcCache(os.path.join(temp_dir, 'cache'), max_size=0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run_batch(
+                    [os.path.join('tests', name + '.keylayout')
+                     for name in ('us_test', 'sgcap')],
+                    temp_dir, jobs=2, cache=cache)
+            self.assertEqual([error for _, _, error in results], [None] * 2)
+            self.assertEqual(os.listdir(cache.cache_dir), [])
+
+    def test_klc_renderer(self):
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        with open(input_keylayout, 'rb') as f:
+            keylayout = f.read()
+        keyboard_data = KeylayoutParser(
+            xml_chunks=iter_prefiltered_xml(keylayout),
+            diagnostics=Diagnostics())
+        renderer = KlcRenderer()
+        klc_bytes = renderer.render('us_test', keyboard_data)
+        self.assertEqual(
+            klc_bytes, encode_klc(make_klc_data('us_test', keyboard_data)))
+        keycode_plan, keycode_gaps = get_keycode_plan()
+        self.assertEqual(
+            renderer.rendered, [
+                'prologue',
+                *(f'KEY {win_kc_hex}' for win_kc_hex, _, _ in keycode_plan),
+                'DEADKEY 00b4', 'DEADKEY 0060', 'DEADKEY 02c6',
+                'DEADKEY 00a8', 'DEADKEY 02dc', 'keyname_dead', 'epilogue'])
+        events = len(keyboard_data.diagnostics.events)
+
+        # nothing changed, events of the key table are reported again
+        self.assertEqual(renderer.render('us_test', keyboard_data), klc_bytes)
+        self.assertEqual(renderer.rendered, [])
+        self.assertEqual(
+            len(keyboard_data.diagnostics.events),
+            events + len(renderer.key_table_events))
+
+        # a single dead key result edited
+        keylayout = keylayout.replace(
+            '<when state="1" output="Ó"/>'.encode('utf-8'),
+            '<when state="1" output="Ő"/>'.encode('utf-8'))
+        edited = KeylayoutParser(
+            xml_chunks=iter_prefiltered_xml(keylayout),
+            diagnostics=Diagnostics())
+        klc_bytes = renderer.render('us_test', edited)
+        self.assertEqual(renderer.rendered, ['DEADKEY 00b4'])
+        self.assertEqual(
+            klc_bytes, encode_klc(make_klc_data('us_test', edited)))
+
+        # a single key edited: only its lines are rendered again, the
+        # events of the other keys are still reported
+        keylayout = keylayout.replace(
+            b'<key code="18" output="!"/>',
+            '<key code="18" output="¡"/>'.encode('utf-8'))
+        edited = KeylayoutParser(
+            xml_chunks=iter_prefiltered_xml(keylayout),
+            diagnostics=Diagnostics())
+        key_table_events = renderer.key_table_events
+        klc_bytes = renderer.render('us_test', edited)
+        self.assertEqual(renderer.rendered, ['KEY 02'])
+        self.assertEqual(
+            klc_bytes, encode_klc(make_klc_data('us_test', edited)))
+        self.assertEqual(renderer.key_table_events, key_table_events)
+        self.assertEqual(
+            edited.diagnostics.counts()[event_skipped_key],
+            sum(event.kind == event_skipped_key for event in key_table_events))
+
+        # a locale only changes the prologue and epilogue
+        locale = Locale('0407', 'de-DE', 'German (DE)', 'German (Mac)')
+        renderer.render('us_test', edited, locale=locale)
+        self.assertEqual(renderer.rendered, ['prologue', 'epilogue'])
+
+    def test_intermediate_representation(self):
+        import contextlib
+        import io
+        import json
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for sample_keylayout in ['us_test', 'sgcap', 'dummy']:
+                input_keylayout = os.path.join(
+                    'tests', sample_keylayout + '.keylayout')
+                ir_path = os.path.join(temp_dir, sample_keylayout + ir_suffix)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    output_path = convert_keylayout(
+                        input_keylayout, temp_dir, diagnostics=Diagnostics(),
+                        ir=True)
+                self.assertTrue(os.path.exists(ir_path))
+                with open(output_path, 'rb') as f:
+                    klc_bytes = f.read()
+                os.remove(output_path)
+
+                # converted from the IR, without parsing the XML
+                diagnostics = Diagnostics()
+                with contextlib.redirect_stdout(io.StringIO()), mock.patch(
+                    'mac2winKeyboard.KeylayoutParser.parse_stream'
+                ) as parse_stream:
+                    self.assertEqual(
+                        convert_keylayout(
+                            ir_path, temp_dir, diagnostics=diagnostics),
+                        output_path)
+                parse_stream.assert_not_called()
+                with open(output_path, 'rb') as f:
+                    self.assertEqual(f.read(), klc_bytes)
+
+                keyboard_data = process_input_keylayout(
+                    input_keylayout, diagnostics=Diagnostics())
+                ir_data = read_ir(ir_path, diagnostics=Diagnostics())
+                self.assertEqual(
+                    json.dumps(ir_data.as_ir()),
+                    json.dumps(keyboard_data.as_ir()))
+                for keymapset_id in keyboard_data.keymapset_ids:
+                    self.assertEqual(
+                        ir_data.get_key_table(keymapset_id),
+                        keyboard_data.get_key_table(keymapset_id))
+                self.assertEqual(
+                    ir_data.deadkey_dict, keyboard_data.deadkey_dict)
+
+            # events of the parse are reported again
+            self.assertEqual(
+                read_ir(ir_path, diagnostics=Diagnostics()).diagnostics
+                .counts()[event_ligature], 2)
+
+            with open(ir_path) as f:
+                ir = json.load(f)
+            ir['version'] = ir_version + 1
+            with open(ir_path, 'w') as f:
+                json.dump(ir, f)
+            with self.assertRaises(ValueError):
+                read_ir(ir_path)
+            with self.assertRaises(ValueError):
+                read_ir(os.path.join('tests', 'us_test.keylayout'))
+
+    def test_keylayout_watcher(self):
+        import shutil
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_keylayout = os.path.join(temp_dir, 'us_test.keylayout')
+            shutil.copy(
+                os.path.join('tests', 'us_test.keylayout'), input_keylayout)
+            watcher = KeylayoutWatcher([temp_dir], debounce=1)
+
+            # new file: converted once it is stable
+            self.assertEqual(watcher.poll(now=0), [])
+            results = watcher.poll(now=1)
+            self.assertEqual(len(results), 1)
+            self.assertEqual(
+                results[0], (
+                    input_keylayout,
+                    os.path.join(temp_dir, 'us_test.klc'), None))
+            self.assertEqual(watcher.poll(now=2), [])
+
+            # touched, but not modified
+            os.utime(input_keylayout, ns=(0, 0))
+            self.assertEqual(watcher.poll(now=3), [])
+            self.assertEqual(watcher.poll(now=4), [])
+
+            # saved twice in a row
+            with open(input_keylayout, 'a') as f:
+                f.write('\n')
+            self.assertEqual(watcher.poll(now=5), [])
+            with open(input_keylayout, 'a') as f:
+                f.write('\n\n')
+            self.assertEqual(watcher.poll(now=5.5), [])
+            self.assertEqual(len(watcher.poll(now=6.5)), 1)
+            # the .klc file is unchanged, no section was rendered again
+            self.assertEqual(watcher.renderers[input_keylayout].rendered, [])
+
+            # --watch --profile
+            output_dir = os.path.join(temp_dir, 'klc')
+            os.mkdir(output_dir)
+            watcher = KeylayoutWatcher(
+                [input_keylayout], output_dir, debounce=0, profile=True)
+            self.assertEqual(len(watcher.poll(now=0)), 1)
+            self.assertTrue(os.path.exists(
+                os.path.join(output_dir, 'us_test.profile.json')))
+
+    def test_watcher_latency(self):
+        import shutil
+        import statistics
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_keylayout = os.path.join(temp_dir, 'us_test.keylayout')
+            shutil.copy(
+                os.path.join('tests', 'us_test.keylayout'), input_keylayout)
+            watcher = KeylayoutWatcher([temp_dir])
+
+            # the next poll is due when a pending file becomes stable
+            self.assertEqual(watcher.get_poll_delay(now=0), watch_interval)
+            watcher.pending[input_keylayout] = 0
+            self.assertAlmostEqual(watcher.get_poll_delay(now=0.01), 0.015)
+            self.assertEqual(watcher.get_poll_delay(now=1), 0)
+            del watcher.pending[input_keylayout]
+
+            def wait_for_conversion():
+                # as in KeylayoutWatcher.run
+                while True:
+                    results = watcher.poll()
+                    if results:
+                        return results
+                    time.sleep(watcher.get_poll_delay())
+
+            wait_for_conversion()
+            latencies = []
+            key_outputs = ['!', '¡', '!', '¡']
+            for old_output, new_output in zip(key_outputs, key_outputs[1:]):
+                # edit a single key
+                with open(input_keylayout, encoding='utf-8') as f:
+                    keylayout = f.read()
+                with open(input_keylayout, 'w', encoding='utf-8') as f:
+                    f.write(keylayout.replace(
+                        f'<key code="18" output="{old_output}"/>',
+                        f'<key code="18" output="{new_output}"/>'))
+                start = time.perf_counter()
+                # the save may happen just after a poll
+                time.sleep(watch_interval)
+                results = wait_for_conversion()
+                latencies.append(time.perf_counter() - start)
+                self.assertEqual(results[0][2], None)
+                # only the lines of the edited key were rendered again
+                self.assertEqual(
+                    watcher.renderers[input_keylayout].rendered, ['KEY 02'])
+            self.assertLess(statistics.median(latencies), 0.1)
+
+    def test_classify_modifier(self):
+        import itertools
+
+        tokens = [
+            'anyShift', 'anyShift?', 'anyOption', 'anyOption?', 'command',
+            'command?', 'caps', 'caps?', 'control', 'shift?']
+        rules = KeylayoutParser.shift_state_rules
+        for size in range(4):
+            for combination in itertools.combinations(tokens, size):
+                keys = ' '.join(combination)
+                self.assertEqual(
+                    KeylayoutParser.classify_modifier(keys),
+                    tuple(
+                        state for state, (maxset, minset) in rules.items()
+                        if maxset.issuperset(combination) and
+                        minset.issubset(combination)), keys)
+
+        keyboard_data = process_input_keylayout(
+            os.path.join('tests', 'us_test.keylayout'),
+            diagnostics=Diagnostics())
+        self.assertEqual(keyboard_data.unassigned_keymaps, [5, 6, 7])
+        self.assertEqual(
+            keyboard_data.keymap_modifiers[5], ['caps anyOption'])
+        self.assertIn(
+            "// Keymap 5 ('caps anyOption') matches no Windows shift state. "
+            "Skipping.", keyboard_data.diagnostics.messages)
+
+    def test_chained_deadkeys(self):
+        keylayout = (
+            '<?xml version="1.1" encoding="UTF-8"?>\n'
+            '<keyboard group="0" id="-1" name="chain">\n'
+            '<modifierMap id="m" defaultIndex="0">\n'
+            '<keyMapSelect mapIndex="0"><modifier keys=""/></keyMapSelect>\n'
+            '</modifierMap>\n'
+            '<keyMapSet id="s"><keyMap index="0">\n'
+            '<key code="0" action="a"/>\n'
+            '<key code="14" action="acute"/>\n'
+            '<key code="50" action="grave"/>\n'
+            '<key code="49" action="space"/>\n'
+            '</keyMap></keyMapSet>\n'
+            '<actions>\n'
+            '<action id="acute">'
+            '<when state="none" next="1"/><when state="1" next="2"/>'
+            '</action>\n'
+            '<action id="grave"><when state="none" next="3"/></action>\n'
+            '<action id="a">'
+            '<when state="none" output="a"/><when state="1" output="á"/>'
+            '<when state="2" output="ő"/><when state="3" output="à"/>'
+            '</action>\n'
+            '<action id="space">'
+            '<when state="none" output=" "/><when state="1" output="´"/>'
+            '</action>\n'
+            '</actions>\n'
+            '<terminators>'
+            '<when state="2" output="˝"/><when state="3" output="`"/>'
+            '</terminators>\n'
+            '</keyboard>\n')
+
+        for streaming in (True, False):
+            if streaming:
+                keyboard_data = KeylayoutParser(
+                    xml_chunks=iter_prefiltered_xml(keylayout.encode('utf-8')))
+            else:
+                keyboard_data = KeylayoutParser(ET.XML(prefilter_xml(
+                    keylayout.encode('utf-8'))))
+            self.assertEqual(keyboard_data.reachable_states, ['1', '3', '2'])
+            self.assertEqual(
+                keyboard_data.deadkeys,
+                {'1': '00b4', '3': '0060', '2': '02dd'})
+            self.assertEqual(
+                keyboard_data.deadkey_dict, {
+                    '00b4': [
+                        ('00b4', '02dd@'), ('0061', '00e1'),
+                        ('0020', '00b4')],
+                    '02dd': [('0061', '0151'), ('0020', '02dd')],
+                    '0060': [('0061', '00e0'), ('0020', '0060')]})
+
+        klc_bytes, diagnostics = convert_keylayout_data(keylayout, 'chain')
+        klc_data = klc_bytes.decode('utf-16')
+        self.assertIn('00b4\t02dd@\t// \u00b4 -> \u02dd', klc_data)
+        self.assertIn('DEADKEY\t02dd', klc_data)
+        self.assertIn('02dd\t"DOUBLE ACUTE ACCENT"', klc_data)
+
+    def test_keymap_inheritance(self):
+        import tempfile
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        for streaming in (True, False):
+            keyboard_data = process_input_keylayout(
+                input_keylayout, streaming, diagnostics=Diagnostics())
+            self.assertEqual(keyboard_data.keymapset_bases, {'984': '16c'})
+            # the rows of the base are stored once, the derived keyMapSet
+            # only stores the rows which differ
+            base_dict = keyboard_data.output_dicts['16c']
+            derived_dict = keyboard_data.output_dicts['984']
+            self.assertIs(derived_dict.maps[1], base_dict)
+            self.assertEqual(len(derived_dict), 110)
+            self.assertEqual(len(derived_dict.maps[0]), 18)
+            self.assertIs(derived_dict[0], base_dict[0])
+            self.assertEqual(derived_dict[24][0], '005e')
+            self.assertEqual(base_dict[24][0], '003d')
+
+            base_table = keyboard_data.output_tables['16c']
+            derived_table = keyboard_data.output_tables['984']
+            self.assertIs(derived_table.base, base_table)
+            self.assertIs(derived_table.outputs, base_table.outputs)
+            self.assertEqual(sorted(derived_table.rows), sorted(
+                derived_dict.maps[0]))
+            self.assertEqual(derived_table.get_row(0), base_table.get_row(0))
+            self.assertEqual(derived_table.get(24, 'default'), '005e')
+            self.assertEqual(base_table.get(24, 'default'), '003d')
+            keycodes, cells = derived_table.dense()
+            for keycode in range(len(keycodes) + 1):
+                self.assertEqual(
+                    keycode in derived_table, keycode in derived_dict)
+            width = len(KeyOutputTable.columns)
+            self.assertEqual(
+                [derived_table.outputs[index]
+                 for index in cells[24 * width:25 * width]],
+                list(derived_table.get_row(24)))
+
+            ir = keyboard_data.as_ir()
+            self.assertEqual(ir['keymapset_bases'], {'984': '16c'})
+            self.assertEqual(len(ir['keymapsets']['16c']), 107)
+            self.assertEqual(len(ir['keymapsets']['984']), 18)
+            # the keys are not kept after parsing
+            self.assertEqual(keyboard_data.key_list, [])
+            self.assertEqual(keyboard_data.keymaps, {})
+
+        keylayout = (
+            '<?xml version="1.1" encoding="UTF-8"?>\n'
+            '<keyboard group="0" id="-1" name="base">\n'
+            '<modifierMap id="m" defaultIndex="0">\n'
+            '<keyMapSelect mapIndex="0"><modifier keys=""/></keyMapSelect>\n'
+            '</modifierMap>\n'
+            '<keyMapSet id="a"><keyMap index="0">\n'
+            '<key code="0" output="a"/><key code="1" output="s"/>\n'
+            '</keyMap></keyMapSet>\n'
+            '<keyMapSet id="b">'
+            '<keyMap index="0" baseMapSet="c" baseIndex="0">\n'
+            '<key code="0" output="q"/>\n'
+            '</keyMap></keyMapSet>\n'
+            '<keyMapSet id="c">'
+            '<keyMap index="0" baseMapSet="a" baseIndex="0">\n'
+            '<key code="1" output="w"/>\n'
+            '</keyMap></keyMapSet>\n'
+            '<keyMapSet id="d">'
+            '<keyMap index="0" baseMapSet="x" baseIndex="0"/>\n'
+            '</keyMapSet>\n'
+            '</keyboard>\n')
+        keyboard_data = KeylayoutParser(
+            xml_chunks=iter_prefiltered_xml(keylayout.encode('utf-8')),
+            diagnostics=Diagnostics())
+        self.assertEqual(keyboard_data.keymapset_ids, ['a', 'b', 'c'])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_keylayout = os.path.join(temp_dir, 'base.keylayout')
+            with open(input_keylayout, 'w', encoding='utf-8') as f:
+                f.write(keylayout)
+            self.assertEqual(
+                scan_keymapset_ids(input_keylayout), ['a', 'b', 'c'])
+        # chains are flattened, the bases are made first
+        self.assertEqual(list(keyboard_data.output_dicts), ['a', 'c', 'b'])
+        self.assertEqual(len(keyboard_data.output_dicts['b'].maps), 3)
+        self.assertEqual(
+            {key_id: outputs[0] for key_id, outputs
+             in keyboard_data.output_dicts['b'].items()},
+            {0: '0071', 1: '0077'})
+        self.assertEqual(
+            keyboard_data.diagnostics.counts(), {event_keymap_base: 1})
+
+        # b -> c -> b: the cycle is reported once, at the keymap closing it,
+        # which then keeps its own keys only (as the message says)
+        keyboard_data = KeylayoutParser(
+            xml_chunks=iter_prefiltered_xml(keylayout.replace(
+                'baseMapSet="a"', 'baseMapSet="b"').encode('utf-8')),
+            diagnostics=Diagnostics())
+        messages = keyboard_data.diagnostics.messages
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(len(set(messages)), 2)
+        self.assertIn('keyMapSet c inherits', messages[0])
+        self.assertEqual(keyboard_data.keymapset_bases, {'b': 'c'})
+        self.assertEqual(
+            {key_id: outputs[0] for key_id, outputs
+             in keyboard_data.output_dicts['c'].items()},
+            {1: '0077'})
+        self.assertEqual(
+            {key_id: outputs[0] for key_id, outputs
+             in keyboard_data.output_dicts['b'].items()},
+            {0: '0071', 1: '0077'})
+
+    def test_keycode_plan(self):
+        import contextlib
+        import io
+        import tempfile
+
+        keycode_plan, keycode_gaps = get_keycode_plan()
+        self.assertIs(get_keycode_plan()[0], keycode_plan)
+        self.assertEqual(keycode_gaps, [])
+        self.assertEqual(keycode_plan[0], ('02', '1', 18))
+        self.assertEqual(
+            [win_kc_hex for win_kc_hex, _, _ in keycode_plan],
+            sorted(win_kc_hex for win_kc_hex, _, _ in keycode_plan))
+
+        # gaps are recorded by every conversion, but printed once per
+        # process only, whichever way the events are passed on
+        gap = error_msg_macwin_mismatch.format(0x7f, 'F16')
+        input_keylayout = os.path.join('tests', 'sgcap.keylayout')
+        with open(input_keylayout, 'rb') as f:
+            keylayout = f.read()
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch(
+            'mac2winKeyboard.get_keycode_plan',
+            return_value=(keycode_plan, [gap])
+        ), mock.patch('mac2winKeyboard.printed_events', set()):
+            recorders = []
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                for mode in (None, 'print', 'jsonl', None):
+                    diagnostics = None
+                    if mode:
+                        diagnostics = Diagnostics(mode, input_keylayout)
+                        recorders.append(diagnostics)
+                    convert_keylayout(
+                        input_keylayout, temp_dir, diagnostics=diagnostics)
+            for _ in range(2):
+                _, diagnostics = convert_keylayout_data(keylayout, 'sgcap')
+                recorders.append(diagnostics)
+        self.assertEqual(output.getvalue().count(gap), 1)
+        for diagnostics in recorders:
+            self.assertEqual(diagnostics.messages.count(gap), 1)
+            self.assertEqual(diagnostics.counts()[event_keycode_gap], 1)
+
+    def test_all_keymapsets(self):
+        import contextlib
+        import io
+        import tempfile
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        keyboard_data = process_input_keylayout(input_keylayout)
+        self.assertEqual(keyboard_data.keymapset_ids, ['16c', '984'])
+        self.assertIs(
+            keyboard_data.output_table, keyboard_data.output_tables['16c'])
+        self.assertEqual(
+            make_keymapset_names('us_test', keyboard_data.keymapset_ids),
+            [('16c', 'us_test'), ('984', 'us_test_1')])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                with mock.patch(
+                    'mac2winKeyboard.process_input_keylayout',
+                    wraps=process_input_keylayout
+                ) as process:
+                    output_path = convert_keylayout(
+                        input_keylayout, temp_dir, all_keymapsets=True)
+            self.assertEqual(process.call_count, 1)
+            self.assertEqual(
+                sorted(os.listdir(temp_dir)), ['us_tes_1.klc', 'us_test.klc'])
+
+            with open(output_path, 'r', encoding='utf-16') as oklc:
+                output_klc_data = oklc.read()
+            with open(
+                os.path.join('tests', 'us_test.klc'), 'r', encoding='utf-16'
+            ) as xklc:
+                example_klc_data = actualize_copyright_year(xklc.read())
+            self.assertEqual(output_klc_data, example_klc_data)
+
+            with open(
+                os.path.join(temp_dir, 'us_tes_1.klc'), 'r', encoding='utf-16'
+            ) as oklc:
+                self.assertIn('KBD\tus_test_1\t', oklc.read())
+
+    def test_locale_variants(self):
+        import contextlib
+        import io
+        import json
+        import tempfile
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            locale_file = os.path.join(temp_dir, 'locales.json')
+            with open(locale_file, 'w') as f:
+                json.dump({'de-CH': {
+                    'language_id': '0807',
+                    'language_name': 'German (CH)',
+                    'keyboard_description': 'Swiss German (Mac)'}}, f)
+            locales = resolve_locales(['en-US', 'de-CH'], locale_file)
+            self.assertEqual(locales[0], default_locale)
+            self.assertEqual(locales[1].language_tag, 'de-CH')
+            with self.assertRaises(ValueError):
+                resolve_locales(['xx-XX'], locale_file)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                with mock.patch(
+                    'mac2winKeyboard.process_input_keylayout',
+                    wraps=process_input_keylayout
+                ) as process:
+                    output_path = convert_keylayout(
+                        input_keylayout, temp_dir, locales=locales)
+            self.assertEqual(process.call_count, 1)
+            self.assertEqual(
+                output_path, os.path.join(temp_dir, 'en-US', 'us_test.klc'))
+
+            with open(output_path, 'r', encoding='utf-16') as oklc:
+                output_klc_data = oklc.read()
+            with open(
+                os.path.join('tests', 'us_test.klc'), 'r', encoding='utf-16'
+            ) as xklc:
+                example_klc_data = actualize_copyright_year(xklc.read())
+            self.assertEqual(output_klc_data, example_klc_data)
+
+            with open(
+                os.path.join(temp_dir, 'de-CH', 'us_test.klc'), 'r',
+                encoding='utf-16'
+            ) as oklc:
+                variant_klc_data = oklc.read()
+            self.assertIn('LOCALEID\t"00000807"', variant_klc_data)
+            self.assertIn('0409\tSwiss German (Mac)', variant_klc_data)
+            self.assertIn(
+                output_klc_data.split('LAYOUT')[1].split('DESCRIPTIONS')[0],
+                variant_klc_data)
+
+    def test_write_klc(self):
+        import contextlib
+        import io
+        import tempfile
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                output_path = convert_keylayout(input_keylayout, temp_dir)
+                output = io.BytesIO()
+                self.assertIsNone(
+                    convert_keylayout(input_keylayout, output=output))
+            with open(output_path, 'rb') as f:
+                klc_bytes = f.read()
+            self.assertEqual(output.getvalue(), klc_bytes)
+            self.assertTrue(klc_bytes.startswith(b'\xff\xfeK\x00'))
+
+            # an interrupted write leaves the previous file untouched
+            with mock.patch('os.replace', side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    write_klc(b'partial', output_path)
+            self.assertEqual(os.listdir(temp_dir), ['us_test.klc'])
+            with open(output_path, 'rb') as f:
+                self.assertEqual(f.read(), klc_bytes)
+
+            with self.assertRaises(ValueError):
+                convert_keylayout(
+                    input_keylayout, output=output, all_keymapsets=True)
+
+    def test_diagnostics(self):
+        import io
+        import json
+
+        stream = io.StringIO()
+        diagnostics = Diagnostics('jsonl', 'sgcap.keylayout', stream)
+        keyboard_data = process_input_keylayout(
+            os.path.join('tests', 'sgcap.keylayout'),
+            diagnostics=diagnostics)
+        keyboard_data.get_key_table()
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(
+            events, [
+                dict(event._asdict(), codepoints=list(event.codepoints))
+                for event in diagnostics.events])
+        self.assertEqual(diagnostics.counts(), {event_sgcap: 1})
+        sgcap_event = diagnostics.events[0]
+        self.assertEqual(sgcap_event.file, 'sgcap.keylayout')
+        self.assertEqual(sgcap_event.keycode, 0)
+        self.assertEqual(len(sgcap_event.codepoints), 4)
+        self.assertEqual(diagnostics.messages, [sgcap_event.message])
+
+        stream = io.StringIO()
+        diagnostics = Diagnostics('summary', 'dummy.keylayout', stream)
+        keyboard_data = process_input_keylayout(
+            os.path.join('tests', 'dummy.keylayout'),
+            diagnostics=diagnostics)
+        keyboard_data.get_key_table()
+        self.assertEqual(stream.getvalue(), '')
+        diagnostics.finish()
+        self.assertEqual(
+            stream.getvalue(),
+            'dummy.keylayout: 2 ligature, 48 skipped_key\n')
+        self.assertEqual(
+            diagnostics.events[0].codepoints, ('0061', '0062', '0063'))
+
+        with self.assertRaises(ValueError):
+            Diagnostics('verbose')
+
+    def test_diagnostics_jsonl_stdout(self):
+        import json
+        import subprocess
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            process = subprocess.run(
+                [sys.executable, 'mac2winKeyboard.py', '--batch',
+                 os.path.join('tests', 'sgcap.keylayout'),
+                 os.path.join('tests', 'dummy.keylayout'),
+                 '-o', temp_dir, '-j', '2', '--diagnostics', 'jsonl'],
+                capture_output=True, text=True)
+        lines = process.stdout.splitlines()
+        self.assertGreater(len(lines), 2)
+        for line in lines:
+            json.loads(line)
+        # status messages go to standard error
+        self.assertIn('files converted', process.stderr)
+        self.assertIn('written to sgcap.klc', process.stderr)
+
+    def test_conversion_profile(self):
+        import json
+        import tempfile
+
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile = ConversionProfile()
+            output_path = convert_keylayout(
+                input_keylayout, temp_dir, profile=profile)
+            self.assertEqual(
+                output_path, os.path.join(temp_dir, 'us_test.klc'))
+            # written next to the .klc file
+            profile_path = os.path.join(temp_dir, 'us_test.profile.json')
+            with open(profile_path) as f:
+                profile_data = json.load(f)
+
+        self.assertEqual(profile_data['stages'], profile.stages)
+        self.assertEqual(
+            list(profile.stages), [
+                'parse_stream', 'find_deadkeys', 'match_actions',
+                'find_outputs', 'make_deadkey_dict', 'make_output_dict',
+                'render_prologue', 'render_key_table',
+                'render_deadkey_table', 'render_keyname_dead',
+                'render_epilogue', 'write', 'total'])
+        self.assertEqual(profile.stages['total']['calls'], 1)
+        self.assertEqual(profile.sizes['action_list'], 77)
+        self.assertEqual(profile.sizes['deadkeys'], 5)
+        self.assertIn('hits', profile_data['codepoint_cache'])
+
 
 def actualize_copyright_year(s):
     year = time.localtime()[0]
@@ -0,0 +1,231 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import json
+import threading
+import unittest
+
+import http.client
+
+from mac2winServer import *
+
+
+class ServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.server = ConversionServer(workers=1, max_pending=1)
+        cls.listener = cls.loop.run_until_complete(
+            cls.server.start(port=0))
+        cls.port = cls.listener.sockets[0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        async def shutdown():
+            cls.listener.close()
+            await cls.listener.wait_closed()
+            tasks = [
+                task for task in asyncio.all_tasks()
+                if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), cls.loop).result()
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+        cls.server.close()
+
+    def request(self, connection, method, target, body=None):
+        connection.request(method, target, body)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_convert(self):
+        input_keylayout = os.path.join('tests', 'us_test.keylayout')
+        example_klc = os.path.join('tests', 'us_test.klc')
+        with open(input_keylayout, 'rb') as f:
+            keylayout = f.read()
+        with open(example_klc, 'r', encoding='utf-16', newline='') as xklc:
+            year = time.localtime()[0]
+            example_klc_data = re.sub(
+                r'COPYRIGHT\t\"\(c\) \d+ ', f'COPYRIGHT\t"(c) {year} ',
+                xklc.read())
+
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        # two requests on the same connection
+        for i in range(2):
+            response, body = self.request(
+                connection, 'POST', '/convert?name=us_test', keylayout)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(body.decode('utf-16'), example_klc_data)
+            self.assertIn('us_test.klc', response.getheader(
+                'Content-Disposition'))
+            self.assertTrue(json.loads(response.getheader('X-Diagnostics')))
+
+        response, body = self.request(
+            connection, 'POST',
+            '/convert?name=us_test&language_id=0407&company=Example',
+            keylayout)
+        self.assertIn('LOCALEID\t"00000407"', body.decode('utf-16'))
+        self.assertIn('COMPANY\t"Example"', body.decode('utf-16'))
+
+        response, body = self.request(
+            connection, 'POST', '/convert', b'<no keylayout')
+        self.assertEqual(response.status, 422)
+
+        response, body = self.request(connection, 'GET', '/health')
+        self.assertEqual(response.status, 200)
+        metrics = json.loads(body)
+        self.assertEqual(metrics['status'], 'ok')
+        self.assertGreaterEqual(metrics['completed'], 3)
+        self.assertGreaterEqual(metrics['failed'], 1)
+        self.assertEqual(metrics['pending'], 0)
+        connection.close()
+
+    def test_errors(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        response, body = self.request(connection, 'GET', '/convert')
+        self.assertEqual(response.status, 405)
+        response, body = self.request(connection, 'GET', '/nonexistent')
+        self.assertEqual(response.status, 404)
+        connection.close()
+
+    def test_request_validation(self):
+        import socket
+        from urllib.parse import quote
+
+        with open(os.path.join('tests', 'sgcap.keylayout'), 'rb') as f:
+            keylayout = f.read()
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        name = quote('a\r\nSet-Cookie: x')
+        response, body = self.request(
+            connection, 'POST', f'/convert?name={name}', keylayout)
+        self.assertEqual(response.status, 400)
+        self.assertIsNone(response.getheader('Set-Cookie'))
+
+        response, body = self.request(
+            connection, 'POST', f'/convert?name={quote("Ωmega")}', keylayout)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.getheader('Content-Disposition'),
+            'attachment; filename="_mega.klc"; '
+            "filename*=UTF-8''%CE%A9mega.klc")
+        self.assertEqual(
+            int(response.getheader('X-Diagnostics-Count')),
+            len(json.loads(response.getheader('X-Diagnostics'))))
+        connection.close()
+
+        with socket.create_connection(('127.0.0.1', self.port)) as client:
+            client.sendall(
+                b'POST /convert HTTP/1.1\r\nContent-Length: -5\r\n\r\n')
+            self.assertTrue(
+                client.recv(1024).startswith(b'HTTP/1.1 400 '))
+
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        for query in (
+            'company=a%22b', 'company=a%0D%0Ab', 'keyboard_description=%22',
+            'language_tag=en%0AUS', 'name=a%22b'
+        ):
+            response, body = self.request(
+                connection, 'POST', f'/convert?{query}', keylayout)
+            self.assertEqual(response.status, 400, query)
+        connection.close()
+
+    def send_raw(self, data):
+        import socket
+
+        with socket.create_connection(('127.0.0.1', self.port)) as client:
+            client.settimeout(5)
+            client.sendall(data)
+            return client.recv(1024)
+
+    def test_request_limits(self):
+        self.assertTrue(self.send_raw(
+            b'GET /health HTTP/1.1\r\n' +
+            b'X-Header: x\r\n' * (max_header_lines + 1) +
+            b'\r\n').startswith(b'HTTP/1.1 431 '))
+        self.assertTrue(self.send_raw(
+            b'GET /health HTTP/1.1\r\nX-Header: ' + b'x' * 70000 +
+            b'\r\n\r\n').startswith(b'HTTP/1.1 431 '))
+        self.assertTrue(self.send_raw(
+            b'GET /' + b'x' * 70000 +
+            b' HTTP/1.1\r\n\r\n').startswith(b'HTTP/1.1 414 '))
+
+        # rejected before the body is read
+        self.server.pending = self.server.max_pending
+        try:
+            self.assertTrue(self.send_raw(
+                b'POST /convert HTTP/1.1\r\nContent-Length: 1000000\r\n'
+                b'\r\n').startswith(b'HTTP/1.1 503 '))
+        finally:
+            self.server.pending = 0
+
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        response, body = self.request(connection, 'GET', '/health')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body)['pending'], 0)
+        connection.close()
+
+    def test_worker_restart(self):
+        import signal
+
+        with open(os.path.join('tests', 'sgcap.keylayout'), 'rb') as f:
+            keylayout = f.read()
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        response, body = self.request(
+            connection, 'POST', '/convert?name=sgcap', keylayout)
+        self.assertEqual(response.status, 200)
+
+        restarts = self.server.restarts
+        for pid in list(self.server.executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        response, body = self.request(
+            connection, 'POST', '/convert?name=sgcap', keylayout)
+        self.assertEqual(response.status, 422)
+        self.assertIn(b'BrokenProcessPool', body)
+        self.assertEqual(self.server.restarts, restarts + 1)
+
+        response, body = self.request(
+            connection, 'POST', '/convert?name=sgcap', keylayout)
+        self.assertEqual(response.status, 200)
+        connection.close()
+
+    def test_headers(self):
+        self.assertEqual(
+            make_content_disposition('us_test.klc'),
+            'attachment; filename="us_test.klc"')
+        self.assertEqual(
+            make_content_disposition('a"b.klc'),
+            'attachment; filename="a_b.klc"; filename*=UTF-8\'\'a%22b.klc')
+
+        messages = [f'message {index}: ' + 'x' * 100 for index in range(1000)]
+        header = make_diagnostics_header(messages)
+        self.assertLessEqual(len(header), diagnostics_header_limit)
+        included = json.loads(header)
+        self.assertEqual(included, messages[:len(included)])
+        self.assertGreater(len(included), 10)
+        self.assertEqual(
+            json.loads(make_diagnostics_header(messages[:3])), messages[:3])
+
+    def test_backpressure(self):
+        self.server.pending = self.server.max_pending
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port)
+            response, body = self.request(
+                connection, 'POST', '/convert', b'')
+            self.assertEqual(response.status, 503)
+            self.assertEqual(response.getheader('Retry-After'), '1')
+            connection.close()
+        finally:
+            self.server.pending = 0
+
+
+if __name__ == "__main__":
+    sys.exit(unittest.main())